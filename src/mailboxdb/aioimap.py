@@ -0,0 +1,498 @@
+import asyncio
+import base64
+import re
+import ssl
+import tempfile
+from collections import defaultdict, deque
+from collections.abc import AsyncIterator, Iterator
+from imaplib import IMAP4, IMAP4_PORT, IMAP4_SSL_PORT
+from typing import IO, NamedTuple, TypeAlias
+
+from mailboxdb.attachments import open_store
+from mailboxdb.config import ConfigReader
+from mailboxdb.helpers import results_from_raw
+from mailboxdb.imap import (
+    DEFAULT_FETCH_BATCH_BYTES,
+    DEFAULT_FETCH_BATCH_SIZE,
+    FETCH_SIZE_RE,
+    FETCH_UID_RE,
+    SIZE_PROBE_CHUNK,
+    THROTTLED,
+    MboxThrottled,
+    _fetch_items,
+    parse_fetch_literals,
+    plan_batches,
+    uid_sequence_set,
+)
+from mailboxdb.imap_xoauth import (
+    command_token,
+    password_command,
+    use_xoauth2,
+    xoauth2_string,
+)
+from mailboxdb.logger import get_logger
+from mailboxdb.schema import (
+    OK_STATUS,
+    UID,
+    ListUIDs,
+    MailboxStatus,
+    MboxResults,
+    RawMessage,
+)
+from mailboxdb.stream import (
+    DEFAULT_STREAM_CHUNK_SIZE,
+    DEFAULT_STREAM_THRESHOLD,
+    split_message,
+)
+
+# UID FETCH commands in flight per connection.
+DEFAULT_FETCH_PIPELINE = 4
+# Longest response line; UID SEARCH of a large mailbox is a single line.
+MAX_LINE = 16 * 1024 * 1024
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n$')
+UNTAGGED_STATUS_RE = re.compile(rb'(\d+) ([A-Z-]+)(?: (.*))?$', re.DOTALL)
+UNTAGGED_RE = re.compile(rb'([A-Z-]+)(?: (.*))?$', re.DOTALL)
+RESPONSE_CODE_RE = re.compile(rb'\[([A-Z-]+)(?: ([^\]]*))?\]')
+QUOTE_NEEDED_RE = re.compile(r'[\s"\\(){%*\]]')
+
+# Untagged responses by type, shaped like imaplib's: literals come as
+# `(header, literal)` tuples followed by the rest of the response line.
+Responses: TypeAlias = dict[str, list]
+
+
+class _Command(NamedTuple):
+    future: 'asyncio.Future[tuple[str, bytes]]'
+    responses: Responses
+
+
+def _astring(value: str) -> bytes:
+    """
+    Quote `value` as an IMAP string unless it is already quoted or is an atom.
+    """
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        return value.encode()
+    if value and not QUOTE_NEEDED_RE.search(value):
+        return value.encode()
+    return ('"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"').encode()
+
+
+class AsyncMbox:
+    """
+    asyncio IMAP4 client with the surface of `Mbox`.
+
+    Commands are pipelined: each one is written with its own tag and awaits its
+    tagged completion, while a single reader task parses responses, so many
+    connections share one event loop. Untagged responses go to every command
+    in flight and are matched by UID.
+    """
+
+    def __init__(
+        self,
+        settings: ConfigReader,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ):
+        self.log = get_logger(self.__class__.__name__)
+        self.settings = settings
+        self.batch_size = settings.get_int('fetch_batch_size', DEFAULT_FETCH_BATCH_SIZE)
+        self.batch_bytes = settings.get_int(
+            'fetch_batch_bytes', DEFAULT_FETCH_BATCH_BYTES
+        )
+        self.pipeline = max(1, settings.get_int('fetch_pipeline', DEFAULT_FETCH_PIPELINE))
+        self.stream_threshold = settings.get_int(
+            'stream_threshold', DEFAULT_STREAM_THRESHOLD
+        )
+        self.stream_chunk_size = settings.get_int(
+            'stream_chunk_size', DEFAULT_STREAM_CHUNK_SIZE
+        )
+        self.store = open_store(settings)
+        self.capabilities: tuple[str, ...] = ()
+        self.selected: str | None = None
+        self.reader = reader
+        self.writer = writer
+        self.tagnum = 0
+        self.commands: dict[bytes, _Command] = {}
+        self.unsolicited: Responses = defaultdict(list)
+        self.continuation: asyncio.Future[bytes] | None = None
+        self.reader_task: asyncio.Task | None = None
+
+    @classmethod
+    async def connect(
+        cls, settings: ConfigReader, port: int | None = None, use_ssl: bool = True
+    ) -> 'AsyncMbox':
+        """
+        Connect to the IMAP4 server and log in.
+        """
+        context = ssl.create_default_context() if use_ssl else None
+        reader, writer = await asyncio.open_connection(
+            settings.server,
+            port or (IMAP4_SSL_PORT if use_ssl else IMAP4_PORT),
+            ssl=context,
+            limit=MAX_LINE,
+        )
+        mbox = cls(settings, reader, writer)
+        greeting = await reader.readuntil(b'\r\n')
+        if not greeting.startswith((b'* OK', b'* PREAUTH')):
+            writer.close()
+            raise IMAP4.error(f'Unexpected greeting: {greeting!r}')
+        mbox.reader_task = asyncio.create_task(mbox._read_responses())
+        try:
+            await mbox.capability()
+            if use_xoauth2(settings):
+                await mbox.authenticate_xoauth2()
+            else:
+                await mbox.login(settings.username, settings.password)
+        except BaseException:
+            await mbox.close()
+            raise
+        mbox.log.info('Successfully logged in.')
+        return mbox
+
+    async def _read_response(self) -> tuple[bytes, list]:
+        """
+        Read one response with its literals.
+        Returns the first line and the imaplib-shaped parts of the response.
+        """
+        line = await self.reader.readuntil(b'\r\n')
+        first = line
+        parts: list = []
+        while match := LITERAL_RE.search(line):
+            literal = await self.reader.readexactly(int(match.group(1)))
+            parts.append((line[:-2], literal))
+            line = await self.reader.readuntil(b'\r\n')
+        parts.append(line[:-2])
+        return first, parts
+
+    async def _read_responses(self):
+        try:
+            while True:
+                first, parts = await self._read_response()
+                if first.startswith(b'+'):
+                    self._continue(parts[-1][1:].strip())
+                elif first.startswith(b'* '):
+                    self._untagged(parts)
+                else:
+                    self._tagged(parts[-1])
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as err:
+            error = IMAP4.abort(f'Connection closed: {err}')
+        except asyncio.CancelledError:
+            error = IMAP4.abort('Connection closed')
+        except Exception as err:
+            error = err
+        for command in self.commands.values():
+            if not command.future.done():
+                command.future.set_exception(error)
+        if self.continuation and not self.continuation.done():
+            self.continuation.set_exception(error)
+
+    def _continue(self, data: bytes):
+        if self.continuation and not self.continuation.done():
+            self.continuation.set_result(data)
+        else:
+            # An unexpected challenge, e.g. an XOAUTH2 error: answer it empty.
+            self.writer.write(b'\r\n')
+
+    def _untagged(self, parts: list):
+        head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        head = head[2:]
+        if match := UNTAGGED_STATUS_RE.match(head):
+            name = match.group(2)
+            data = match.group(1) + (b' ' + match.group(3) if match.group(3) else b'')
+        elif match := UNTAGGED_RE.match(head):
+            name = match.group(1)
+            data = match.group(2) or b''
+        else:
+            self.log.warning('Unparsed response: %r', head)
+            return
+
+        first = (data, parts[0][1]) if isinstance(parts[0], tuple) else data
+        entries = [first, *parts[1:]]
+        found: dict[str, list] = {name.decode().upper(): entries}
+        if code := RESPONSE_CODE_RE.match(data):
+            found[code.group(1).decode().upper()] = [code.group(2) or b'']
+
+        targets = [c.responses for c in self.commands.values()] or [self.unsolicited]
+        for responses in targets:
+            for key, values in found.items():
+                responses[key].extend(values)
+
+    def _tagged(self, line: bytes):
+        tag, _, rest = line.partition(b' ')
+        command = self.commands.get(tag)
+        if command is None:
+            self.log.warning('Response for unknown tag: %r', line)
+            return
+        status, _, text = rest.partition(b' ')
+        if not command.future.done():
+            command.future.set_result((status.decode().upper(), text))
+
+    async def command(
+        self, name: str, *args: bytes | str, continuation: bytes | None = None
+    ) -> tuple[str, Responses]:
+        """
+        Send a command and wait for its tagged completion.
+        Returns the status and the untagged responses received meanwhile.
+        """
+        self.tagnum += 1
+        tag = b'M%d' % self.tagnum
+        command = _Command(asyncio.get_running_loop().create_future(), defaultdict(list))
+        self.commands[tag] = command
+        words = [tag, name.encode()]
+        words.extend(arg.encode() if isinstance(arg, str) else arg for arg in args)
+        try:
+            if continuation is not None:
+                self.continuation = asyncio.get_running_loop().create_future()
+            self.writer.write(b' '.join(words) + b'\r\n')
+            await self.writer.drain()
+            if continuation is not None and self.continuation:
+                await self.continuation
+                self.writer.write(continuation + b'\r\n')
+                await self.writer.drain()
+            status, text = await command.future
+        finally:
+            del self.commands[tag]
+            if continuation is not None:
+                self.continuation = None
+        command.responses['TEXT'] = [text]
+        return status, command.responses
+
+    async def capability(self) -> tuple[str, ...]:
+        _, responses = await self.command('CAPABILITY')
+        if responses['CAPABILITY']:
+            self.capabilities = tuple(
+                responses['CAPABILITY'][-1].decode().upper().split()
+            )
+        return self.capabilities
+
+    async def login(self, username: str, password: str):
+        status, responses = await self.command(
+            'LOGIN', _astring(username), _astring(password)
+        )
+        if status != OK_STATUS:
+            raise IMAP4.error(f'LOGIN failed: {responses["TEXT"][-1]!r}')
+        await self.capability()
+
+    async def authenticate_xoauth2(self):
+        command = password_command(self.settings)
+        token = await asyncio.to_thread(command_token, command)
+        auth = base64.b64encode(xoauth2_string(self.settings.username, token))
+        if 'SASL-IR' in self.capabilities:
+            status, responses = await self.command('AUTHENTICATE', 'XOAUTH2', auth)
+        else:
+            status, responses = await self.command(
+                'AUTHENTICATE', 'XOAUTH2', continuation=auth
+            )
+        if status != OK_STATUS:
+            raise IMAP4.error(f'XOAUTH2 failed: {responses["TEXT"][-1]!r}')
+        await self.capability()
+
+    async def select_mailbox(self, label: str = 'INBOX') -> MailboxStatus:
+        status, responses = await self.command('EXAMINE', _astring(label))
+        if status != OK_STATUS:
+            raise IMAP4.error(f'Cannot select {label}: {responses["TEXT"][-1]!r}')
+        self.selected = label
+
+        def number(code: str) -> int | None:
+            values = responses.get(code)
+            return int(values[-1]) if values and values[-1].isdigit() else None
+
+        return MailboxStatus(number('UIDVALIDITY'), number('HIGHESTMODSEQ'))
+
+    async def uid(self, command: str, *args: str) -> tuple[str, Responses]:
+        return await self.command('UID', command, *args)
+
+    async def uid_fetch(self, message_set: str, items: str) -> tuple[str, list]:
+        """
+        Run UID FETCH, raising `MboxThrottled` when the server throttles us.
+        """
+        status, responses = await self.uid('FETCH', message_set, items)
+        if status != OK_STATUS and THROTTLED in responses['TEXT'][-1]:
+            raise MboxThrottled(f'Server throttled UID FETCH {message_set}')
+        return status, responses['FETCH']
+
+    async def get_message_uids(
+        self, latest_uid: str | None, label: str = 'INBOX'
+    ) -> ListUIDs | None:
+        """
+        Get all message UIDs to be fetched from server.
+        Resume from the `latest UID` if there is one found.
+        """
+        if self.selected != label:
+            await self.select_mailbox(label)
+
+        if latest_uid:
+            box_status, responses = await self.uid('SEARCH', 'UID', f'{latest_uid}:*')
+            self.log.info('Resuming from the latest UID: %s', latest_uid)
+        else:
+            box_status, responses = await self.uid('SEARCH', 'ALL')
+            self.log.info('Fetching ALL messages.')
+
+        if box_status != OK_STATUS:
+            self.log.error('Mbox error: %s', box_status)
+            return None
+
+        message_uids = [m_uid for data in responses['SEARCH'] for m_uid in data.split()]
+        if latest_uid and latest_uid.encode() in message_uids:
+            message_uids.remove(latest_uid.encode())
+
+        self.log.info('Message count: %s', len(message_uids))
+        return message_uids
+
+    async def get_message_sizes(self, message_uids: ListUIDs) -> dict[UID, int]:
+        """
+        Get the RFC822.SIZE of each message, with all probes pipelined.
+        """
+        chunks = [
+            message_uids[start : start + SIZE_PROBE_CHUNK]
+            for start in range(0, len(message_uids), SIZE_PROBE_CHUNK)
+        ]
+        replies = await asyncio.gather(
+            *(self.uid_fetch(uid_sequence_set(c), '(UID RFC822.SIZE)') for c in chunks)
+        )
+        wanted = set(message_uids)
+        sizes: dict[UID, int] = {}
+        for msg_status, msg_data in replies:
+            if msg_status != OK_STATUS:
+                self.log.warning('Size probe failed: %s', msg_status)
+                continue
+            for item in msg_data:
+                if not isinstance(item, bytes):
+                    continue
+                uid_match = FETCH_UID_RE.search(item)
+                size_match = FETCH_SIZE_RE.search(item)
+                if uid_match and size_match and uid_match.group(1) in wanted:
+                    sizes[uid_match.group(1)] = int(size_match.group(1))
+        return sizes
+
+    def plan_batches(self, message_uids: ListUIDs, sizes: dict[UID, int]):
+        return plan_batches(
+            message_uids, sizes, self.batch_size, self.batch_bytes, self.stream_threshold
+        )
+
+    async def fetch_batch(
+        self, batch: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> list[RawMessage]:
+        """
+        Fetch a single batch of UIDs with one UID FETCH,
+        or stream it if it is a single large message.
+        """
+        if len(batch) == 1 and sizes and sizes.get(batch[0], 0) > self.stream_threshold:
+            return [await self.stream_message(batch[0])]
+
+        msg_status, msg_data = await self.uid_fetch(
+            uid_sequence_set(batch), '(UID RFC822)'
+        )
+        if msg_status != OK_STATUS:
+            self.log.warning('Batch FETCH is not OK: %s', uid_sequence_set(batch))
+            return []
+
+        wanted = set(batch)
+        found = {
+            m_uid: literal
+            for m_uid, literal in parse_fetch_literals(msg_data)
+            if m_uid in wanted
+        }
+        missing = wanted.difference(found)
+        if missing:
+            self.log.warning('Messages missing from batch: %s', uid_sequence_set(missing))
+        return [RawMessage(found[m_uid], m_uid) for m_uid in batch if m_uid in found]
+
+    async def stream_message(self, m_uid: UID) -> RawMessage:
+        """
+        Spool a large message to a temp file with partial FETCH,
+        then extract its attachments in a thread.
+        """
+        self.log.info('Streaming large message: UID=%s', m_uid)
+        with tempfile.TemporaryFile() as spool:
+            offset = 0
+            while True:
+                msg_status, msg_data = await self.uid_fetch(
+                    m_uid.decode(), f'(BODY.PEEK[]<{offset}.{self.stream_chunk_size}>)'
+                )
+                if msg_status != OK_STATUS:
+                    raise RuntimeError(
+                        f'Partial FETCH failed for UID {m_uid!r}: {msg_status}'
+                    )
+                chunk = next(
+                    (
+                        literal
+                        for items, literal in _fetch_items(msg_data)
+                        if (match := FETCH_UID_RE.search(items))
+                        and match.group(1) == m_uid
+                    ),
+                    b'',
+                )
+                spool.write(chunk)
+                offset += len(chunk)
+                if len(chunk) < self.stream_chunk_size:
+                    break
+            spool.seek(0)
+            return await asyncio.to_thread(
+                split_message,
+                _spool_chunks(spool, self.stream_chunk_size),
+                m_uid,
+                self.store,
+            )
+
+    async def fetch_raw_messages(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> AsyncIterator[RawMessage]:
+        """
+        Fetch messages with up to `fetch_pipeline` UID FETCH commands in flight,
+        yielding them in UID order without parsing them.
+        """
+        if not message_uids:
+            return
+        if sizes is None:
+            sizes = await self.get_message_sizes(message_uids)
+        batches = iter(self.plan_batches(message_uids, sizes))
+        in_flight: deque[asyncio.Task[list[RawMessage]]] = deque()
+
+        def launch():
+            if batch := next(batches, None):
+                in_flight.append(asyncio.ensure_future(self.fetch_batch(batch, sizes)))
+
+        for _ in range(self.pipeline):
+            launch()
+        try:
+            while in_flight:
+                results = await in_flight.popleft()
+                launch()
+                for raw in results:
+                    yield raw
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def fetch_all_messages(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> AsyncIterator[MboxResults]:
+        """
+        Fetch each eligible message in RFC822 format.
+        Returns an async generator.
+        """
+        async for raw in self.fetch_raw_messages(message_uids, sizes):
+            yield results_from_raw(raw)
+
+    async def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        finally:
+            await self.close()
+        self.log.info('Logged out')
+
+
+def _spool_chunks(spool: IO[bytes], chunk_size: int) -> Iterator[bytes]:
+    while chunk := spool.read(chunk_size):
+        yield chunk
@@ -0,0 +1,625 @@
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, NamedTuple
+
+from mailboxdb.config import ConfigReader
+from mailboxdb.helpers import sha256sum
+from mailboxdb.logger import get_logger
+from mailboxdb.model import AttachmentMeta, db
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+log = get_logger('Attachments')
+
+DEFAULT_ATTACHMENTS_PATH = 'attachments'
+TMP_PREFIX = '.tmp-'
+# Files younger than this are left alone by gc, as a running sync may not
+# have committed their `AttachmentMeta` row yet.
+GC_GRACE_SECONDS = 3600
+DEFAULT_VERIFY_WORKERS = 8
+HASH_CHUNK_SIZE = 1024 * 1024
+# Attachments smaller than this go into pack segments with the pack store.
+DEFAULT_PACK_THRESHOLD = 64 * 1024
+# A new segment is started once the current one reaches this size.
+DEFAULT_PACK_SEGMENT_SIZE = 256 * 1024 * 1024
+# Segments with at least this share of unreferenced bytes are rewritten by compaction.
+DEFAULT_COMPACT_GARBAGE = 0.25
+# Lock file in the packs folder: shared by appending processes, exclusive to compaction.
+PACK_LOCK = '.lock'
+
+
+def _fsync_dir(path: Path):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AttachmentWriter:
+    """
+    Write one attachment to a temp file while hashing it.
+    The file is stored under its checksum when the context exits cleanly
+    and removed if it raises.
+    """
+
+    def __init__(self, store: 'AttachmentStore'):
+        self.store = store
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.checksum: str | None = None
+        store.root.mkdir(parents=True, exist_ok=True)
+        self.tmp = tempfile.NamedTemporaryFile(
+            dir=store.root, prefix=TMP_PREFIX, delete=False
+        )
+
+    def write(self, data: bytes):
+        self.hash.update(data)
+        self.size += len(data)
+        self.tmp.write(data)
+
+    def __enter__(self) -> 'AttachmentWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.tmp.close()
+            os.unlink(self.tmp.name)
+            return
+        self.checksum = self.hash.hexdigest()
+        self.store.commit(self)
+
+
+class PackLocation(NamedTuple):
+    segment: int
+    offset: int
+    length: int
+
+
+class PackReader(io.RawIOBase):
+    """
+    Read-only file object over the mapped bytes of a packed attachment,
+    copying only what is read.
+    """
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        end = len(self.view) if size is None or size < 0 else self.pos + size
+        data = self.view[self.pos : end].tobytes()
+        self.pos += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self.view[self.pos : self.pos + len(buffer)]
+        buffer[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}
+        self.pos = max(0, base[whence] + offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self):
+        self.view.release()
+        super().close()
+
+
+class AttachmentStore:
+    """
+    Content-addressed attachment files under `root`, fanned out over two
+    directory levels by checksum: `root/ab/cd/abcd...`.
+
+    Files are written to a temp file, fsynced and renamed into place,
+    so a file that exists is always complete.
+    """
+
+    name = 'files'
+
+    def __init__(self, root: Path | str = DEFAULT_ATTACHMENTS_PATH):
+        self.root = Path(root)
+
+    @classmethod
+    def from_settings(cls, settings: ConfigReader | None) -> 'AttachmentStore':
+        return cls(getattr(settings, 'attachments_path', DEFAULT_ATTACHMENTS_PATH))
+
+    def packs(self, size: int) -> bool:
+        """
+        Whether an attachment of `size` bytes is handed to the single writer
+        to be packed, instead of written as a file by the parse workers.
+        """
+        return False
+
+    def add(self, data: bytes) -> PackLocation | None:
+        """
+        Store an attachment from the writer, returning its pack location if packed.
+        """
+        self.put(data)
+        return None
+
+    def sync(self):
+        """
+        Make writes from `add` durable, before the rows pointing at them commit.
+        """
+
+    def compact(self, min_garbage: float = DEFAULT_COMPACT_GARBAGE) -> int:
+        log.info('The %s attachment store has nothing to compact', self.name)
+        return 0
+
+    def path(self, checksum: str) -> Path:
+        return self.root / checksum[:2] / checksum[2:4] / checksum
+
+    def find(self, checksum: str) -> Path | None:
+        """
+        The file of `checksum` in its shard, or still in the flat layout
+        until `checksums` moves it.
+        """
+        for path in (self.path(checksum), self.root / checksum):
+            if path.is_file():
+                return path
+        return None
+
+    def exists(self, checksum: str) -> bool:
+        return self.find(checksum) is not None
+
+    def writer(self) -> AttachmentWriter:
+        return AttachmentWriter(self)
+
+    def put(self, data: bytes) -> str:
+        """
+        Store `data`, returning its checksum.
+        """
+        checksum = sha256sum(data)
+        if self.exists(checksum):
+            log.info(
+                'Attachment file already exists with checksum=%s, Not storing', checksum
+            )
+            return checksum
+        with self.writer() as writer:
+            writer.write(data)
+        return writer.checksum
+
+    def commit(self, writer: AttachmentWriter):
+        checksum = writer.checksum
+        writer.tmp.flush()
+        os.fsync(writer.tmp.fileno())
+        writer.tmp.close()
+        if self.exists(checksum):
+            log.info(
+                'Attachment file already exists with checksum=%s, Not storing', checksum
+            )
+            os.unlink(writer.tmp.name)
+            return
+        log.info('Writing file: %s', checksum)
+        file_path = self.path(checksum)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(writer.tmp.name, file_path)
+        _fsync_dir(file_path.parent)
+
+    def open(self, checksum: str) -> BinaryIO:
+        return (self.find(checksum) or self.path(checksum)).open('rb')
+
+    def remove(self, checksum: str):
+        self.path(checksum).unlink(missing_ok=True)
+        (self.root / checksum).unlink(missing_ok=True)
+
+    def flat_files(self) -> list[Path]:
+        """
+        Files still stored flat in `root`, as before the fan-out.
+        """
+        if not self.root.is_dir():
+            return []
+        return [
+            path
+            for path in self.root.iterdir()
+            if path.is_file() and len(path.name) == 64
+        ]
+
+    def move_flat_files(self, dry_run: bool = False) -> int:
+        """
+        Move files from the flat layout into their shard, dropping those
+        already stored there. Returns the number of files moved or dropped.
+        """
+        paths = self.flat_files()
+        for path in paths:
+            log.info(
+                'Flat attachment file%s: %s', ' (dry run)' if dry_run else '', path.name
+            )
+            if dry_run:
+                continue
+            if self.path(path.name).is_file():
+                path.unlink()
+                continue
+            self.path(path.name).parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, self.path(path.name))
+        return len(paths)
+
+    def checksums(self) -> Iterator[str]:
+        """
+        Checksums of all stored files, in their shard or the flat layout.
+        """
+        if not self.root.is_dir():
+            return
+        for path in self.root.glob('??/??/*'):
+            if path == self.path(path.name) and path.is_file():
+                yield path.name
+        for path in self.flat_files():
+            if not self.path(path.name).is_file():
+                yield path.name
+
+    def rehash(self, checksum: str) -> str:
+        file_hash = hashlib.sha256()
+        with self.open(checksum) as fp:
+            while chunk := fp.read(HASH_CHUNK_SIZE):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    def modified(self, checksum: str) -> float:
+        return (self.find(checksum) or self.path(checksum)).stat().st_mtime
+
+    def stale_temp_files(self) -> Iterator[Path]:
+        cutoff = time.time() - GC_GRACE_SECONDS
+        for path in self.root.glob(f'{TMP_PREFIX}*'):
+            if path.stat().st_mtime < cutoff:
+                yield path
+
+
+class PackStore(AttachmentStore):
+    """
+    Attachment store appending small attachments to segment files in
+    `root/packs/`, with their location kept on the `AttachmentMeta` row.
+    Larger attachments are stored as files.
+
+    Segments are only appended to by the single database writer, which syncs
+    them before committing the rows that point at them. Reads map the segment
+    with mmap and return a view of it, without copying.
+
+    A process that appends holds a shared lock on the packs folder until it
+    closes the store, and compaction needs it exclusively, so segments are
+    never rewritten under rows another process has yet to commit.
+    """
+
+    name = 'pack'
+
+    def __init__(
+        self,
+        root: Path | str = DEFAULT_ATTACHMENTS_PATH,
+        threshold: int = DEFAULT_PACK_THRESHOLD,
+        segment_size: int = DEFAULT_PACK_SEGMENT_SIZE,
+    ):
+        super().__init__(root)
+        self.threshold = threshold
+        self.segment_size = segment_size
+        self.packs_dir = self.root / 'packs'
+        self._segment: int | None = None
+        self._append: BinaryIO | None = None
+        self._lock_file: BinaryIO | None = None
+        self._maps: dict[int, mmap.mmap] = {}
+
+    @classmethod
+    def from_settings(cls, settings: ConfigReader | None) -> 'PackStore':
+        if settings is None:
+            return cls()
+        return cls(
+            getattr(settings, 'attachments_path', DEFAULT_ATTACHMENTS_PATH),
+            settings.get_int('pack_threshold', DEFAULT_PACK_THRESHOLD),
+            settings.get_int('pack_segment_size', DEFAULT_PACK_SEGMENT_SIZE),
+        )
+
+    def __getstate__(self):
+        # Parse workers only decide what gets packed; open files stay here.
+        state = self.__dict__.copy()
+        state.update(_segment=None, _append=None, _lock_file=None, _maps={})
+        return state
+
+    def segment_path(self, segment: int) -> Path:
+        return self.packs_dir / f'{segment:06d}.pack'
+
+    def segments(self) -> list[int]:
+        return sorted(int(path.stem) for path in self.packs_dir.glob('*.pack'))
+
+    def packs(self, size: int) -> bool:
+        return size < self.threshold
+
+    def _roll(self):
+        self.sync()
+        if self._append:
+            self._append.close()
+        segments = self.segments()
+        self._segment = (segments[-1] + 1) if segments else 1
+        self.packs_dir.mkdir(parents=True, exist_ok=True)
+        self._append = self.segment_path(self._segment).open('ab')
+
+    def add(self, data: bytes) -> PackLocation | None:
+        if not self.packs(len(data)):
+            return super().add(data)
+        return self._pack(data)
+
+    def _lock(self, exclusive: bool = False):
+        if fcntl is None:
+            return
+        if self._lock_file is None:
+            self.packs_dir.mkdir(parents=True, exist_ok=True)
+            self._lock_file = (self.packs_dir / PACK_LOCK).open('ab')
+        if not exclusive:
+            fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+            return
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(
+                'Pack segments are in use by a running sync, stop it to compact'
+            ) from None
+
+    def close(self):
+        """
+        Sync and close the segment being appended to, and release the lock.
+        """
+        self.sync()
+        if self._append:
+            self._append.close()
+        self._segment = self._append = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _pack(self, data: bytes) -> PackLocation:
+        """
+        Append `data` to the current segment, whatever its size.
+        """
+        if self._lock_file is None:
+            self._lock()
+        if self._append is None:
+            segments = self.segments()
+            if (
+                segments
+                and self.segment_path(segments[-1]).stat().st_size < self.segment_size
+            ):
+                self._segment = segments[-1]
+                self._append = self.segment_path(self._segment).open('ab')
+            else:
+                self._roll()
+        elif self._append.tell() >= self.segment_size:
+            self._roll()
+        offset = self._append.tell()
+        self._append.write(data)
+        return PackLocation(self._segment, offset, len(data))
+
+    def sync(self):
+        if self._append:
+            self._append.flush()
+            os.fsync(self._append.fileno())
+
+    def location(self, checksum: str) -> PackLocation | None:
+        row = (
+            AttachmentMeta.select(
+                AttachmentMeta.pack_segment,
+                AttachmentMeta.pack_offset,
+                AttachmentMeta.pack_length,
+            )
+            .where(
+                AttachmentMeta.file_checksum == checksum,
+                AttachmentMeta.pack_segment.is_null(False),
+            )
+            .tuples()
+            .first()
+        )
+        return PackLocation(*row) if row else None
+
+    def view(self, location: PackLocation) -> memoryview:
+        """
+        The packed bytes at `location`, mapped rather than read.
+        """
+        if not location.length:
+            return memoryview(b'')
+        end = location.offset + location.length
+        mapped = self._maps.get(location.segment)
+        if mapped is None or len(mapped) < end:
+            if location.segment == self._segment:
+                self.sync()
+            with self.segment_path(location.segment).open('rb') as fp:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[location.segment] = mapped
+        return memoryview(mapped)[location.offset : end]
+
+    def exists(self, checksum: str) -> bool:
+        return super().exists(checksum) or self.location(checksum) is not None
+
+    def open(self, checksum: str) -> BinaryIO:
+        location = self.location(checksum)
+        if location is None:
+            return super().open(checksum)
+        return PackReader(self.view(location))
+
+    def rehash(self, checksum: str) -> str:
+        location = self.location(checksum)
+        if location is None:
+            return super().rehash(checksum)
+        return hashlib.sha256(self.view(location)).hexdigest()
+
+    def remove(self, checksum: str):
+        super().remove(checksum)
+        AttachmentMeta.update(
+            pack_segment=None, pack_offset=None, pack_length=None
+        ).where(AttachmentMeta.file_checksum == checksum).execute()
+
+    def checksums(self) -> Iterator[str]:
+        yield from super().checksums()
+        query = AttachmentMeta.select(AttachmentMeta.file_checksum).where(
+            AttachmentMeta.pack_segment.is_null(False)
+        )
+        for (checksum,) in query.tuples():
+            yield checksum
+
+    def compact(self, min_garbage: float = DEFAULT_COMPACT_GARBAGE) -> int:
+        """
+        Rewrite segments where at least `min_garbage` of the bytes are no longer
+        referenced, moving live attachments to a new segment.
+        Returns the number of bytes released.
+
+        gc never unreferences packed attachments, so the garbage is what was
+        appended by transactions that rolled back, and corrupt attachments
+        dropped by `verify --repair`.
+        Raises RuntimeError while another process is appending.
+        """
+        self._lock(exclusive=True)
+        try:
+            return self._compact(min_garbage)
+        finally:
+            self.close()
+
+    def _compact(self, min_garbage: float) -> int:
+        released = 0
+        rolled = False
+        for segment in self.segments():
+            path = self.segment_path(segment)
+            size = path.stat().st_size
+            rows = list(
+                AttachmentMeta.select()
+                .where(AttachmentMeta.pack_segment == segment)
+                .order_by(AttachmentMeta.pack_offset)
+            )
+            live = sum(row.pack_length for row in rows)
+            if size and (size - live) / size < min_garbage:
+                continue
+            if not rolled:
+                # Live attachments move to a new segment, after all existing ones.
+                self._roll()
+                rolled = True
+            with db.atomic():
+                for row in rows:
+                    data = self.view(
+                        PackLocation(segment, row.pack_offset, row.pack_length)
+                    )
+                    # Packed already: stays packed if pack_threshold went down since.
+                    location = self._pack(bytes(data))
+                    row.pack_segment, row.pack_offset, row.pack_length = location
+                    row.save()
+                self.sync()
+            self._maps.pop(segment, None)
+            path.unlink()
+            released += size - live
+            log.info(
+                'Compacted segment %s: moved=%s released_bytes=%s',
+                segment,
+                len(rows),
+                size - live,
+            )
+        log.info('Pack compaction released bytes: %s', released)
+        return released
+
+
+ATTACHMENT_STORES: dict[str, type[AttachmentStore]] = {
+    AttachmentStore.name: AttachmentStore,
+    PackStore.name: PackStore,
+}
+
+
+def open_store(settings: ConfigReader | None = None) -> AttachmentStore:
+    """
+    The attachment store configured by `attachment_store` and `attachments_path`.
+    """
+    kind = getattr(settings, 'attachment_store', AttachmentStore.name)
+    if kind not in ATTACHMENT_STORES:
+        raise RuntimeError(
+            f'Unknown attachment store {kind!r}, use one of {tuple(ATTACHMENT_STORES)}'
+        )
+    return ATTACHMENT_STORES[kind].from_settings(settings)
+
+
+class VerifyReport(NamedTuple):
+    checked: int
+    corrupt: list[str]
+    missing: list[str]
+
+
+def verify_store(
+    store: AttachmentStore, workers: int = DEFAULT_VERIFY_WORKERS, repair: bool = False
+) -> VerifyReport:
+    """
+    Re-hash every stored file on a thread pool and check every `AttachmentMeta`
+    has its file. With `repair`, corrupt files are removed so the next sync
+    of a message carrying them stores them again.
+    """
+    checksums = list(store.checksums())
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        actual = executor.map(store.rehash, checksums)
+        corrupt = [c for c, digest in zip(checksums, actual) if c != digest]
+    for checksum in corrupt:
+        log.warning('Corrupt attachment file: %s', checksum)
+        if repair:
+            store.remove(checksum)
+
+    stored = set(checksums).difference(corrupt)
+    missing = [
+        checksum
+        for (checksum,) in AttachmentMeta.select(AttachmentMeta.file_checksum).tuples()
+        if checksum not in stored
+    ]
+    for checksum in missing:
+        log.warning('Attachment file missing: %s', checksum)
+    log.info(
+        'Verified attachment files: checked=%s corrupt=%s missing=%s',
+        len(checksums),
+        len(corrupt),
+        len(missing),
+    )
+    return VerifyReport(len(checksums), corrupt, missing)
+
+
+def gc_store(store: AttachmentStore, dry_run: bool = False) -> list[str]:
+    """
+    Move files from the flat layout into their shard, then delete files no
+    `AttachmentMeta` row references, and stale temp files.
+    Returns the checksums of the deleted files.
+    """
+    store.move_flat_files(dry_run)
+    referenced = {
+        checksum
+        for (checksum,) in AttachmentMeta.select(AttachmentMeta.file_checksum).tuples()
+    }
+    cutoff = time.time() - GC_GRACE_SECONDS
+    orphans = [
+        checksum
+        for checksum in store.checksums()
+        if checksum not in referenced and store.modified(checksum) < cutoff
+    ]
+    for checksum in orphans:
+        log.info(
+            'Orphan attachment file%s: %s', ' (dry run)' if dry_run else '', checksum
+        )
+        if not dry_run:
+            store.remove(checksum)
+    for path in store.stale_temp_files():
+        log.info('Stale temp file%s: %s', ' (dry run)' if dry_run else '', path.name)
+        if not dry_run:
+            path.unlink(missing_ok=True)
+    log.info('Orphan attachment files: %s', len(orphans))
+    return orphans
@@ -0,0 +1,55 @@
+import lzma
+import zlib
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+# Codec names stored in RawMsg.codec; None marks an uncompressed body.
+CODEC_NONE = 'none'
+CODECS = (CODEC_NONE, 'zlib', 'lzma', 'zstd')
+DEFAULT_CODEC = 'zlib'
+
+
+def check_codec(codec: str) -> str:
+    codec = codec.strip().lower()
+    if codec not in CODECS:
+        raise RuntimeError(f'Unknown compression codec {codec!r}, use one of {CODECS}')
+    if codec == 'zstd' and zstd is None:
+        raise RuntimeError('zstd compression needs Python 3.14+ or the zstandard package')
+    return codec
+
+
+def stored_codec(codec: str) -> str | None:
+    """
+    Value of the codec marker column for `codec`.
+    """
+    return None if codec == CODEC_NONE else codec
+
+
+def compress(data: bytes, codec: str | None) -> bytes:
+    if codec is None or codec == CODEC_NONE:
+        return data
+    if codec == 'zlib':
+        return zlib.compress(data)
+    if codec == 'lzma':
+        return lzma.compress(data)
+    if codec == 'zstd' and zstd is not None:
+        return zstd.compress(data)
+    raise RuntimeError(f'Cannot compress with codec {codec!r}')
+
+
+def decompress(data: bytes, codec: str | None) -> bytes:
+    if codec is None or codec == CODEC_NONE:
+        return data
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lzma':
+        return lzma.decompress(data)
+    if codec == 'zstd' and zstd is not None:
+        return zstd.decompress(data)
+    raise RuntimeError(f'Cannot decompress codec {codec!r}')
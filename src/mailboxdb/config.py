@@ -1,17 +1,88 @@
 import configparser
+import re
 from pathlib import Path
 
+TRUTHY = {'1', 'true', 'yes', 'y', 'on'}
+# Comma separated list items; quoted items may contain commas.
+LIST_ITEM_RE = re.compile(r'"[^"]*"|[^,]+')
+
+
+def parse_pragmas(items: list[str]) -> dict[str, str | int]:
+    """
+    Parse `key=value` SQLite pragmas, converting integer values.
+    """
+    pragmas: dict[str, str | int] = {}
+    for item in items:
+        key, sep, value = item.partition('=')
+        if not sep or not key.strip():
+            raise RuntimeError(f'Pragma must look like key=value, got {item!r}')
+        value = value.strip()
+        pragmas[key.strip().lower()] = (
+            int(value) if value.lstrip('-').isdigit() else value
+        )
+    return pragmas
+
 
 class INIConfigReader:
-    def __init__(self, filename: str = 'credentials.ini'):
+    def __init__(self, filename: str = 'credentials.ini', section: str | None = None):
         if not Path(filename).is_file():
             raise RuntimeError(f'Config file not found {filename}')
         config = configparser.ConfigParser()
         config.read(filename)
-        config_dict = config.defaults()
+        if section is not None and not config.has_section(section):
+            raise RuntimeError(f'Config section not found {section}')
+        config_dict = config[section] if section else config.defaults()
         for k, v in config_dict.items():
             setattr(self, str(k), v)
+        self._filename = filename
+        self._section = section
+        self._sections = config.sections()
+
+    @property
+    def section(self) -> str | None:
+        return self._section
+
+    def get_int(self, key: str, default: int) -> int:
+        raw = getattr(self, key, None)
+        if raw is None or str(raw).strip() == '':
+            return default
+        try:
+            return int(str(raw).strip())
+        except ValueError as err:
+            raise RuntimeError(f'{key} must be an integer, got {raw!r}') from err
+
+    def get_bool(self, key: str, default: bool) -> bool:
+        raw = getattr(self, key, None)
+        if raw is None or str(raw).strip() == '':
+            return default
+        return str(raw).strip().lower() in TRUTHY
+
+    def get_list(self, key: str, default: list[str]) -> list[str]:
+        raw = getattr(self, key, None)
+        if raw is None or str(raw).strip() == '':
+            return default
+        items = (item.strip() for item in LIST_ITEM_RE.findall(str(raw)))
+        return [item for item in items if item]
 
 
 class ConfigReader(INIConfigReader):
-    pass
+    def accounts(self) -> list['ConfigReader']:
+        """
+        One settings object per INI section, each inheriting DEFAULT.
+        Without sections, DEFAULT itself is the only account.
+        """
+        if self._section or not self._sections:
+            return [self]
+        return [ConfigReader(self._filename, section) for section in self._sections]
+
+    def mailbox_names(self) -> list[str]:
+        """
+        Mailboxes to sync, from `mailboxes` or the single `mailbox` option.
+        """
+        return self.get_list('mailboxes', [getattr(self, 'mailbox', 'INBOX')])
+
+    def mailbox_row_name(self, label: str) -> str:
+        """
+        Name of the `Mailbox` row holding the sync state of `label`.
+        """
+        return f'{self._section}:{label}' if self._section else label
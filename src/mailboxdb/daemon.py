@@ -0,0 +1,225 @@
+import math
+import queue
+import signal
+import threading
+import time
+from contextlib import suppress
+from imaplib import IMAP4
+from typing import NamedTuple, TypeAlias
+
+from mailboxdb.attachments import AttachmentStore
+from mailboxdb.codec import DEFAULT_CODEC
+from mailboxdb.config import ConfigReader
+from mailboxdb.dedup import DedupCache
+from mailboxdb.imap import Mbox
+from mailboxdb.imap_xoauth import use_xoauth2
+from mailboxdb.instrument import stats
+from mailboxdb.logger import get_logger
+from mailboxdb.model import Mailbox, db
+from mailboxdb.process import (
+    DEFAULT_COMMIT_INTERVAL,
+    DEFAULT_COMMIT_SIZE,
+    DEFAULT_PARSE_WORKERS,
+    MessageWriter,
+    ParsePipeline,
+)
+from mailboxdb.sync import (
+    WRITER_QUEUE_SIZE,
+    MailboxSync,
+    SyncDone,
+    SyncItem,
+    writer_timeout,
+)
+
+log = get_logger('Daemon')
+
+# Seconds before the first reconnect; doubled after each failed attempt.
+DEFAULT_RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 5 * 60
+# Seconds an XOAUTH2 connection is used before reconnecting with a fresh token.
+DEFAULT_TOKEN_REFRESH = 50 * 60
+
+
+class WatchStopped(NamedTuple):
+    pass
+
+
+WatchQueue: TypeAlias = 'queue.Queue[tuple[MailboxSync, SyncItem | WatchStopped]]'
+
+
+class MailboxWatch(MailboxSync):
+    """
+    Keep a connection open to one mailbox, syncing it whenever it changes.
+
+    Each sync hands its items to the writer like `MailboxSync` and waits
+    until the writer stored the checkpoint before idling again.
+    """
+
+    def __init__(
+        self,
+        settings: ConfigReader,
+        label: str,
+        mailbox_row: Mailbox,
+        stop: threading.Event,
+    ):
+        super().__init__(settings, label, mailbox_row)
+        self.stop = stop
+        self.finished = threading.Event()
+        self.reconnect_delay = settings.get_int(
+            'reconnect_delay', DEFAULT_RECONNECT_DELAY
+        )
+        self.token_refresh = settings.get_int('token_refresh', DEFAULT_TOKEN_REFRESH)
+        self.delay = self.reconnect_delay
+
+    def start(self, out: WatchQueue):
+        log.info('Mailbox watch start: mailbox=%s', self.name)
+        thread = threading.Thread(
+            target=self._watch, args=(out,), name=f'watch-{self.name}', daemon=True
+        )
+        thread.start()
+
+    def _watch(self, out: WatchQueue):
+        try:
+            while not self.stop.is_set():
+                try:
+                    self._connection(out)
+                except Exception as err:
+                    if self.stop.is_set():
+                        break
+                    log.warning(
+                        'Mailbox connection lost: mailbox=%s error=%s, retry in %ss',
+                        self.name,
+                        err,
+                        self.delay,
+                    )
+                    self.stop.wait(self.delay)
+                    self.delay = min(self.delay * 2, MAX_RECONNECT_DELAY)
+        finally:
+            if not db.is_closed():
+                db.close()
+            out.put((self, WatchStopped()))
+
+    def _connection(self, out: WatchQueue):
+        """
+        Sync on one connection until it is stopped or due for a new OAuth token.
+        """
+        mbox = Mbox(self.settings)
+        renew_at = math.inf
+        if use_xoauth2(self.settings):
+            renew_at = time.monotonic() + self.token_refresh
+        try:
+            mbox.enable_changes()
+            changed = True
+            while not self.stop.is_set():
+                if changed:
+                    self._cycle(mbox, out)
+                    self.delay = self.reconnect_delay
+                remaining = renew_at - time.monotonic()
+                if remaining <= 0:
+                    log.info('Reconnecting to refresh the OAuth token: %s', self.name)
+                    return
+                changed = mbox.wait_for_changes(
+                    min(mbox.idle_timeout, remaining), self.stop
+                )
+        finally:
+            with suppress(OSError, IMAP4.error):
+                mbox.logout()
+
+    def _cycle(self, mbox: Mbox, out: WatchQueue):
+        """
+        Run one sync and wait for the writer to store its checkpoint.
+        """
+        self.started = time.monotonic()
+        self.message_uids = []
+        self.progress = None
+        self.status = None
+        self.highest_modseq = None
+        self.error = None
+        self.finished.clear()
+        try:
+            for item in self._sync(mbox):
+                if self.stop.is_set():
+                    raise InterruptedError('Stopped before the sync completed')
+                out.put((self, item))
+        except Exception as err:
+            self.error = err
+        out.put((self, SyncDone()))
+        self.finished.wait()
+        if self.error:
+            raise self.error
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self.finished.set()
+
+
+def watch_mailboxes(
+    watches: list[MailboxWatch],
+    stop: threading.Event,
+    commit_size: int = DEFAULT_COMMIT_SIZE,
+    parse_workers: int = DEFAULT_PARSE_WORKERS,
+    codec: str = DEFAULT_CODEC,
+    store: AttachmentStore | None = None,
+    dedup: DedupCache | None = None,
+    stats_file: str | None = None,
+    commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+):
+    """
+    Sync mailboxes as they change until `stop` is set by SIGTERM or SIGINT,
+    writing from the calling thread only.
+    Stats are written to `stats_file` after every sync.
+    """
+    writer = MessageWriter(commit_size, store, dedup, commit_interval)
+    pipeline = ParsePipeline(parse_workers, codec, store)
+    out: WatchQueue = queue.Queue(WRITER_QUEUE_SIZE)
+
+    def request_stop(signum, _frame):
+        log.info('Stopping on %s', signal.Signals(signum).name)
+        stop.set()
+
+    handlers = {
+        signum: signal.signal(signum, request_stop)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    for watch in watches:
+        watch.start(out)
+
+    try:
+        pending = len(watches)
+        while pending:
+            try:
+                job, item = out.get(timeout=writer_timeout(writer, pipeline))
+                stats.gauge('writer', out.qsize())
+                pipeline.put(job, item)
+            except queue.Empty:
+                pass
+            for job, item in pipeline.ready():
+                if isinstance(item, WatchStopped):
+                    pending -= 1
+                elif isinstance(item, SyncDone):
+                    writer.flush()
+                    job.finish()
+                    if stats_file:
+                        stats.write_prometheus(stats_file)
+                else:
+                    job.write(item, writer)
+    finally:
+        stop.set()
+        pipeline.close()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    log.info('Mailbox watch stopped: %s', ', '.join(watch.name for watch in watches))
+
+
+def mailbox_watches(settings: ConfigReader, stop: threading.Event) -> list[MailboxWatch]:
+    """
+    One watch per configured mailbox of every configured account.
+    """
+    watches: list[MailboxWatch] = []
+    for account in settings.accounts():
+        for label in account.mailbox_names():
+            mailbox_row, _ = Mailbox.get_or_create(name=account.mailbox_row_name(label))
+            watches.append(MailboxWatch(account, label, mailbox_row, stop))
+    return watches
@@ -0,0 +1,203 @@
+import struct
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Iterable
+from pathlib import Path
+
+from mailboxdb.config import ConfigReader
+from mailboxdb.logger import get_logger
+from mailboxdb.model import AttachmentMeta, RawMsg, db
+
+log = get_logger('Dedup')
+
+# Attachment checksum to `AttachmentMeta` id mappings kept in memory.
+ATTACHMENT_ID_CACHE_SIZE = 10_000
+CACHE_SUFFIX = '.dedup'
+# Magic, last RawMsg id, last AttachmentMeta id, message and attachment counts.
+CACHE_HEADER = struct.Struct('<8sQQQQ')
+CACHE_MAGIC = b'MBXDDUP1'
+
+
+def digest_key(checksum: str) -> int:
+    """
+    The first 64 bits of a hex SHA-256 digest.
+    """
+    return int(checksum[:16], 16)
+
+
+class DigestSet:
+    """
+    Exact set of 64-bit digest prefixes: a sorted array loaded at startup,
+    plus the prefixes added since. A miss means the digest is not stored;
+    a hit can be a prefix collision and needs confirming with a query.
+    """
+
+    def __init__(self, keys: Iterable[int] = ()):
+        self.keys = array('Q', sorted(keys))
+        self.added: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.added)
+
+    def __contains__(self, checksum: str) -> bool:
+        key = digest_key(checksum)
+        if key in self.added:
+            return True
+        index = bisect_left(self.keys, key)
+        return index < len(self.keys) and self.keys[index] == key
+
+    def add(self, checksums: Iterable[str]):
+        self.added.update(digest_key(checksum) for checksum in checksums)
+
+    def compacted(self) -> array:
+        if self.added:
+            self.keys = array('Q', sorted({*self.keys, *self.added}))
+            self.added = set()
+        return self.keys
+
+
+class DedupCache:
+    """
+    In-memory index of stored message and attachment checksums, so the writer
+    only queries for checksums that may already be stored.
+
+    It is saved next to the database and brought up to date on load
+    with the rows added since, keyed by row id. Negative answers are only
+    exact while this process is the only writer and the file belongs to this
+    database; `MessageWriter` notices the messages it wrongly took for new.
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.messages = DigestSet()
+        self.attachments = DigestSet()
+        self.attachment_ids: OrderedDict[str, int] = OrderedDict()
+        self.last_rawmsg_id = 0
+        self.last_attachment_id = 0
+
+    @classmethod
+    def open(cls, path: Path | None = None) -> 'DedupCache':
+        cache = cls(path)
+        if path and path.is_file():
+            cache._read()
+        cache._catch_up()
+        return cache
+
+    def _read(self):
+        with self.path.open('rb') as fp:
+            header = fp.read(CACHE_HEADER.size)
+            if len(header) < CACHE_HEADER.size:
+                log.warning('Dedup cache is truncated, rebuilding: %s', self.path)
+                return
+            magic, last_rawmsg, last_attachment, n_messages, n_attachments = (
+                CACHE_HEADER.unpack(header)
+            )
+            if magic != CACHE_MAGIC:
+                log.warning('Dedup cache format unknown, rebuilding: %s', self.path)
+                return
+            messages, attachments = array('Q'), array('Q')
+            try:
+                messages.fromfile(fp, n_messages)
+                attachments.fromfile(fp, n_attachments)
+            except EOFError:
+                log.warning('Dedup cache is truncated, rebuilding: %s', self.path)
+                return
+        self.messages.keys, self.attachments.keys = messages, attachments
+        self.last_rawmsg_id, self.last_attachment_id = last_rawmsg, last_attachment
+
+    def _catch_up(self):
+        if db.is_closed():
+            db.connect()
+        max_rawmsg = RawMsg.select(RawMsg.id).order_by(RawMsg.id.desc()).scalar() or 0
+        max_attachment = (
+            AttachmentMeta.select(AttachmentMeta.id)
+            .order_by(AttachmentMeta.id.desc())
+            .scalar()
+            or 0
+        )
+        if self.last_rawmsg_id > max_rawmsg or self.last_attachment_id > max_attachment:
+            log.warning('Dedup cache is ahead of the database, rebuilding.')
+            self.__init__(self.path)
+
+        query = RawMsg.select(RawMsg.original_checksum).where(
+            RawMsg.id > self.last_rawmsg_id
+        )
+        self.messages.add(checksum for (checksum,) in query.tuples())
+        query = AttachmentMeta.select(AttachmentMeta.file_checksum).where(
+            AttachmentMeta.id > self.last_attachment_id
+        )
+        self.attachments.add(checksum for (checksum,) in query.tuples())
+        self.last_rawmsg_id, self.last_attachment_id = max_rawmsg, max_attachment
+        log.info(
+            'Dedup cache loaded: messages=%s attachments=%s',
+            len(self.messages),
+            len(self.attachments),
+        )
+
+    def save(self):
+        if not self.path:
+            return
+        messages = self.messages.compacted()
+        attachments = self.attachments.compacted()
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('wb') as fp:
+            fp.write(
+                CACHE_HEADER.pack(
+                    CACHE_MAGIC,
+                    self.last_rawmsg_id,
+                    self.last_attachment_id,
+                    len(messages),
+                    len(attachments),
+                )
+            )
+            messages.tofile(fp)
+            attachments.tofile(fp)
+        tmp.replace(self.path)
+
+    def maybe_messages(self, checksums: Iterable[str]) -> set[str]:
+        """
+        The message checksums that may already be stored.
+        """
+        return {checksum for checksum in checksums if checksum in self.messages}
+
+    def maybe_attachments(self, checksums: Iterable[str]) -> set[str]:
+        """
+        The attachment checksums that may already be stored.
+        """
+        return {checksum for checksum in checksums if checksum in self.attachments}
+
+    def add_messages(self, rawmsg_ids: dict[str, int]):
+        self.messages.add(rawmsg_ids)
+
+    def add_attachments(self, attachment_ids: dict[str, int]):
+        self.attachments.add(attachment_ids)
+        for checksum, attachment_id in attachment_ids.items():
+            self.attachment_ids[checksum] = attachment_id
+            self.attachment_ids.move_to_end(checksum)
+        while len(self.attachment_ids) > ATTACHMENT_ID_CACHE_SIZE:
+            self.attachment_ids.popitem(last=False)
+
+    def attachment_id(self, checksum: str) -> int | None:
+        attachment_id = self.attachment_ids.get(checksum)
+        if attachment_id is not None:
+            self.attachment_ids.move_to_end(checksum)
+        return attachment_id
+
+
+def dedup_cache_path() -> Path | None:
+    """
+    Where the dedup cache of the configured database is saved.
+    """
+    if not db.database or db.database == ':memory:':
+        return None
+    return Path(db.database + CACHE_SUFFIX)
+
+
+def open_dedup(settings: ConfigReader | None = None) -> DedupCache | None:
+    """
+    The dedup cache of the configured database, unless `dedup_cache` is off.
+    """
+    if settings and not settings.get_bool('dedup_cache', True):
+        return None
+    return DedupCache.open(dedup_cache_path())
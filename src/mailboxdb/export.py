@@ -0,0 +1,143 @@
+from collections.abc import Iterator
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+from mailboxdb.attachments import AttachmentStore
+from mailboxdb.codec import decompress
+from mailboxdb.instrument import stats
+from mailboxdb.logger import get_logger
+from mailboxdb.mailfiles import MboxWriter
+from mailboxdb.model import Mailbox, MsgLabel, MsgMeta, RawMsg
+from mailboxdb.stream import DEFAULT_STREAM_CHUNK_SIZE, MimeJoiner
+
+log = get_logger('Export')
+
+EXPORT_FORMATS = ('eml', 'mbox')
+# Messages read per query; only one stripped body at a time is decompressed.
+EXPORT_BATCH = 200
+
+
+class ExportMessage(NamedTuple):
+    msgmeta_id: int
+    date: datetime | None
+    fetch_time: datetime | str
+    from_: str | None
+    email_body: bytes
+    codec: str | None
+
+
+def export_rows(
+    mailbox: str | None = None,
+    after: datetime | None = None,
+    before: datetime | None = None,
+    sender: str | None = None,
+    batch_size: int = EXPORT_BATCH,
+) -> Iterator[ExportMessage]:
+    """
+    Stored messages matching the filters in id order, `batch_size` rows per
+    query resuming after the last id, so no read stays open between batches.
+    """
+    where = []
+    if mailbox:
+        where.append(
+            MsgMeta.id.in_(
+                MsgLabel.select(MsgLabel.msgmeta)
+                .join(Mailbox)
+                .where(Mailbox.name == mailbox)
+            )
+        )
+    if after:
+        where.append(MsgMeta.date >= after)
+    if before:
+        where.append(MsgMeta.date < before)
+    if sender:
+        where.append(MsgMeta.from_.contains(sender))
+
+    last_id = 0
+    while True:
+        rows = (
+            MsgMeta.select(
+                MsgMeta.id,
+                MsgMeta.date,
+                MsgMeta.fetch_time,
+                MsgMeta.from_,
+                RawMsg.email_body,
+                RawMsg.codec,
+            )
+            .join(RawMsg)
+            .where(MsgMeta.id > last_id, *where)
+            .order_by(MsgMeta.id)
+            .limit(batch_size)
+            .tuples()
+        )
+        count = 0
+        for row in rows.iterator():
+            count += 1
+            last_id = row[0]
+            yield ExportMessage(*row)
+        if count < batch_size:
+            return
+
+
+def _mbox_date(message: ExportMessage) -> datetime | None:
+    # fetch_time is stored with its UTC offset, which DateTimeField leaves a string.
+    if message.date or not isinstance(message.fetch_time, str):
+        return message.date or message.fetch_time
+    try:
+        return datetime.fromisoformat(message.fetch_time)
+    except ValueError:
+        return None
+
+
+def _eol(email_body: bytes) -> bytes:
+    end = email_body.find(b'\n')
+    return b'\r\n' if end > 0 and email_body[end - 1 : end] == b'\r' else b'\n'
+
+
+def export_messages(
+    path: Path | str,
+    export_format: str = 'eml',
+    store: AttachmentStore | None = None,
+    mailbox: str | None = None,
+    after: datetime | None = None,
+    before: datetime | None = None,
+    sender: str | None = None,
+    chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+) -> int:
+    """
+    Write the matching messages with their attachments put back, one .eml file
+    each into the folder `path`, or all into the mbox file `path`.
+
+    Attachments are copied from `store` in `chunk_size` pieces, so memory use
+    does not grow with the size of the export.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise RuntimeError(f'Export format must be one of {EXPORT_FORMATS}')
+    store = store or AttachmentStore()
+    path = Path(path)
+    rows = export_rows(mailbox, after, before, sender)
+
+    count = 0
+    if export_format == 'mbox':
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('wb') as fp:
+            writer = MboxWriter(fp)
+            for message in rows:
+                body = decompress(message.email_body, message.codec)
+                writer.start(message.from_, _mbox_date(message))
+                MimeJoiner(body, writer, store, chunk_size).join()
+                writer.finish(_eol(body))
+                count += 1
+                stats.count('exported_messages')
+    else:
+        path.mkdir(parents=True, exist_ok=True)
+        for message in rows:
+            body = decompress(message.email_body, message.codec)
+            with (path / f'{message.msgmeta_id:08d}.eml').open('wb') as fp:
+                MimeJoiner(body, fp, store, chunk_size).join()
+            count += 1
+            stats.count('exported_messages')
+
+    log.info('Exported messages: %s to %s', count, path)
+    return count
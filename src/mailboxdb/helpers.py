@@ -3,14 +3,37 @@ import hashlib
 from datetime import datetime, timezone
 from email.message import Message
 
+from mailboxdb.instrument import stats
+from mailboxdb.schema import MboxResults, RawMessage
+
 
 def email_from_bytes(raw_email: bytes) -> Message:
-    return email.message_from_bytes(raw_email)
+    with stats.timed('parse'):
+        return email.message_from_bytes(raw_email)
 
 
 def utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
 
+def naive_utc(value: datetime) -> datetime:
+    """
+    Convert an aware datetime to naive UTC, so stored dates sort as text.
+    """
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 def sha256sum(raw_email: bytes) -> str:
     return hashlib.sha256(raw_email).hexdigest()
+
+
+def results_from_raw(raw: RawMessage) -> MboxResults:
+    raw_email = raw.raw_email
+    return MboxResults(
+        email_from_bytes(raw_email),
+        raw.checksum or sha256sum(raw_email),
+        raw.uid,
+        raw.size if raw.size is not None else len(raw_email),
+    )
@@ -1,16 +1,238 @@
-from imaplib import IMAP4_SSL
+import re
+import select
+import ssl
+import threading
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from email.parser import BytesHeaderParser
+from imaplib import IMAP4, IMAP4_SSL
+from itertools import chain
 
+from mailboxdb.attachments import open_store
 from mailboxdb.config import ConfigReader
-from mailboxdb.helpers import email_from_bytes, sha256sum
+from mailboxdb.helpers import results_from_raw
 from mailboxdb.imap_xoauth import authenticate_xoauth2, use_xoauth2
+from mailboxdb.instrument import stats
 from mailboxdb.logger import get_logger
 from mailboxdb.schema import (
     NO_CHARSET,
     OK_STATUS,
+    UID,
     ListUIDs,
-    MboxResults,
+    MailboxChanges,
+    MailboxStatus,
+    MboxHeaders,
     MboxResultsGenerator,
+    RawMessage,
+    RawMessageGenerator,
 )
+from mailboxdb.selective import (
+    PartPlan,
+    PartPolicy,
+    assemble_parts,
+    fetch_responses,
+    finish_parts,
+    parse_bodystructure,
+    part_fetch_items,
+    parts_checksum,
+)
+from mailboxdb.stream import (
+    DEFAULT_STREAM_CHUNK_SIZE,
+    DEFAULT_STREAM_THRESHOLD,
+    split_message,
+)
+
+# Default number of UIDs requested by a single FETCH command.
+DEFAULT_FETCH_BATCH_SIZE = 100
+# Default upper bound for the RFC822 bytes requested by a single FETCH command.
+DEFAULT_FETCH_BATCH_BYTES = 50 * 1024 * 1024
+# Number of UIDs per RFC822.SIZE or header probe.
+SIZE_PROBE_CHUNK = 5000
+# Seconds in IDLE before it is renewed, below the 29 minutes of RFC 2177.
+DEFAULT_IDLE_TIMEOUT = 10 * 60
+# Seconds between NOOPs on servers without IDLE.
+DEFAULT_POLL_INTERVAL = 60
+# Seconds between checks of the stop flag while waiting for changes.
+IDLE_POLL = 1.0
+
+THROTTLED = b'[THROTTLED]'
+
+FETCH_UID_RE = re.compile(rb'\bUID (\d+)')
+FETCH_SIZE_RE = re.compile(rb'\bRFC822\.SIZE (\d+)')
+FETCH_FLAGS_RE = re.compile(rb'\bFLAGS \(([^)]*)\)')
+# Untagged responses that mean the selected mailbox changed.
+CHANGE_RE = re.compile(rb'\* (\d+ (EXISTS|EXPUNGE|FETCH)|VANISHED)\b', re.IGNORECASE)
+CHANGE_RESPONSES = ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED')
+
+
+def uid_sequence_set(message_uids: Iterable[UID]) -> str:
+    """
+    Compact UIDs into an IMAP sequence set, e.g. `12,15,20:30`.
+    """
+    uids = sorted({int(m_uid) for m_uid in message_uids})
+    ranges: list[str] = []
+    start = prev = None
+    for uid in uids:
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            ranges.append(f'{start}:{prev}' if start != prev else str(start))
+        start = prev = uid
+    if start is not None:
+        ranges.append(f'{start}:{prev}' if start != prev else str(start))
+    return ','.join(ranges)
+
+
+def parse_sequence_set(sequence_set: bytes | str) -> list[tuple[int, int]]:
+    """
+    Expand an IMAP sequence set of UIDs, e.g. `12,15,20:30`, into ranges.
+    """
+    if isinstance(sequence_set, bytes):
+        sequence_set = sequence_set.decode()
+    ranges: list[tuple[int, int]] = []
+    for part in sequence_set.split(','):
+        start, _, end = part.strip().partition(':')
+        if not start.isdigit() or (end and not end.isdigit()):
+            continue
+        first, last = int(start), int(end or start)
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+def plan_batches(
+    message_uids: ListUIDs,
+    sizes: dict[UID, int],
+    batch_size: int,
+    batch_bytes: int,
+    stream_threshold: int,
+) -> Iterator[ListUIDs]:
+    """
+    Group UIDs into batches of at most `batch_size` UIDs and `batch_bytes` bytes.
+    A message larger than the byte budget, or one to be streamed,
+    is fetched on its own.
+    """
+    batch: ListUIDs = []
+    total = 0
+    for m_uid in message_uids:
+        size = sizes.get(m_uid, 0)
+        if size > stream_threshold:
+            if batch:
+                yield batch
+                batch, total = [], 0
+            yield [m_uid]
+            continue
+        if batch and (len(batch) >= batch_size or total + size > batch_bytes):
+            yield batch
+            batch, total = [], 0
+        batch.append(m_uid)
+        total += size
+    if batch:
+        yield batch
+
+
+def _fetch_items(fetch_data: list) -> Iterator[tuple[bytes, bytes]]:
+    """
+    Pair each literal of a FETCH response with its non-literal items.
+
+    imaplib returns each literal as a `(header, literal)` tuple followed by the
+    trailer of the response, which is where some servers put the UID item.
+    """
+    pending: tuple[bytes, bytes] | None = None
+    for item in fetch_data:
+        if isinstance(item, tuple) or pending is None:
+            if pending:
+                yield pending
+            pending = item if isinstance(item, tuple) else None
+            continue
+        header, literal = pending
+        pending = None
+        yield header + b' ' + (item or b''), literal
+    if pending:
+        yield pending
+
+
+def parse_fetch_literals(fetch_data: list) -> Iterator[tuple[UID, bytes]]:
+    """
+    Split a multi-message FETCH response into `(uid, literal)` pairs.
+    """
+    for items, literal in _fetch_items(fetch_data):
+        if match := FETCH_UID_RE.search(items):
+            yield match.group(1), literal
+
+
+def parse_fetch_headers(fetch_data: list) -> Iterator[MboxHeaders]:
+    """
+    Parse a FETCH response for `RFC822.SIZE` and the Message-ID header.
+    """
+    for items, literal in _fetch_items(fetch_data):
+        uid_match = FETCH_UID_RE.search(items)
+        size_match = FETCH_SIZE_RE.search(items)
+        if not uid_match or not size_match:
+            continue
+        message_id = BytesHeaderParser().parsebytes(literal).get('Message-Id')
+        yield MboxHeaders(
+            uid_match.group(1),
+            int(size_match.group(1)),
+            message_id.strip() if message_id else None,
+        )
+
+
+def parse_fetch_flags(fetch_data: list) -> dict[UID, str]:
+    """
+    Parse a FETCH response for `UID FLAGS` into the flags of each UID.
+    """
+    flags: dict[UID, str] = {}
+    for item in fetch_data:
+        if not isinstance(item, bytes):
+            continue
+        uid_match = FETCH_UID_RE.search(item)
+        flags_match = FETCH_FLAGS_RE.search(item)
+        if uid_match and flags_match:
+            flags[uid_match.group(1)] = ' '.join(flags_match.group(1).decode().split())
+    return flags
+
+
+class IdleShim:
+    """
+    The imaplib internals a hand-made IDLE needs, until IMAP4.idle() in
+    Python 3.14: a registered command tag, and the reply buffered by
+    `IMAP4.file` that select on the socket cannot see.
+    """
+
+    def __init__(self, mbox: IMAP4):
+        self.mbox = mbox
+
+    def new_tag(self) -> bytes:
+        return self.mbox._new_tag()
+
+    def forget_tag(self, tag: bytes):
+        """
+        Drop the reply slot imaplib keeps for `tag`, once it is read by hand.
+        """
+        self.mbox.tagged_commands.pop(tag, None)
+
+    def readable(self) -> bool:
+        """
+        Whether a response can be read without waiting: already in the buffer
+        of `IMAP4.file` or of the TLS layer, or on the socket.
+        """
+        sock = self.mbox.sock
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(self.mbox.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+
+class MboxThrottled(RuntimeError):
+    """
+    The server refused a command with a `[THROTTLED]` response code.
+    """
 
 
 class Mbox:
@@ -23,6 +245,23 @@ class Mbox:
         Connect to IMAP4 server.
         """
         self.log = get_logger(self.__class__.__name__)
+        self.batch_size = settings.get_int('fetch_batch_size', DEFAULT_FETCH_BATCH_SIZE)
+        self.batch_bytes = settings.get_int(
+            'fetch_batch_bytes', DEFAULT_FETCH_BATCH_BYTES
+        )
+        self.stream_threshold = settings.get_int(
+            'stream_threshold', DEFAULT_STREAM_THRESHOLD
+        )
+        self.stream_chunk_size = settings.get_int(
+            'stream_chunk_size', DEFAULT_STREAM_CHUNK_SIZE
+        )
+        self.idle_timeout = settings.get_int('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+        self.poll_interval = settings.get_int('poll_interval', DEFAULT_POLL_INTERVAL)
+        self.store = open_store(settings)
+        self.part_policy = PartPolicy.from_settings(settings)
+        self.condstore = False
+        self.qresync = False
+        self.selected: str | None = None
         self.mbox = IMAP4_SSL(settings.server)
         if use_xoauth2(settings):
             authenticate_xoauth2(self.mbox, settings)
@@ -30,6 +269,77 @@ class Mbox:
             self.mbox.login(settings.username, settings.password)
         self.log.info('Successfully logged in.')
 
+    def enable_changes(self):
+        """
+        Enable QRESYNC, which implies CONDSTORE, when the server supports it.
+        Must be called before selecting a mailbox.
+        """
+        cap_status, cap_data = self.mbox.capability()
+        if cap_status == OK_STATUS and cap_data and cap_data[-1]:
+            # Servers often advertise more capabilities once logged in.
+            self.mbox.capabilities = tuple(cap_data[-1].decode().upper().split())
+        capabilities = self.mbox.capabilities
+        self.condstore = 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities
+        if 'QRESYNC' in capabilities and 'ENABLE' in capabilities:
+            enable_status, _ = self.mbox.enable('QRESYNC')
+            self.qresync = enable_status == OK_STATUS
+        self.log.info(
+            'Server changes: CONDSTORE=%s QRESYNC=%s', self.condstore, self.qresync
+        )
+
+    def _response_int(self, code: str) -> int | None:
+        _, data = self.mbox.response(code)
+        value = data[-1] if data else None
+        return int(value) if value and value.isdigit() else None
+
+    def select_mailbox(self, label: str = 'INBOX') -> MailboxStatus:
+        self.mbox.select(label, readonly=True)
+        # self.mbox.select('"[Gmail]/All mail"', readonly=True)
+        self.selected = label
+        return MailboxStatus(
+            self._response_int('UIDVALIDITY'), self._response_int('HIGHESTMODSEQ')
+        )
+
+    def fetch_changes(self, since_modseq: int | None) -> MailboxChanges:
+        """
+        Get the flags of messages changed since `since_modseq`, or of every message,
+        with the UIDs expunged since then when QRESYNC is enabled, in one UID FETCH.
+        """
+        items = '(UID FLAGS)'
+        if since_modseq:
+            vanished = ' VANISHED' if self.qresync else ''
+            items += f' (CHANGEDSINCE {since_modseq}{vanished})'
+        msg_status, msg_data = self.uid_fetch('1:*', items)
+        if msg_status != OK_STATUS:
+            raise RuntimeError(f'Changes FETCH failed: {msg_status}')
+        _, vanished_data = self.mbox.response('VANISHED')
+        expunged = [
+            uid_range
+            for data in vanished_data
+            if data
+            for uid_range in parse_sequence_set(data.split()[-1])
+        ]
+        changes = MailboxChanges(parse_fetch_flags(msg_data), expunged)
+        self.log.info(
+            'Changed since modseq %s: flags=%s vanished_ranges=%s',
+            since_modseq,
+            len(changes.flags),
+            len(expunged),
+        )
+        return changes
+
+    def uid_fetch(self, message_set: str, items: str) -> tuple[str, list]:
+        """
+        Run UID FETCH, raising `MboxThrottled` when the server throttles us.
+        """
+        with stats.timed('imap_fetch'):
+            msg_status, msg_data = self.mbox.uid('fetch', message_set, items)
+        if msg_status != OK_STATUS and any(
+            THROTTLED in item for item in msg_data if isinstance(item, bytes)
+        ):
+            raise MboxThrottled(f'Server throttled UID FETCH {message_set}')
+        return msg_status, msg_data
+
     def get_message_uids(
         self, latest_uid: str | None, label: str = 'INBOX'
     ) -> ListUIDs | None:
@@ -37,8 +347,8 @@ class Mbox:
         Get all message UIDs to be fetched from server.
         Resume from the `latest UID` if there is one found.
         """
-        self.mbox.select(label, readonly=True)
-        # self.mbox.select('"[Gmail]/All mail"', readonly=True)
+        if self.selected != label:
+            self.select_mailbox(label)
 
         if latest_uid:
             box_status, box_data = self.mbox.uid(
@@ -63,23 +373,332 @@ class Mbox:
 
         return message_uids
 
-    def fetch_all_messages(self, message_uids: ListUIDs) -> MboxResultsGenerator:
+    def fetch_all_messages(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> MboxResultsGenerator:
         """
         Fetch each eligible message in RFC822 format.
         Returns a generator.
         """
+        for raw in self.fetch_raw_messages(message_uids, sizes):
+            yield results_from_raw(raw)
+
+    def fetch_raw_messages(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> RawMessageGenerator:
+        """
+        Fetch each eligible message in RFC822 format, without parsing it.
+        Returns a generator.
+        """
+        if self.batch_size > 1 or self.part_policy:
+            yield from self.fetch_batched_messages(message_uids, sizes)
+            return
+
+        if sizes is None:
+            sizes = self.get_message_sizes(message_uids)
         for m_uid in message_uids:
-            msg_status, msg_data = self.mbox.uid('fetch', m_uid.decode(), '(RFC822)')
+            if self.is_streamed([m_uid], sizes):
+                yield self.stream_message(m_uid)
+                continue
+            msg_status, msg_data = self.uid_fetch(m_uid.decode(), '(RFC822)')
 
             if msg_status != OK_STATUS:
                 self.log.warning('Message UID is not OK: %s', m_uid)
                 continue  # skip
 
-            raw_email: bytes = msg_data[0][1]
-            checksum = sha256sum(raw_email)
-            email_msg = email_from_bytes(raw_email)
+            yield RawMessage(msg_data[0][1], m_uid)
+
+    def prefetch_headers(self, message_uids: ListUIDs) -> list[MboxHeaders]:
+        """
+        Fetch the size and Message-ID of each message,
+        without downloading message bodies.
+        """
+        headers: list[MboxHeaders] = []
+        for start in range(0, len(message_uids), SIZE_PROBE_CHUNK):
+            chunk = message_uids[start : start + SIZE_PROBE_CHUNK]
+            msg_status, msg_data = self.uid_fetch(
+                uid_sequence_set(chunk),
+                '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])',
+            )
+            if msg_status != OK_STATUS:
+                self.log.warning('Header prefetch failed: %s', msg_status)
+                continue
+            headers.extend(parse_fetch_headers(msg_data))
+        self.log.info('Prefetched headers: %s', len(headers))
+        return headers
+
+    def get_message_sizes(self, message_uids: ListUIDs) -> dict[UID, int]:
+        """
+        Get the RFC822.SIZE of each message, probing in large chunks.
+        """
+        sizes: dict[UID, int] = {}
+        for start in range(0, len(message_uids), SIZE_PROBE_CHUNK):
+            chunk = message_uids[start : start + SIZE_PROBE_CHUNK]
+            msg_status, msg_data = self.uid_fetch(
+                uid_sequence_set(chunk), '(UID RFC822.SIZE)'
+            )
+            if msg_status != OK_STATUS:
+                self.log.warning('Size probe failed: %s', msg_status)
+                continue
+            for item in msg_data:
+                if not isinstance(item, bytes):
+                    continue
+                uid_match = FETCH_UID_RE.search(item)
+                size_match = FETCH_SIZE_RE.search(item)
+                if uid_match and size_match:
+                    sizes[uid_match.group(1)] = int(size_match.group(1))
+        return sizes
+
+    def plan_batches(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> Iterator[ListUIDs]:
+        """
+        Group UIDs into batches bounded by `batch_size` and `batch_bytes`.
+        """
+        if sizes is None:
+            sizes = self.get_message_sizes(message_uids)
+        return plan_batches(
+            message_uids, sizes, self.batch_size, self.batch_bytes, self.stream_threshold
+        )
+
+    def fetch_batched_messages(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> RawMessageGenerator:
+        """
+        Fetch messages with one UID FETCH per batch of UIDs.
+        Messages are yielded one at a time.
+        """
+        if sizes is None:
+            sizes = self.get_message_sizes(message_uids)
+        for batch in self.plan_batches(message_uids, sizes):
+            yield from self.fetch_batch(batch, sizes)
+
+    def is_streamed(self, batch: ListUIDs, sizes: dict[UID, int] | None) -> bool:
+        return (
+            len(batch) == 1
+            and sizes is not None
+            and sizes.get(batch[0], 0) > self.stream_threshold
+        )
+
+    def stream_literal(self, m_uid: UID, section: str = '') -> Iterator[bytes]:
+        """
+        Fetch one message, or one body `section` of it,
+        in `stream_chunk_size` pieces with partial FETCH.
+        """
+        offset = 0
+        while True:
+            msg_status, msg_data = self.uid_fetch(
+                m_uid.decode(),
+                f'(BODY.PEEK[{section}]<{offset}.{self.stream_chunk_size}>)',
+            )
+            if msg_status != OK_STATUS:
+                raise RuntimeError(
+                    f'Partial FETCH failed for UID {m_uid!r}: {msg_status}'
+                )
+            chunk = next((literal for _, literal in _fetch_items(msg_data)), b'')
+            del msg_data
+            if chunk:
+                yield chunk
+            offset += len(chunk)
+            if len(chunk) < self.stream_chunk_size:
+                return
+
+    def stream_message(self, m_uid: UID) -> RawMessage:
+        """
+        Stream a large message, extracting attachments as they arrive.
+        Returns the message with attachments removed.
+        """
+        self.log.info('Streaming large message: UID=%s', m_uid)
+        return split_message(self.stream_literal(m_uid), m_uid, self.store)
+
+    def plan_parts(self, batch: ListUIDs) -> dict[UID, PartPlan]:
+        """
+        Probe BODYSTRUCTURE to find the messages with attachments
+        that `part_policy` leaves on the server.
+        """
+        msg_status, msg_data = self.uid_fetch(
+            uid_sequence_set(batch), '(UID RFC822.SIZE BODYSTRUCTURE)'
+        )
+        if msg_status != OK_STATUS:
+            self.log.warning('BODYSTRUCTURE probe failed: %s', msg_status)
+            return {}
+        plans: dict[UID, PartPlan] = {}
+        for fields in fetch_responses(msg_data):
+            if not isinstance(fields.get('BODYSTRUCTURE'), list):
+                continue
+            structure = parse_bodystructure(fields['BODYSTRUCTURE'])
+            if actions := self.part_policy.plan(structure):
+                plans[fields['UID']] = PartPlan(
+                    int(fields['RFC822.SIZE']), structure, actions
+                )
+        return plans
+
+    def fetch_parts(self, m_uid: UID, plan: PartPlan) -> RawMessage | None:
+        """
+        Fetch a message part by part, leaving out the attachments in `plan`.
+        Returns None when the parts cannot be put back together exactly.
+        """
+        msg_status, msg_data = self.uid_fetch(m_uid.decode(), part_fetch_items(plan))
+        fields = next(fetch_responses(msg_data), {}) if msg_status == OK_STATUS else {}
+        assembly = assemble_parts(plan, fields)
+        if assembly is None:
+            return None
+        msg_status, msg_data = self.uid_fetch(
+            m_uid.decode(),
+            f'(BODY.PEEK[TEXT]<{assembly.tail_offset}.{assembly.tail_length}>)',
+        )
+        fields = next(fetch_responses(msg_data), {}) if msg_status == OK_STATUS else {}
+        raw_email = finish_parts(
+            assembly, fields.get(f'BODY[TEXT]<{assembly.tail_offset}>')
+        )
+        if raw_email is None:
+            return None
+        for part in plan.structure.parts:
+            if action := plan.actions.get(part.section):
+                stats.count(f'{action}_part_bytes', part.size)
+        self.log.info(
+            'Fetched by parts: UID=%s, left on server=%s',
+            m_uid,
+            len(plan.actions),
+        )
+        return RawMessage(raw_email, m_uid, parts_checksum(raw_email), plan.size)
+
+    def fetch_part(self, m_uid: UID, section: str) -> RawMessage | None:
+        """
+        Stream one body part with its MIME header, extracting it to the store
+        as an attachment. Returns None when the message is gone.
+        """
+        msg_status, msg_data = self.uid_fetch(
+            m_uid.decode(), f'(BODY.PEEK[{section}.MIME])'
+        )
+        mime = next(fetch_responses(msg_data), {}) if msg_status == OK_STATUS else {}
+        header = mime.get(f'BODY[{section}.MIME]')
+        if not header:
+            return None
+        chunks = chain([header], self.stream_literal(m_uid, section))
+        return split_message(chunks, m_uid, self.store)
+
+    def fetch_batch(
+        self, batch: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> RawMessageGenerator:
+        """
+        Fetch a single batch of UIDs, leaving attachments on the server
+        as `part_policy` says.
+        """
+        plans = self.plan_parts(batch) if self.part_policy else {}
+        if not plans:
+            yield from self.fetch_whole(batch, sizes)
+            return
+
+        whole = {
+            raw.uid: raw
+            for raw in self.fetch_whole([m for m in batch if m not in plans], sizes)
+        }
+        for m_uid in batch:
+            if m_uid in plans:
+                raw = self.fetch_parts(m_uid, plans[m_uid])
+                if raw is None:
+                    stats.count('selective_fallbacks')
+                    self.log.warning(
+                        'Fetching whole message, parts did not match: %s', m_uid
+                    )
+                    raw = next(self.fetch_whole([m_uid], sizes), None)
+                if raw is not None:
+                    yield raw
+            elif m_uid in whole:
+                yield whole.pop(m_uid)
+
+    def fetch_whole(
+        self, batch: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> RawMessageGenerator:
+        """
+        Fetch a single batch of UIDs with one UID FETCH,
+        or stream it if it is a single large message.
+        """
+        if not batch:
+            return
+        if self.is_streamed(batch, sizes):
+            yield self.stream_message(batch[0])
+            return
+
+        msg_status, msg_data = self.uid_fetch(uid_sequence_set(batch), '(UID RFC822)')
+
+        if msg_status != OK_STATUS:
+            self.log.warning('Batch FETCH is not OK: %s', uid_sequence_set(batch))
+            return  # skip
+
+        literals = deque(parse_fetch_literals(msg_data))
+        del msg_data
+        missing = set(batch).difference(m_uid for m_uid, _ in literals)
+        if missing:
+            self.log.warning('Messages missing from batch: %s', uid_sequence_set(missing))
+
+        while literals:
+            m_uid, raw_email = literals.popleft()
+            yield RawMessage(raw_email, m_uid)
+
+    def wait_for_changes(self, timeout: float, stop: threading.Event) -> bool:
+        """
+        Wait until the selected mailbox changes, `timeout` passes or `stop` is set,
+        with IDLE or else NOOP polling. Returns whether the mailbox changed.
+        """
+        if 'IDLE' in self.mbox.capabilities:
+            return self.idle(timeout, stop)
+        return self.poll(min(timeout, self.poll_interval), stop)
+
+    def idle(self, timeout: float, stop: threading.Event) -> bool:
+        """
+        Run one IDLE command, ending it on the first change.
+        """
+        # imaplib has no IDLE before Python 3.14, so the exchange is done by hand.
+        shim = IdleShim(self.mbox)
+        tag = shim.new_tag()
+        self.mbox.send(tag + b' IDLE\r\n')
+        line = self.mbox.readline()
+        if not line.startswith(b'+'):
+            shim.forget_tag(tag)
+            raise RuntimeError(f'IDLE refused: {line!r}')
+
+        changed = False
+        deadline = time.monotonic() + timeout
+        while not changed and not stop.is_set() and time.monotonic() < deadline:
+            if (
+                not shim.readable()
+                and not select.select([self.mbox.sock], [], [], IDLE_POLL)[0]
+            ):
+                continue
+            changed = self._idle_line(self.mbox.readline())
 
-            yield MboxResults(email_msg, checksum, m_uid)
+        self.mbox.send(b'DONE\r\n')
+        while not (line := self.mbox.readline()).startswith(tag):
+            changed = self._idle_line(line) or changed
+        shim.forget_tag(tag)
+        if not line.startswith(tag + b' OK'):
+            raise RuntimeError(f'IDLE failed: {line!r}')
+        return changed
+
+    @staticmethod
+    def _idle_line(line: bytes) -> bool:
+        if not line:
+            raise IMAP4.abort('Connection closed while idling')
+        if line.startswith(b'* BYE'):
+            raise IMAP4.abort(f'Server closed the connection: {line!r}')
+        return CHANGE_RE.match(line) is not None
+
+    def poll(self, interval: float, stop: threading.Event) -> bool:
+        """
+        Wait `interval` seconds, then ask the server for changes with NOOP.
+        """
+        if stop.wait(interval):
+            return False
+        for name in CHANGE_RESPONSES:
+            self.mbox.untagged_responses.pop(name, None)
+        noop_status, _ = self.mbox.noop()
+        if noop_status != OK_STATUS:
+            raise RuntimeError(f'NOOP failed: {noop_status}')
+        return any(
+            self.mbox.untagged_responses.pop(name, None) for name in CHANGE_RESPONSES
+        )
 
     def logout(self):
         self.mbox.logout()
@@ -2,14 +2,14 @@ import ast
 import subprocess
 from imaplib import IMAP4
 
-from mailboxdb.config import ConfigReader
+from mailboxdb.config import TRUTHY, ConfigReader
 
 
 def use_xoauth2(settings: ConfigReader) -> bool:
     raw = getattr(settings, 'use_xoauth2', False)
     if isinstance(raw, bool):
         return raw
-    return str(raw).strip().lower() in {'1', 'true', 'yes', 'y', 'on'}
+    return str(raw).strip().lower() in TRUTHY
 
 
 def password_command(settings: ConfigReader) -> tuple[str, ...]:
@@ -0,0 +1,137 @@
+from collections.abc import Iterator
+from pathlib import Path
+
+from mailboxdb.attachments import AttachmentStore
+from mailboxdb.codec import DEFAULT_CODEC
+from mailboxdb.dedup import DedupCache
+from mailboxdb.helpers import utcnow
+from mailboxdb.instrument import stats
+from mailboxdb.logger import get_logger
+from mailboxdb.mailfiles import (
+    FileMessage,
+    eml_messages,
+    find_maildirs,
+    maildir_messages,
+    mbox_messages,
+)
+from mailboxdb.model import Mailbox, db
+from mailboxdb.process import (
+    DEFAULT_COMMIT_INTERVAL,
+    DEFAULT_COMMIT_SIZE,
+    DEFAULT_PARSE_WORKERS,
+    MessageWriter,
+    ParsePipeline,
+)
+from mailboxdb.schema import UID, ListUIDs, ParsedMessage
+from mailboxdb.stream import DEFAULT_STREAM_THRESHOLD
+
+log = get_logger('Ingest')
+
+
+def file_mailboxes(
+    path: Path,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    store: AttachmentStore | None = None,
+) -> Iterator[tuple[Mailbox, Iterator[FileMessage]]]:
+    """
+    The messages to ingest from an mbox file, a Maildir tree with one mailbox
+    per folder, or a folder of .eml files, resuming from each stored checkpoint.
+    """
+    if path.is_file():
+        mailbox_row, _ = Mailbox.get_or_create(name=f'FILE:{path}')
+        yield (
+            mailbox_row,
+            mbox_messages(path, mailbox_row.last_uid, stream_threshold, store),
+        )
+    elif maildirs := find_maildirs(path):
+        for folder in maildirs:
+            mailbox_row, _ = Mailbox.get_or_create(name=f'FILE:{folder}')
+            yield (
+                mailbox_row,
+                maildir_messages(folder, mailbox_row.last_uid, stream_threshold, store),
+            )
+    else:
+        mailbox_row, _ = Mailbox.get_or_create(name=f'FILE:{path}')
+        yield (
+            mailbox_row,
+            eml_messages(path, mailbox_row.last_uid, stream_threshold, store),
+        )
+
+
+def save_file_checkpoint(mailbox_row: Mailbox, checkpoint: str):
+    mailbox_row.last_uid = checkpoint
+    mailbox_row.last_sync_at = utcnow()
+    with stats.timed('checkpoint'):
+        mailbox_row.save()
+
+
+def ingest_file_messages(
+    mailbox_row: Mailbox,
+    messages: Iterator[FileMessage],
+    writer: MessageWriter,
+    pipeline: ParsePipeline,
+) -> int:
+    """
+    Store `messages`, saving the checkpoint in the transaction of every group.
+    """
+    log.info(
+        'File ingest start: source=%s resume=%s', mailbox_row.name, mailbox_row.last_uid
+    )
+    checkpoints: dict[UID, str] = {}
+
+    def checkpoint(message_uids: ListUIDs):
+        # Messages are committed in file order: the last one covers the group.
+        for m_uid in message_uids[:-1]:
+            del checkpoints[m_uid]
+        save_file_checkpoint(mailbox_row, checkpoints.pop(message_uids[-1]))
+
+    def write(parsed_items: Iterator[tuple[Mailbox, ParsedMessage]]):
+        for _, parsed in parsed_items:
+            writer.add(parsed, mailbox_row, checkpoint)
+
+    count = 0
+    for message in messages:
+        checkpoints[message.raw.uid] = message.checkpoint
+        pipeline.put(mailbox_row, message.raw)
+        count += 1
+        write(pipeline.ready())
+    write(pipeline.drain())
+    writer.flush()
+
+    if not count:
+        log.warning('No new messages found in %s', mailbox_row.name)
+        return 0
+    log.info(
+        'File ingest complete: source=%s messages=%s last_uid=%s synced_at=%s',
+        mailbox_row.name,
+        count,
+        mailbox_row.last_uid,
+        mailbox_row.last_sync_at,
+    )
+    return count
+
+
+def run_file(
+    email_path: str,
+    commit_size: int = DEFAULT_COMMIT_SIZE,
+    parse_workers: int = DEFAULT_PARSE_WORKERS,
+    codec: str = DEFAULT_CODEC,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    store: AttachmentStore | None = None,
+    dedup: DedupCache | None = None,
+    commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+):
+    db.connect(reuse_if_open=True)
+    path = Path(email_path)
+    if not path.exists():
+        raise RuntimeError(f'Email folder or mbox file not found: {path}')
+
+    writer = MessageWriter(commit_size, store, dedup, commit_interval)
+    pipeline = ParsePipeline(parse_workers, codec, store)
+    try:
+        for mailbox_row, messages in file_mailboxes(path, stream_threshold, store):
+            ingest_file_messages(mailbox_row, messages, writer, pipeline)
+    finally:
+        pipeline.close()
+        if dedup:
+            dedup.save()
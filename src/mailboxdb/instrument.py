@@ -0,0 +1,216 @@
+import math
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import NamedTuple
+
+from mailboxdb.logger import get_logger
+
+log = get_logger('Instrument')
+
+# Upper bounds in seconds of the stage timing histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, math.inf)
+PROMETHEUS_PREFIX = 'mailboxdb'
+TRACEMALLOC_TOP = 15
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[next(i for i, bound in enumerate(BUCKETS) if value <= bound)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'Histogram'):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the `q` quantile.
+        """
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+
+class Gauge:
+    def __init__(self):
+        self.last = 0
+        self.max = 0
+
+    def set(self, value: int):
+        self.last = value
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'Gauge'):
+        self.last = other.last
+        self.max = max(self.max, other.max)
+
+
+class StatsSnapshot(NamedTuple):
+    counters: dict[str, int]
+    histograms: dict[str, Histogram]
+    gauges: dict[str, Gauge]
+
+
+class Stats:
+    """
+    Stage timings, counters and queue depths of one process.
+
+    Parse workers hand theirs back with `take`, to be merged by the writer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: dict[str, int] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.gauges: dict[str, Gauge] = {}
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: int):
+        with self.lock:
+            self.gauges.setdefault(name, Gauge()).set(value)
+
+    def take(self) -> StatsSnapshot:
+        """
+        Return everything recorded so far and start over.
+        """
+        with self.lock:
+            snapshot = StatsSnapshot(self.counters, self.histograms, self.gauges)
+            self.counters, self.histograms, self.gauges = {}, {}, {}
+        return snapshot
+
+    def merge(self, snapshot: StatsSnapshot):
+        with self.lock:
+            for name, value in snapshot.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, histogram in snapshot.histograms.items():
+                self.histograms.setdefault(name, Histogram()).merge(histogram)
+            for name, gauge in snapshot.gauges.items():
+                self.gauges.setdefault(name, Gauge()).merge(gauge)
+
+    def summary(self) -> str:
+        with self.lock:
+            lines = [
+                f'{"stage":<16} {"count":>8} {"total s":>9} {"mean ms":>9} '
+                f'{"p95 ms":>9} {"max ms":>9}'
+            ]
+            for stage, h in sorted(self.histograms.items()):
+                lines.append(
+                    f'{stage:<16} {h.count:>8} {h.total:>9.2f} '
+                    f'{1000 * h.total / h.count:>9.2f} {1000 * h.quantile(0.95):>9.1f} '
+                    f'{1000 * h.max:>9.1f}'
+                )
+            lines.extend(
+                f'{name:<26} {value:>12}' for name, value in sorted(self.counters.items())
+            )
+            lines.extend(
+                f'{name + " queue depth":<26} {g.last:>12} (max {g.max})'
+                for name, g in sorted(self.gauges.items())
+            )
+        return '\n'.join(lines)
+
+    def prometheus(self) -> str:
+        """
+        Everything recorded, in the Prometheus text exposition format.
+        """
+        prefix = PROMETHEUS_PREFIX
+        with self.lock:
+            lines = [f'# TYPE {prefix}_stage_seconds histogram']
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    lines.append(
+                        f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} '
+                        f'{cumulative}'
+                    )
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {h.total!r}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                lines.append(f'{prefix}_{name}_total {value}')
+            for suffix in ('', '_max'):
+                lines.append(f'# TYPE {prefix}_queue_depth{suffix} gauge')
+                lines.extend(
+                    f'{prefix}_queue_depth{suffix}{{queue="{name}"}} '
+                    f'{g.max if suffix else g.last}'
+                    for name, g in sorted(self.gauges.items())
+                )
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: Path | str):
+        """
+        Replace `path` atomically, as textfile collectors expect.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+stats = Stats()
+
+
+@contextmanager
+def profiled(profile_file: str | None = None, trace_memory: bool = False):
+    """
+    Profile the calling thread with cProfile into `profile_file`,
+    and log the top allocation sites when `trace_memory` is set.
+    """
+    # Imported only when used: tracemalloc alone costs more than this module.
+    profiler = None
+    if trace_memory:
+        import tracemalloc
+
+        tracemalloc.start()
+    if profile_file:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            log.info('Profile written to %s, read it with python -m pstats', profile_file)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            log.info('Peak traced memory: %.1f MiB', peak / 2**20)
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                log.info('Allocated: %s', stat)
@@ -0,0 +1,245 @@
+import mmap
+import re
+import time
+from collections.abc import Iterator
+from datetime import datetime
+from email.utils import parseaddr
+from pathlib import Path
+from typing import BinaryIO, NamedTuple
+
+from mailboxdb.attachments import AttachmentStore
+from mailboxdb.logger import get_logger
+from mailboxdb.schema import RawMessage
+from mailboxdb.stream import (
+    DEFAULT_STREAM_CHUNK_SIZE,
+    DEFAULT_STREAM_THRESHOLD,
+    LINE_LIMIT,
+    file_chunks,
+    split_message,
+)
+
+log = get_logger('MailFiles')
+
+MBOX_SEPARATOR = b'From '
+MBOX_DEFAULT_SENDER = 'MAILER-DAEMON'
+MBOX_DEFAULT_DATE = datetime(1970, 1, 1)
+FROM_LINE_RE = re.compile(rb'^(>*From )', re.MULTILINE)
+FROM_QUOTED_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+MAILDIR_FOLDERS = ('cur', 'new')
+
+
+class FileMessage(NamedTuple):
+    raw: RawMessage
+    # Stored as `Mailbox.last_uid` once the message is written, to resume after it.
+    checkpoint: str
+
+
+def _read(
+    path: Path, uid: bytes, stream_threshold: int, store: AttachmentStore | None
+) -> RawMessage:
+    if path.stat().st_size > stream_threshold:
+        return split_message(file_chunks(path), uid, store)
+    return RawMessage(path.read_bytes(), uid)
+
+
+def eml_messages(
+    folder: Path,
+    resume: str | None = None,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    store: AttachmentStore | None = None,
+) -> Iterator[FileMessage]:
+    """
+    Read the .eml files of a folder in name order, skipping the names up to `resume`.
+    """
+    for path in sorted(folder.glob('*.eml')):
+        if resume and path.name <= resume:
+            continue
+        yield FileMessage(
+            _read(path, path.name.encode(), stream_threshold, store), path.name
+        )
+
+
+def find_maildirs(root: Path) -> list[Path]:
+    """
+    Maildir folders below `root`, including Maildir++ subfolders.
+    """
+    return sorted(
+        {
+            path.parent
+            for name in MAILDIR_FOLDERS
+            for path in [root / name, *root.rglob(name)]
+            if path.is_dir()
+        }
+    )
+
+
+def _maildir_key(path: Path) -> str:
+    # Flags after ':' change when a message is read; the unique name does not.
+    return path.name.split(':', 1)[0]
+
+
+def maildir_messages(
+    folder: Path,
+    resume: str | None = None,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    store: AttachmentStore | None = None,
+) -> Iterator[FileMessage]:
+    """
+    Read the messages of one Maildir folder ordered by their unique name,
+    skipping the names up to `resume`.
+    """
+    paths = [
+        path
+        for name in MAILDIR_FOLDERS
+        if (folder / name).is_dir()
+        for path in (folder / name).iterdir()
+        if path.is_file() and not path.name.startswith('.')
+    ]
+    for path in sorted(paths, key=_maildir_key):
+        key = _maildir_key(path)
+        if resume and key <= resume:
+            continue
+        yield FileMessage(_read(path, key.encode(), stream_threshold, store), key)
+
+
+def _message_end(mm: mmap.mmap, end: int) -> int:
+    """
+    Drop the blank line that separates a message from the next `From ` line.
+    """
+    if mm[max(0, end - 4) : end] == b'\r\n\r\n':
+        return end - 2
+    if mm[max(0, end - 2) : end] == b'\n\n':
+        return end - 1
+    return end
+
+
+def unquote_from(data: bytes) -> bytes:
+    """
+    Undo mboxrd quoting: drop one `>` from lines that start with `>`s and `From `.
+    """
+    return FROM_QUOTED_RE.sub(rb'\1', data)
+
+
+def _mmap_chunks(mm: mmap.mmap, start: int, end: int) -> Iterator[bytes]:
+    """
+    Unquoted pieces of a message, cut after a line end where there is one.
+    """
+    line_start = True
+    while start < end:
+        stop = min(start + DEFAULT_STREAM_CHUNK_SIZE, end)
+        if stop < end and (newline := mm.rfind(b'\n', start, stop)) != -1:
+            stop = newline + 1
+        chunk = mm[start:stop]
+        # A piece of an overlong line is not the start of a `>From ` line.
+        head = 0 if line_start else chunk.find(b'\n') + 1 or len(chunk)
+        yield chunk[:head] + unquote_from(chunk[head:])
+        line_start = chunk.endswith(b'\n')
+        start = stop
+
+
+def mbox_messages(
+    path: Path,
+    resume: str | None = None,
+    stream_threshold: int = DEFAULT_STREAM_THRESHOLD,
+    store: AttachmentStore | None = None,
+) -> Iterator[FileMessage]:
+    """
+    Split an mbox file on `From ` lines over an mmap, starting at byte offset `resume`.
+
+    Each message gets its start offset as UID and the offset of the next one
+    as checkpoint. Only the message being read is copied into memory, with its
+    mboxrd `>From ` quoting undone.
+    """
+    if path.stat().st_size == 0:
+        return
+    with path.open('rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        start = int(resume) if resume else 0
+        if start > len(mm) or (
+            start < len(mm) and mm[start : start + len(MBOX_SEPARATOR)] != MBOX_SEPARATOR
+        ):
+            log.warning('No message at offset %s of %s, starting over', start, path)
+            start = 0
+        if start == 0 and mm[: len(MBOX_SEPARATOR)] != MBOX_SEPARATOR:
+            raise RuntimeError(f'Not an mbox file, no "From " line at its start: {path}')
+        while start < len(mm):
+            body = mm.find(b'\n', start) + 1 or len(mm)
+            separator = mm.find(b'\n' + MBOX_SEPARATOR, body - 1)
+            end = len(mm) if separator == -1 else separator + 1
+            stop = max(body, _message_end(mm, end))
+            uid = str(start).encode()
+            if stop - body > stream_threshold:
+                raw = split_message(_mmap_chunks(mm, body, stop), uid, store)
+            else:
+                raw = RawMessage(unquote_from(mm[body:stop]), uid)
+            yield FileMessage(raw, str(end))
+            start = end
+
+
+class MboxWriter:
+    """
+    Append messages to an mbox file, mboxrd style: lines of a message that
+    start with `From `, after any number of `>`, get one more `>`.
+    """
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        # Start of the current line while it may still turn out to be a `From ` line,
+        # None once the line is written.
+        self.pending: bytes | None = None
+        # Last bytes written, to end the message with its own line end.
+        self.last = b'\n'
+
+    def start(self, sender: str | None = None, date: datetime | None = None):
+        """
+        Begin a message with its `From sender date` separator line.
+        """
+        address = parseaddr(sender or '')[1].split()
+        sender = address[0] if address else MBOX_DEFAULT_SENDER
+        stamp = time.asctime((date or MBOX_DEFAULT_DATE).timetuple())
+        self.fp.write(f'From {sender} {stamp}\n'.encode())
+        self.pending = b''
+        self.last = b'\n'
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        self.last = (self.last + data)[-2:]
+        if self.pending is None:
+            end = data.find(b'\n') + 1
+            if not end:
+                self.fp.write(data)
+                return
+            self.fp.write(data[:end])
+            data = data[end:]
+        else:
+            data = self.pending + data
+        cut = data.rfind(b'\n') + 1
+        self.fp.write(FROM_LINE_RE.sub(rb'>\1', data[:cut]))
+        tail = data[cut:]
+        quoted = tail.lstrip(b'>')
+        if len(quoted) < len(MBOX_SEPARATOR) and len(tail) < LINE_LIMIT:
+            if MBOX_SEPARATOR.startswith(quoted):
+                self.pending = tail  # too short to tell yet
+                return
+        elif quoted.startswith(MBOX_SEPARATOR):
+            self.fp.write(b'>')
+        self.fp.write(tail)
+        self.pending = None
+
+    def finish(self, eol: bytes = b'\n'):
+        """
+        End the current message and add the blank line before the next one.
+
+        The blank line repeats the line end of the message, which is what
+        `mbox_messages` drops. A message without a final line end gets `eol`
+        first: mbox has no way to keep it unterminated.
+        """
+        if self.pending:
+            self.fp.write(self.pending)
+        self.pending = None
+        if not self.last.endswith(b'\n'):
+            self.fp.write(eol)
+            self.last = eol
+        self.fp.write(b'\r\n' if self.last == b'\r\n' else b'\n')
@@ -1,12 +1,12 @@
 from __future__ import annotations
 
 import importlib.util
+import json
 from pathlib import Path
 from types import ModuleType
 from typing import NamedTuple
 
 import peewee as pw
-from playhouse.migrate import SqliteMigrator
 
 from mailboxdb.helpers import sha256sum, utcnow
 from mailboxdb.logger import get_logger
@@ -14,6 +14,9 @@ from mailboxdb.model import db
 
 log = get_logger('Migrations')
 
+# Saved next to the database: name, size, mtime and checksum of every migration file.
+MANIFEST_SUFFIX = '.migrations'
+
 
 class SchemaMigration(pw.Model):
     name = pw.CharField(unique=True)
@@ -25,6 +28,10 @@ class SchemaMigration(pw.Model):
         table_name = 'schema_migrations'
 
 
+def column_names(db: pw.Database, table: str) -> set[str]:
+    return {column.name for column in db.get_columns(table)}
+
+
 def _default_migrations_dir() -> Path:
     return Path(__file__).resolve().parents[1] / 'migrations'
 
@@ -62,6 +69,49 @@ def _list_migration_files(root: Path) -> list[MigrationFile]:
     return migrations
 
 
+def _manifest_path() -> Path | None:
+    if not db.database or db.database == ':memory:':
+        return None
+    return Path(db.database + MANIFEST_SUFFIX)
+
+
+def _file_stat(path: Path) -> list:
+    stat = path.stat()
+    return [path.name, stat.st_size, stat.st_mtime_ns]
+
+
+def _cached_checksums(root: Path) -> list[str] | None:
+    """
+    Checksums of the migration files from the manifest, or None when any file
+    was added, removed or touched since it was written.
+    """
+    path = _manifest_path()
+    try:
+        manifest = json.loads(path.read_text()) if path else None
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('root') != str(root.resolve()):
+        return None
+    files = manifest.get('files')
+    stats = [_file_stat(p) for p in sorted(root.iterdir()) if p.suffix == '.py']
+    if not isinstance(files, list) or [f[:3] for f in files] != stats:
+        return None
+    return [f[3] for f in files]
+
+
+def _save_manifest(root: Path, migrations: list[MigrationFile]):
+    path = _manifest_path()
+    if path is None:
+        return
+    files = [[*_file_stat(m.path), m.checksum] for m in migrations]
+    tmp = path.with_name(path.name + '.tmp')
+    try:
+        tmp.write_text(json.dumps({'root': str(root.resolve()), 'files': files}))
+        tmp.replace(path)
+    except OSError as err:
+        log.warning('Could not save the migration manifest %s: %s', path, err)
+
+
 def _load_migration(path: Path) -> ModuleType:
     spec = importlib.util.spec_from_file_location(path.stem, path)
     if spec is None or spec.loader is None:
@@ -83,16 +133,26 @@ def run_migrations(migrations_dir: Path | str | None = None) -> list[str]:
     if not root.is_dir():
         raise RuntimeError(f'Migrations directory not found: {root}')
 
-    migration_files = _list_migration_files(root)
-    applied_rows = list(SchemaMigration.select())
-    applied_checksums = {row.checksum for row in applied_rows if row.checksum}
+    applied_checksums = {
+        checksum
+        for (checksum,) in SchemaMigration.select(SchemaMigration.checksum).tuples()
+    }
+    # Unchanged files that are all applied: nothing to hash or load.
+    cached = _cached_checksums(root)
+    if cached is not None and applied_checksums.issuperset(cached):
+        log.info('No pending migrations.')
+        return []
 
+    migration_files = _list_migration_files(root)
     pending = [m for m in migration_files if m.checksum not in applied_checksums]
 
     if not pending:
+        _save_manifest(root, migration_files)
         log.info('No pending migrations.')
         return []
 
+    from playhouse.migrate import SqliteMigrator
+
     migrator = SqliteMigrator(db)
     applied_now: list[str] = []
 
@@ -104,6 +164,7 @@ def run_migrations(migrations_dir: Path | str | None = None) -> list[str]:
             SchemaMigration.create(name=migration.name, checksum=migration.checksum)
         applied_now.append(migration.name)
 
+    _save_manifest(root, migration_files)
     return applied_now
 
 
@@ -131,6 +192,8 @@ def rollback_migrations(
         log.info('No migrations to rollback.')
         return []
 
+    from playhouse.migrate import SqliteMigrator
+
     migrator = SqliteMigrator(db)
     rolled_back: list[str] = []
 
@@ -1,8 +1,33 @@
+from collections import defaultdict
+from collections.abc import Iterable
+
 import peewee as pw
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
 
+from mailboxdb.codec import compress, decompress, stored_codec
 from mailboxdb.helpers import utcnow
+from mailboxdb.logger import get_logger
+
+log = get_logger('Model')
+
+DEFAULT_DATABASE_PATH = 'database/messages.db'
+# Applied on every connection, in order; auto_vacuum only takes effect on new files.
+DEFAULT_PRAGMAS: dict[str, str | int] = {
+    'auto_vacuum': 'incremental',
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,  # KiB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,  # ms
+}
 
-db = pw.SqliteDatabase('database/messages.db')
+db = pw.SqliteDatabase(DEFAULT_DATABASE_PATH, pragmas=DEFAULT_PRAGMAS)
+
+# Bound values per statement, the lowest SQLite host parameter limit.
+SQLITE_MAX_VARIABLES = 999
+# Values per `IN (...)` lookup, below the host parameter limit.
+SQLITE_BATCH = 400
 
 
 class BaseModel(pw.Model):
@@ -22,6 +47,13 @@ class RawMsg(BaseModel):
         unique=True,
         help_text='Checksum of the original message from the server',
     )
+    codec = pw.CharField(null=True, help_text='Compression codec of email_body')
+
+    def read_body(self) -> bytes:
+        """
+        Email body with attachments removed, decompressed on access.
+        """
+        return decompress(self.email_body, self.codec)
 
 
 class AttachmentMeta(BaseModel):
@@ -29,6 +61,9 @@ class AttachmentMeta(BaseModel):
     file_checksum = pw.CharField(unique=True, help_text='Checksum of the file on disk')
     original_filename = pw.CharField(help_text='Original filename')
     content_type = pw.CharField(help_text='Original content type')
+    pack_segment = pw.IntegerField(null=True, help_text='Pack segment holding the file')
+    pack_offset = pw.IntegerField(null=True)
+    pack_length = pw.IntegerField(null=True)
 
 
 class Mailbox(BaseModel):
@@ -39,6 +74,8 @@ class Mailbox(BaseModel):
     name = pw.CharField(unique=True)
     last_uid = pw.CharField(null=True)
     last_sync_at = pw.DateTimeField(null=True)
+    uid_validity = pw.IntegerField(null=True, help_text='UIDVALIDITY of last_uid')
+    highest_modseq = pw.IntegerField(null=True, help_text='CONDSTORE checkpoint')
 
     @classmethod
     def get_latest_uid(cls, name: str) -> str | None:
@@ -46,27 +83,241 @@ class Mailbox(BaseModel):
         return mailbox.last_uid if mailbox else None
 
 
+DeferredMsgLabel = pw.DeferredThroughModel()
+
+
 class MsgMeta(BaseModel):
     """
     Metadata for messages.
     """
 
     rawmsg = pw.ForeignKeyField(RawMsg, backref='msgmeta')
-    labels = pw.ManyToManyField(Mailbox, backref='messages')
+    labels = pw.ManyToManyField(
+        Mailbox, backref='messages', through_model=DeferredMsgLabel
+    )
     fetch_time = pw.DateTimeField(default=utcnow)
 
-    from_ = pw.CharField(null=True)
+    from_ = pw.CharField(null=True, index=True)
     to = pw.CharField(null=True)
     subject = pw.CharField(null=True)
-    date = pw.CharField(null=True)
+    date = pw.DateTimeField(null=True, index=True, help_text='Date header in UTC')
     num_attachments = pw.IntegerField(null=True)
-    message_id = pw.CharField(null=True)
-    in_reply_to = pw.CharField(null=True)
+    message_id = pw.CharField(null=True, index=True)
+    in_reply_to = pw.CharField(null=True, index=True)
+    size = pw.IntegerField(null=True, help_text='Size of the original message')
+    thread = pw.IntegerField(null=True, index=True)
 
     def link_label(self, mailbox: Mailbox):
         through = MsgMeta.labels.get_through_model()
         through.get_or_create(msgmeta=self, mailbox=mailbox)
 
+    @classmethod
+    def link_labels(cls, msgmeta_ids: dict[bytes, int], mailbox: Mailbox):
+        """
+        Link messages to `mailbox`, given the id of each message by its UID.
+        """
+        MsgLabel.link(
+            [
+                dict(msgmeta=msgmeta_id, mailbox=mailbox, uid=imap_uid(m_uid))
+                for m_uid, msgmeta_id in msgmeta_ids.items()
+            ]
+        )
+
+
+class MsgLabel(BaseModel):
+    """
+    Link of a message to a mailbox, with its UID and flags in that mailbox.
+    """
+
+    msgmeta = pw.ForeignKeyField(MsgMeta)
+    mailbox = pw.ForeignKeyField(Mailbox)
+    uid = pw.IntegerField(null=True)
+    flags = pw.CharField(null=True, help_text='IMAP flags, space separated')
+
+    class Meta:
+        # Same table and index names as the implicit through model it replaces.
+        table_name = 'msgmeta_mailbox_through'
+        name = 'msgmetamailboxthrough'
+        indexes = (
+            (('msgmeta', 'mailbox'), True),
+            (('mailbox', 'uid'), False),
+        )
+
+    @classmethod
+    def link(cls, rows: list[dict]):
+        """
+        Insert links, updating the UID of links that already exist.
+        """
+        if not rows:
+            return
+        chunk_size = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+        for chunk in pw.chunked(rows, chunk_size):
+            cls.insert_many(chunk).on_conflict(
+                conflict_target=[cls.msgmeta, cls.mailbox], preserve=[cls.uid]
+            ).execute()
+
+    @classmethod
+    def update_flags(cls, mailbox: Mailbox, flags: dict[bytes, str]):
+        by_flags: dict[str, list[int]] = defaultdict(list)
+        for m_uid, value in flags.items():
+            by_flags[value].append(int(m_uid))
+        for value, uids in by_flags.items():
+            for chunk in pw.chunked(uids, SQLITE_BATCH):
+                cls.update(flags=value).where(
+                    cls.mailbox == mailbox, cls.uid.in_(chunk)
+                ).execute()
+
+    @classmethod
+    def unlink_uids(cls, mailbox: Mailbox, ranges: list[tuple[int, int]]) -> int:
+        """
+        Remove the links of expunged UIDs. Messages are kept.
+        """
+        removed = 0
+        for start, end in ranges:
+            removed += (
+                cls.delete()
+                .where(cls.mailbox == mailbox, cls.uid.between(start, end))
+                .execute()
+            )
+        return removed
+
+
+DeferredMsgLabel.set_model(MsgLabel)
+
+
+class MsgThread(BaseModel):
+    """
+    Thread of every Message-ID seen, of a stored message or one it refers to.
+    """
+
+    message_id = pw.CharField(unique=True)
+    thread = pw.IntegerField(index=True)
+
+
+class DeferredAttachment(BaseModel):
+    """
+    Attachment left on the server by selective fetch, queued for a backfill.
+    """
+
+    rawmsg = pw.ForeignKeyField(RawMsg, backref='deferred_attachments')
+    mailbox = pw.ForeignKeyField(Mailbox)
+    uid = pw.IntegerField()
+    section = pw.CharField(help_text='IMAP body section of the attachment')
+    original_filename = pw.CharField()
+    content_type = pw.CharField()
+    size = pw.IntegerField(help_text='Encoded size from BODYSTRUCTURE')
+    queued_at = pw.DateTimeField(default=utcnow)
+
+    class Meta:
+        indexes = ((('rawmsg', 'section'), True),)
+
+
+class MsgSearch(FTS5Model):
+    """
+    Full-text index of messages, keyed by the `MsgMeta` id.
+    Contentless, so only the index is stored and results are read from `MsgMeta`.
+    """
+
+    rowid = RowIDField()
+    subject = SearchField()
+    from_ = SearchField()
+    to = SearchField()
+    body = SearchField()
+
+    class Meta:
+        database = db
+        options = {'content': ''}
+
+
+def imap_uid(m_uid: bytes) -> int | None:
+    """
+    Numeric IMAP UID, or None for messages read from files.
+    """
+    return int(m_uid) if m_uid.isdigit() else None
+
+
+def insert_rows(model: type[pw.Model], rows: list[dict]):
+    """
+    Bulk insert rows in chunks that fit the SQLite parameter limit,
+    ignoring rows that violate a unique constraint.
+    """
+    if not rows:
+        return
+    chunk_size = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+    for chunk in pw.chunked(rows, chunk_size):
+        model.insert_many(chunk).on_conflict_ignore().execute()
+
+
+def configure_db(path: str | None = None, pragmas: dict | None = None):
+    """
+    Point `db` at another file, overriding pragmas of the default profile.
+    """
+    if not db.is_closed():
+        db.close()
+    db.init(path or DEFAULT_DATABASE_PATH, pragmas={**DEFAULT_PRAGMAS, **(pragmas or {})})
+
+
+def optimize_db():
+    """
+    Refresh query planner statistics, truncate the WAL and release free pages.
+    """
+    if db.is_closed():
+        db.connect()
+    db.execute_sql('PRAGMA optimize')
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    (auto_vacuum,) = db.execute_sql('PRAGMA auto_vacuum').fetchone()
+    if auto_vacuum != 2:
+        log.info('auto_vacuum is not incremental; run VACUUM once to enable it.')
+    (free_pages,) = db.execute_sql('PRAGMA freelist_count').fetchone()
+    db.execute_sql('PRAGMA incremental_vacuum')
+    log.info('Database optimized, free pages released: %s', free_pages)
+
+
+def recompress_bodies(codec: str, batch_size: int = 500) -> int:
+    """
+    Rewrite message bodies with `codec`, one transaction per batch,
+    so the database stays usable while it runs.
+    """
+    target = stored_codec(codec)
+    if db.is_closed():
+        db.connect()
+    last_id = 0
+    rewritten = 0
+    while True:
+        rows = list(
+            RawMsg.select(RawMsg.id, RawMsg.email_body, RawMsg.codec)
+            .where(RawMsg.id > last_id)
+            .order_by(RawMsg.id)
+            .limit(batch_size)
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        with db.atomic():
+            for rawmsg in rows:
+                if rawmsg.codec == target:
+                    continue
+                body = compress(rawmsg.read_body(), target)
+                RawMsg.update(email_body=body, codec=target).where(
+                    RawMsg.id == rawmsg.id
+                ).execute()
+                rewritten += 1
+        log.info('Recompressed messages: %s, up to id=%s', rewritten, last_id)
+    return rewritten
+
+
+def ids_by(field: pw.Field, values: Iterable) -> dict:
+    """
+    Map each stored value of `field` found in `values` to its row id.
+    """
+    model = field.model
+    found = {}
+    for chunk in pw.chunked(list(values), SQLITE_BATCH):
+        query = model.select(model.id, field).where(field.in_(chunk))
+        for row_id, value in query.tuples():
+            found[value] = row_id
+    return found
+
 
 def schema_tables() -> list[type[pw.Model]]:
     return [
@@ -75,5 +326,8 @@ def schema_tables() -> list[type[pw.Model]]:
         AttachmentMeta,
         Mailbox,
         AttachmentMeta.rawmsg.get_through_model(),
-        MsgMeta.labels.get_through_model(),
+        MsgLabel,
+        MsgSearch,
+        MsgThread,
+        DeferredAttachment,
     ]
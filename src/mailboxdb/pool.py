@@ -0,0 +1,168 @@
+import queue
+import random
+import threading
+from imaplib import IMAP4
+
+from mailboxdb.config import ConfigReader
+from mailboxdb.helpers import results_from_raw
+from mailboxdb.imap import Mbox, MboxThrottled
+from mailboxdb.logger import get_logger
+from mailboxdb.schema import (
+    UID,
+    ListUIDs,
+    MboxResultsGenerator,
+    RawMessage,
+    RawMessageGenerator,
+)
+
+DEFAULT_FETCH_CONNECTIONS = 1
+BACKOFF_INITIAL = 1.0
+BACKOFF_MAX = 60.0
+MAX_ATTEMPTS = 6
+
+BatchResult = list[RawMessage] | BaseException
+
+
+class FetchPool:
+    """
+    Fetch messages over several authenticated IMAP connections.
+
+    Batches of UIDs are fetched concurrently and yielded in UID order,
+    so a single writer can process them.
+    """
+
+    def __init__(self, settings: ConfigReader, label: str, connections: int):
+        self.log = get_logger(self.__class__.__name__)
+        self.settings = settings
+        self.label = label
+        self.connections = max(1, connections)
+        self._results: dict[int, BatchResult] = {}
+        self._ready = threading.Condition()
+        self._stop = threading.Event()
+        # Bounds the batches held in memory ahead of the writer.
+        self._window = threading.Semaphore(self.connections * 2)
+
+    def _connect(self) -> Mbox:
+        mbox = Mbox(self.settings)
+        mbox.select_mailbox(self.label)
+        return mbox
+
+    def _close(self, mbox: Mbox | None):
+        if mbox is None:
+            return
+        try:
+            mbox.logout()
+        except (IMAP4.error, OSError):
+            pass
+
+    def _fetch_batch(
+        self, mbox: Mbox | None, batch: ListUIDs, sizes: dict[UID, int]
+    ) -> tuple[Mbox, list[RawMessage]]:
+        """
+        Fetch one batch, reconnecting with exponential backoff
+        when the server throttles or drops the connection.
+        """
+        delay = BACKOFF_INITIAL
+        attempt = 1
+        while True:
+            try:
+                if mbox is None:
+                    mbox = self._connect()
+                return mbox, list(mbox.fetch_batch(batch, sizes))
+            except (MboxThrottled, IMAP4.abort, OSError) as err:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                self._close(mbox)
+                mbox = None
+                wait = delay + random.uniform(0, delay / 2)
+                self.log.warning('Fetch failed (%s), retrying in %.1fs', err, wait)
+                if self._stop.wait(wait):
+                    raise
+                delay = min(delay * 2, BACKOFF_MAX)
+                attempt += 1
+
+    def _acquire_slot(self) -> bool:
+        while not self._window.acquire(timeout=0.5):
+            if self._stop.is_set():
+                return False
+        return True
+
+    def _worker(
+        self,
+        work: 'queue.SimpleQueue[tuple[int, ListUIDs]]',
+        mbox: Mbox | None,
+        sizes: dict[UID, int],
+    ):
+        try:
+            while not self._stop.is_set() and self._acquire_slot():
+                try:
+                    index, batch = work.get_nowait()
+                except queue.Empty:
+                    self._window.release()
+                    return
+                result: BatchResult
+                try:
+                    mbox, result = self._fetch_batch(mbox, batch, sizes)
+                except Exception as err:
+                    result = err
+                    self._stop.set()
+                with self._ready:
+                    self._results[index] = result
+                    self._ready.notify_all()
+        finally:
+            self._close(mbox)
+
+    def fetch_all_messages(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> MboxResultsGenerator:
+        """
+        Fetch messages concurrently and yield them in UID order.
+        Returns a generator.
+        """
+        for raw in self.fetch_raw_messages(message_uids, sizes):
+            yield results_from_raw(raw)
+
+    def fetch_raw_messages(
+        self, message_uids: ListUIDs, sizes: dict[UID, int] | None = None
+    ) -> RawMessageGenerator:
+        """
+        Fetch messages concurrently and yield them unparsed, in UID order.
+        Returns a generator.
+        """
+        if not message_uids:
+            return
+
+        first = self._connect()
+        if sizes is None:
+            sizes = first.get_message_sizes(message_uids)
+        batches = list(first.plan_batches(message_uids, sizes))
+        work: queue.SimpleQueue[tuple[int, ListUIDs]] = queue.SimpleQueue()
+        for index, batch in enumerate(batches):
+            work.put((index, batch))
+
+        workers = min(self.connections, len(batches))
+        self.log.info('Fetching %s batches over %s connections', len(batches), workers)
+        threads = [
+            threading.Thread(
+                target=self._worker,
+                args=(work, first if n == 0 else None, sizes),
+                daemon=True,
+            )
+            for n in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for index in range(len(batches)):
+                with self._ready:
+                    self._ready.wait_for(lambda: index in self._results)
+                    result = self._results.pop(index)
+                self._window.release()
+                if isinstance(result, BaseException):
+                    raise result
+                yield from result
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
@@ -1,106 +1,520 @@
 import email
-from pathlib import Path
+import logging
+import multiprocessing
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, TypeAlias
 
-from mailboxdb.helpers import sha256sum
-from mailboxdb.logger import get_logger
-from mailboxdb.model import AttachmentMeta, Mailbox, MsgMeta, RawMsg, db
-from mailboxdb.schema import AttachmentProperties, MboxResults, Message
+from mailboxdb.attachments import AttachmentStore
+from mailboxdb.codec import DEFAULT_CODEC, compress, stored_codec
+from mailboxdb.dedup import DedupCache
+from mailboxdb.helpers import email_from_bytes, naive_utc, results_from_raw, sha256sum
+from mailboxdb.instrument import StatsSnapshot, stats
+from mailboxdb.logger import configure_root_logger, get_logger
+from mailboxdb.model import (
+    SQLITE_BATCH,
+    AttachmentMeta,
+    DeferredAttachment,
+    Mailbox,
+    MsgLabel,
+    MsgMeta,
+    MsgSearch,
+    RawMsg,
+    db,
+    ids_by,
+    imap_uid,
+    insert_rows,
+    pw,
+)
+from mailboxdb.schema import (
+    UID,
+    AttachmentProperties,
+    ListUIDs,
+    MboxHeaders,
+    MboxResults,
+    Message,
+    ParsedMessage,
+    RawMessage,
+)
+from mailboxdb.search import message_text, search_row
+from mailboxdb.selective import (
+    DEFERRED_HEADER,
+    SKIPPED_HEADER,
+    deferred_part,
+    part_placeholder,
+)
+from mailboxdb.threads import assign_threads, message_references
 
 log = get_logger('Process')
 
+# Messages stored per transaction by MessageWriter.
+DEFAULT_COMMIT_SIZE = 500
+# Seconds after which a group is committed even if it holds fewer messages.
+DEFAULT_COMMIT_INTERVAL = 30
+# Processes used to parse messages; 1 parses in the calling process.
+DEFAULT_PARSE_WORKERS = 1
+# Messages queued per parse worker before waiting on the oldest one.
+PARSE_WINDOW_PER_WORKER = 8
+
+# Called inside the transaction that stored the messages with these UIDs.
+Checkpoint: TypeAlias = Callable[[ListUIDs], None]
+
 
 def process_message(result: MboxResults, mailbox: Mailbox | None = None):
     """
-    Process an entire message object.
-
-    Split attachment files from rawmsg, create db entries for
-    each rawmsg, message meta and attachment.
+    Process an entire message object and store it right away.
+    Use `MessageWriter` to store messages in groups.
     """
-    email_msg, checksum, m_uid = result
+    writer = MessageWriter(commit_size=1)
+    writer.add(parse_message(result), mailbox)
+    writer.flush()
 
-    # Deduplicate RawMsg
-    rawmsg = RawMsg.get_or_none(RawMsg.original_checksum == checksum)
-    if rawmsg:
-        log.info('Message already seen: CSUM=%s, UID=%s', checksum, m_uid)
-        if mailbox:
-            msgmeta = MsgMeta.get_or_none(MsgMeta.rawmsg == rawmsg)
-            if msgmeta:
-                msgmeta.link_label(mailbox)
-            else:
-                log.warning(
-                    'MsgMeta missing for checksum=%s; mailbox link skipped', checksum
-                )
-        return
+
+def _header(email_msg: Message, name: str) -> str | None:
+    value = email_msg.get(name)
+    return str(value) if value is not None else None
+
+
+def parse_message(
+    result: MboxResults,
+    codec: str = DEFAULT_CODEC,
+    store: AttachmentStore | None = None,
+) -> ParsedMessage:
+    """
+    Split attachment files from the message into `store` and collect its metadata.
+    The stripped body is compressed with `codec`.
+    """
+    email_msg = result.message
+    store = store or AttachmentStore()
 
     # We need to parse attachments first.
     # They are extracted and removed from messages.
-    _attachments = [process_attachment(part) for part in email_msg.walk()]
+    _attachments = [process_attachment(part, store) for part in email_msg.walk()]
     attachments: list[AttachmentProperties] = list(filter(None, _attachments))
-    num_attachments = len(attachments)
+    deferred = tuple(filter(None, map(deferred_part, email_msg.walk())))
 
-    # Parse metadata
-    from_ = email_msg.get('From')
-    to = email_msg.get('To')
-    subject = email_msg.get('Subject')
     date = (
-        email.utils.parsedate_to_datetime(email_msg.get('Date'))
+        naive_utc(email.utils.parsedate_to_datetime(email_msg.get('Date')))
         if email_msg.get('Date')
         else None
     )
-    message_id = email_msg.get('Message-Id')
-    in_reply_to = email_msg.get('In-Reply-To')
-
-    with db.atomic():
-        rmsg = RawMsg.create(email_body=email_msg.as_bytes(), original_checksum=checksum)
-
-        if num_attachments:
-            for file_checksum, filename, content_type in attachments:
-                # Deduplicate AttachmentMeta
-                att, _ = AttachmentMeta.get_or_create(
-                    file_checksum=file_checksum,
-                    defaults=dict(
-                        original_filename=filename,
-                        content_type=content_type,
-                    ),
+
+    return ParsedMessage(
+        checksum=result.checksum,
+        uid=result.uid,
+        size=result.size,
+        email_body=compress(email_msg.as_bytes(), stored_codec(codec)),
+        from_=_header(email_msg, 'From'),
+        to=_header(email_msg, 'To'),
+        subject=_header(email_msg, 'Subject'),
+        date=date,
+        message_id=_header(email_msg, 'Message-Id'),
+        in_reply_to=_header(email_msg, 'In-Reply-To'),
+        attachments=attachments,
+        codec=stored_codec(codec),
+        body_text=message_text(email_msg),
+        references=message_references(email_msg),
+        deferred=deferred,
+    )
+
+
+def parse_raw_message(
+    raw: RawMessage, codec: str = DEFAULT_CODEC, store: AttachmentStore | None = None
+) -> ParsedMessage:
+    """
+    Parse raw message bytes into a plain record.
+    Runs in parse worker processes.
+    """
+    return parse_message(results_from_raw(raw), codec, store)
+
+
+def parse_worker_message(
+    raw: RawMessage, codec: str = DEFAULT_CODEC, store: AttachmentStore | None = None
+) -> tuple[ParsedMessage, StatsSnapshot]:
+    """
+    `parse_raw_message` in a worker process, handing back the stats it recorded.
+    """
+    return parse_raw_message(raw, codec, store), stats.take()
+
+
+def _parsed(future: Future) -> ParsedMessage:
+    parsed, recorded = future.result()
+    stats.merge(recorded)
+    return parsed
+
+
+class ParsePipeline:
+    """
+    Parse raw messages, in worker processes when `workers` > 1,
+    and hand them back in the order they were put.
+
+    Items that are not a `RawMessage` pass through unchanged, keeping their place,
+    so markers like the end of a mailbox stay behind its messages.
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_PARSE_WORKERS,
+        codec: str = DEFAULT_CODEC,
+        store: AttachmentStore | None = None,
+    ):
+        # Fetch threads are already running, so workers are spawned rather than forked.
+        self.executor = (
+            ProcessPoolExecutor(
+                workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=configure_root_logger,
+                initargs=(logging.getLogger().level,),
+            )
+            if workers > 1
+            else None
+        )
+        self.window = max(1, workers) * PARSE_WINDOW_PER_WORKER
+        self.codec = codec
+        self.store = store or AttachmentStore()
+        self.queue: deque[tuple[Any, Any]] = deque()
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.queue)
+
+    def put(self, key: Any, item: Any):
+        if isinstance(item, RawMessage):
+            if self.executor:
+                item = self.executor.submit(
+                    parse_worker_message, item, self.codec, self.store
                 )
-                rmsg.attachments.add(att)
-
-        msgmeta = MsgMeta.create(
-            rawmsg=rmsg,
-            from_=from_,
-            to=to,
-            subject=subject,
-            date=date,
-            num_attachments=num_attachments,
-            message_id=message_id,
-            in_reply_to=in_reply_to,
+            else:
+                item = parse_raw_message(item, self.codec, self.store)
+        self.queue.append((key, item))
+        stats.gauge('parse', len(self.queue))
+
+    def ready(self) -> Iterator[tuple[Any, Any]]:
+        """
+        Yield parsed items in order, waiting only when the window is full.
+        """
+        while self.queue:
+            key, item = self.queue[0]
+            if isinstance(item, Future):
+                if not item.done() and len(self.queue) <= self.window:
+                    return
+                item = _parsed(item)
+            self.queue.popleft()
+            yield key, item
+
+    def drain(self) -> Iterator[tuple[Any, Any]]:
+        """
+        Yield all remaining items in order, waiting for each one.
+        """
+        while self.queue:
+            key, item = self.queue.popleft()
+            yield key, _parsed(item) if isinstance(item, Future) else item
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+
+
+class MessageWriter:
+    """
+    Collect parsed messages and store them in groups.
+
+    Each group is written in one transaction with bulk inserts,
+    deduplicating messages by checksum and attachments by file checksum.
+    A group is committed once it holds `commit_size` messages or its first
+    message waited `commit_interval` seconds, together with the checkpoints
+    of its messages.
+    """
+
+    def __init__(
+        self,
+        commit_size: int = DEFAULT_COMMIT_SIZE,
+        store: AttachmentStore | None = None,
+        dedup: DedupCache | None = None,
+        commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+    ):
+        self.commit_size = max(1, commit_size)
+        self.commit_interval = commit_interval
+        self.store = store or AttachmentStore()
+        self.dedup = dedup
+        self.pending: list[tuple[ParsedMessage, Mailbox | None]] = []
+        self.checkpoints: dict[Checkpoint, ListUIDs] = {}
+        self.pending_since = 0.0
+
+    def add(
+        self,
+        parsed: ParsedMessage,
+        mailbox: Mailbox | None = None,
+        checkpoint: Checkpoint | None = None,
+    ):
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.append((parsed, mailbox))
+        if checkpoint:
+            self.checkpoints.setdefault(checkpoint, []).append(parsed.uid)
+        if len(self.pending) >= self.commit_size:
+            self.flush()
+        else:
+            self.flush_due()
+
+    def flush_due(self) -> float | None:
+        """
+        Commit the group if its first message waited `commit_interval` seconds.
+        Returns the seconds until the pending group is due, None if there is none.
+        """
+        if not self.pending:
+            return None
+        remaining = self.pending_since + self.commit_interval - time.monotonic()
+        if remaining > 0:
+            return remaining
+        self.flush()
+        return None
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        checkpoints, self.checkpoints = self.checkpoints, {}
+        with stats.timed('db_transaction'), db.atomic():
+            self._store(pending)
+            for checkpoint, uids in checkpoints.items():
+                checkpoint(uids)
+
+    def _store(self, pending: list[tuple[ParsedMessage, Mailbox | None]]):
+        # Deduplicate RawMsg, against the database and within the group
+        checksums = {p.checksum for p, _ in pending}
+        if self.dedup:
+            maybe_stored = self.dedup.maybe_messages(checksums)
+            stats.count('dedup_cache_skips', len(checksums) - len(maybe_stored))
+            checksums = maybe_stored
+        existing = ids_by(RawMsg.original_checksum, checksums)
+        new: dict[str, ParsedMessage] = {}
+        for parsed, _ in pending:
+            if parsed.checksum not in existing:
+                new.setdefault(parsed.checksum, parsed)
+
+        last_rawmsg_id = RawMsg.select(pw.fn.MAX(RawMsg.id)).scalar() or 0
+        insert_rows(
+            RawMsg,
+            [
+                dict(email_body=p.email_body, original_checksum=p.checksum, codec=p.codec)
+                for p in new.values()
+            ],
         )
-        if mailbox:
-            msgmeta.link_label(mailbox)
+        rawmsg_ids = ids_by(RawMsg.original_checksum, new)
+        # A stale dedup cache, or another writer, can miss stored messages: their
+        # insert was ignored, so they keep an older id and are not new after all.
+        for checksum, rawmsg_id in list(rawmsg_ids.items()):
+            if rawmsg_id <= last_rawmsg_id:
+                existing[checksum] = rawmsg_ids.pop(checksum)
+                del new[checksum]
+                stats.count('dedup_cache_stale')
+        stats.count('stored_messages', len(new))
+        stats.count('duplicate_messages', len(pending) - len(new))
+        if self.dedup:
+            self.dedup.add_messages(rawmsg_ids)
 
-    log.info(
-        'Processed message: m_uid=%s, from_=%s, to=%s, subject=%s',
-        m_uid,
-        from_,
-        to,
-        subject,
-    )
+        attachment_ids = self.store_attachments(
+            {a.file_checksum: a for p in new.values() for a in p.attachments}
+        )
+        insert_rows(
+            AttachmentMeta.rawmsg.get_through_model(),
+            [
+                dict(
+                    rawmsg=rawmsg_ids[p.checksum],
+                    attachmentmeta=attachment_ids[a.file_checksum],
+                )
+                for p in new.values()
+                for a in p.attachments
+            ],
+        )
 
+        threads = assign_threads([(p.message_id, p.references) for p in new.values()])
+        insert_rows(
+            MsgMeta,
+            [
+                dict(
+                    rawmsg=rawmsg_ids[p.checksum],
+                    from_=p.from_,
+                    to=p.to,
+                    subject=p.subject,
+                    date=p.date,
+                    num_attachments=len(p.attachments),
+                    message_id=p.message_id,
+                    in_reply_to=p.in_reply_to,
+                    size=p.size,
+                    thread=thread,
+                )
+                for p, thread in zip(new.values(), threads)
+            ],
+        )
+        msgmeta_ids = ids_by(MsgMeta.rawmsg, [*rawmsg_ids.values(), *existing.values()])
+        insert_rows(
+            MsgSearch,
+            [
+                search_row(
+                    msgmeta_ids[rawmsg_ids[p.checksum]],
+                    p.from_,
+                    p.to,
+                    p.subject,
+                    p.body_text,
+                )
+                for p in new.values()
+            ],
+        )
 
-def process_attachment(part: Message) -> AttachmentProperties | None:
+        labels = []
+        deferred = []
+        for parsed, mailbox in pending:
+            rawmsg_id = rawmsg_ids.get(parsed.checksum) or existing[parsed.checksum]
+            if new.get(parsed.checksum) is parsed:
+                log.info(
+                    'Processed message: m_uid=%s, from_=%s, to=%s, subject=%s',
+                    parsed.uid,
+                    parsed.from_,
+                    parsed.to,
+                    parsed.subject,
+                )
+            else:
+                log.info(
+                    'Message already seen: CSUM=%s, UID=%s', parsed.checksum, parsed.uid
+                )
+            if not mailbox:
+                continue
+            if new.get(parsed.checksum) is parsed:
+                deferred.extend(
+                    dict(
+                        rawmsg=rawmsg_id,
+                        mailbox=mailbox,
+                        uid=imap_uid(parsed.uid),
+                        section=part.section,
+                        original_filename=part.filename,
+                        content_type=part.content_type,
+                        size=part.size,
+                    )
+                    for part in parsed.deferred
+                )
+            msgmeta_id = msgmeta_ids.get(rawmsg_id)
+            if msgmeta_id:
+                labels.append(
+                    dict(msgmeta=msgmeta_id, mailbox=mailbox, uid=imap_uid(parsed.uid))
+                )
+            else:
+                log.warning(
+                    'MsgMeta missing for checksum=%s; mailbox link skipped',
+                    parsed.checksum,
+                )
+        MsgLabel.link(labels)
+        insert_rows(DeferredAttachment, deferred)
+
+    def store_attachments(
+        self, attachments: dict[str, AttachmentProperties]
+    ) -> dict[str, int]:
+        """
+        Store new attachments by file checksum, packing the contents of small ones.
+        Returns the AttachmentMeta id of every checksum.
+        """
+        known_attachments = self._known_attachments(attachments)
+        stats.count('duplicate_attachments', len(known_attachments))
+        attachment_rows = []
+        for a in attachments.values():
+            if a.file_checksum in known_attachments:
+                continue
+            location = None
+            if a.data is not None:
+                location = self.store.add(a.data)
+            attachment_rows.append(
+                dict(
+                    file_checksum=a.file_checksum,
+                    original_filename=a.filename,
+                    content_type=a.content_type,
+                    pack_segment=location.segment if location else None,
+                    pack_offset=location.offset if location else None,
+                    pack_length=location.length if location else None,
+                )
+            )
+        self.store.sync()
+        insert_rows(AttachmentMeta, attachment_rows)
+        attachment_ids = {
+            **known_attachments,
+            **ids_by(
+                AttachmentMeta.file_checksum,
+                [c for c in attachments if c not in known_attachments],
+            ),
+        }
+        if self.dedup:
+            self.dedup.add_attachments(attachment_ids)
+        return attachment_ids
+
+    def _known_attachments(self, checksums: Iterable[str]) -> dict[str, int]:
+        """
+        Ids of the attachments among `checksums` that are already stored.
+        """
+        if not self.dedup:
+            return ids_by(AttachmentMeta.file_checksum, checksums)
+        known: dict[str, int] = {}
+        lookup = []
+        for checksum in self.dedup.maybe_attachments(checksums):
+            attachment_id = self.dedup.attachment_id(checksum)
+            if attachment_id is None:
+                lookup.append(checksum)
+            else:
+                known[checksum] = attachment_id
+        known.update(ids_by(AttachmentMeta.file_checksum, lookup))
+        return known
+
+
+def find_known_messages(headers: list[MboxHeaders]) -> dict[UID, int]:
+    """
+    Find messages already stored under another label,
+    matching on Message-ID and original size.
+
+    Returns a mapping of UID to the id of the stored `MsgMeta`.
     """
-    Remove attachments from email messages and save them as files.
+    by_message_id = {h.message_id: h for h in headers if h.message_id}
+    known: dict[str, int] = {}
+    message_ids = list(by_message_id)
+    for start in range(0, len(message_ids), SQLITE_BATCH):
+        query = MsgMeta.select(MsgMeta.id, MsgMeta.message_id, MsgMeta.size).where(
+            MsgMeta.message_id.in_(message_ids[start : start + SQLITE_BATCH])
+        )
+        for msgmeta in query:
+            if msgmeta.size == by_message_id[msgmeta.message_id].size:
+                known[msgmeta.message_id] = msgmeta.id
+
+    return {h.uid: known[h.message_id] for h in headers if h.message_id in known}
+
+
+def process_attachment(
+    part: Message, store: AttachmentStore | None = None
+) -> AttachmentProperties | None:
+    """
+    Remove attachments from email messages and save them in `store`.
     The message will be altered.
     """
 
     filename = part.get_filename()
-    if not filename:
+    if not filename or part.get(SKIPPED_HEADER) or part.get(DEFERRED_HEADER):
+        # Parts left on the server by selective fetch have no body to extract.
         return None
 
     content_type = part.get_content_type()
-    payload = part.get_payload(decode=True)  # decode from base64
-    file_checksum = sha256sum(payload)
-    file_path = Path('attachments/', file_checksum)
+    if part.get('X-File-Checksum') and not part.get_payload():
+        # Already extracted while streaming the message
+        return AttachmentProperties(str(part['X-File-Checksum']), filename, content_type)
+
+    store = store or AttachmentStore()
+    with stats.timed('attachment'):
+        payload = part.get_payload(decode=True) or b''  # decode from base64
+        data = None
+        if store.packs(len(payload)):
+            file_checksum = sha256sum(payload)
+            data = payload
+        else:
+            file_checksum = store.put(payload)
+    stats.count('attachment_bytes', len(payload))
 
     log.debug(
         'Attachment found: file_checksum=%s, filename=%s, content_type=%s',
@@ -109,16 +523,58 @@ def process_attachment(part: Message) -> AttachmentProperties | None:
         content_type,
     )
 
-    if file_path.is_file():
-        log.info(
-            'Attachment file already exists with checksum=%s, Not storing',
-            file_checksum,
-        )
-    else:
-        log.info('Writing file: %s', file_checksum)
-        file_path.write_bytes(payload)
-
     part.set_param(file_checksum, None, header='X-File-Checksum')
     part.set_payload(None)
 
-    return AttachmentProperties(file_checksum, filename, content_type)
+    return AttachmentProperties(file_checksum, filename, content_type, data)
+
+
+def store_backfilled_part(
+    deferred: DeferredAttachment, part: RawMessage, writer: MessageWriter
+) -> bool:
+    """
+    Attach a part fetched after its message, leaving the stored body as if
+    the part had been fetched with it. Runs inside a transaction.
+    """
+    part_msg = email_from_bytes(part.raw_email)
+    attachment = process_attachment(part_msg, writer.store)
+    rawmsg = RawMsg.get_by_id(deferred.rawmsg_id)
+    body = rawmsg.read_body()
+    placeholder = part_placeholder(DEFERRED_HEADER, deferred.section, deferred.size)
+    if (
+        attachment is None
+        or (attachment.filename, attachment.content_type)
+        != (deferred.original_filename, deferred.content_type)
+        or placeholder + part_msg.policy.linesep.encode() not in body
+    ):
+        log.warning(
+            'Deferred attachment does not match its message: rawmsg=%s section=%s',
+            deferred.rawmsg_id,
+            deferred.section,
+        )
+        deferred.delete_instance()
+        return False
+
+    attachment_ids = writer.store_attachments({attachment.file_checksum: attachment})
+    insert_rows(
+        AttachmentMeta.rawmsg.get_through_model(),
+        [dict(rawmsg=rawmsg.id, attachmentmeta=attachment_ids[attachment.file_checksum])],
+    )
+    # Folded as `as_bytes` folds the header process_attachment sets.
+    checksum_line = part_msg.policy.fold_binary(
+        'X-File-Checksum', attachment.file_checksum
+    )
+    body = body.replace(placeholder + part_msg.policy.linesep.encode(), checksum_line, 1)
+    RawMsg.update(email_body=compress(body, rawmsg.codec)).where(
+        RawMsg.id == rawmsg.id
+    ).execute()
+    MsgMeta.update(num_attachments=MsgMeta.num_attachments + 1).where(
+        MsgMeta.rawmsg == rawmsg.id
+    ).execute()
+    deferred.delete_instance()
+    log.info(
+        'Backfilled attachment: rawmsg=%s filename=%s',
+        rawmsg.id,
+        attachment.filename,
+    )
+    return True
@@ -1,98 +1,219 @@
+from __future__ import annotations
+
 import argparse
 import sys
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from mailboxdb.config import ConfigReader
-from mailboxdb.helpers import email_from_bytes, sha256sum, utcnow
-from mailboxdb.imap import Mbox
+from mailboxdb.codec import DEFAULT_CODEC, check_codec
+from mailboxdb.config import ConfigReader, parse_pragmas
 from mailboxdb.logger import get_logger, quiet_root_logger
-from mailboxdb.migrations import rollback_migrations, run_migrations
-from mailboxdb.model import Mailbox, db, pw
-from mailboxdb.process import process_message
-from mailboxdb.schema import MboxResults
+
+if TYPE_CHECKING:
+    from mailboxdb.attachments import AttachmentStore
 
 log = get_logger('Run')
 
+# Subcommands import what they need when they run, so that `mailboxdb --migrate`
+# or `mailboxdb search` load neither the IMAP client nor the sync machinery.
+
+
+def run(
+    creds_file: str = 'credentials.ini',
+    daemon: bool = False,
+    stats_file: str | None = None,
+):
+    from mailboxdb.attachments import open_store
+    from mailboxdb.dedup import open_dedup
+    from mailboxdb.model import db
+    from mailboxdb.process import (
+        DEFAULT_COMMIT_INTERVAL,
+        DEFAULT_COMMIT_SIZE,
+        DEFAULT_PARSE_WORKERS,
+    )
 
-def run(creds_file: str = 'credentials.ini'):
     settings = ConfigReader(creds_file)
     db.connect()
-    mbox = Mbox(settings)
-    mailbox_name = getattr(settings, 'mailbox', 'INBOX')
-    mailbox_row, _ = Mailbox.get_or_create(name=mailbox_name)
-    log.info(
-        'Mailbox sync start: mailbox=%s last_uid=%s',
-        mailbox_name,
-        mailbox_row.last_uid,
-    )
-    message_uids = mbox.get_message_uids(
-        latest_uid=mailbox_row.last_uid,
-        label=mailbox_name,
-    )
-    if not message_uids:
-        log.warning('No new message UIDs found for mailbox %s', mailbox_name)
-        mbox.logout()
-        sys.exit(0)
-
-    all_msg_gen = mbox.fetch_all_messages(message_uids)
-    # The first message can be a duplicate.
-    # This is because IMAP fetch will always get the latest message from the mailbox,
-    # even if the UID we specify is higher than the latest one.
-    for msg in all_msg_gen:
-        process_message(msg, mailbox_row)
-
-    last_uid = max(map(int, message_uids))
-    mailbox_row.last_uid = str(last_uid)
-    mailbox_row.last_sync_at = utcnow()
-    mailbox_row.save()
-    log.info(
-        'Mailbox sync complete: mailbox=%s last_uid=%s synced_at=%s',
-        mailbox_name,
-        mailbox_row.last_uid,
-        mailbox_row.last_sync_at,
-    )
-
-    mbox.logout()
-
-
-def run_file(email_folder: str):
-    db.connect()
-    folder = Path(email_folder)
-    if not folder.is_dir():
-        raise RuntimeError(f'Email folder not found or not a directory: {folder}')
-
-    mailbox_name = f'FILE:{folder}'
-    mailbox_row, _ = Mailbox.get_or_create(name=mailbox_name)
-    log.info('File ingest start: folder=%s', folder)
-
-    all_msg_paths: list[Path] = sorted(folder.glob('*.eml'))
-    if not len(all_msg_paths):
-        log.warning('No .eml files found in folder %s', folder)
-        sys.exit(0)
-
-    for path in all_msg_paths:
-        raw_email = path.read_bytes()
-        checksum = sha256sum(raw_email)
-        email_msg = email_from_bytes(raw_email)
-        process_message(
-            MboxResults(email_msg, checksum, path.name.encode()),
-            mailbox_row,
-        )
+    commit_size = settings.get_int('commit_size', DEFAULT_COMMIT_SIZE)
+    commit_interval = settings.get_int('commit_interval', DEFAULT_COMMIT_INTERVAL)
+    parse_workers = settings.get_int('parse_workers', DEFAULT_PARSE_WORKERS)
+    codec = check_codec(getattr(settings, 'compression', DEFAULT_CODEC))
+    store = open_store(settings)
+    dedup = open_dedup(settings)
+    try:
+        if daemon:
+            import threading
 
-    mailbox_row.last_uid = all_msg_paths[-1].name
-    mailbox_row.last_sync_at = utcnow()
-    mailbox_row.save()
+            from mailboxdb.daemon import mailbox_watches, watch_mailboxes
+
+            stop = threading.Event()
+            watch_mailboxes(
+                mailbox_watches(settings, stop),
+                stop,
+                commit_size,
+                parse_workers,
+                codec,
+                store,
+                dedup,
+                stats_file,
+                commit_interval,
+            )
+        else:
+            from mailboxdb.sync import (
+                backfill_deferred_parts,
+                mailbox_jobs,
+                sync_mailboxes,
+            )
+
+            sync_mailboxes(
+                mailbox_jobs(settings),
+                commit_size,
+                parse_workers,
+                codec,
+                store,
+                dedup,
+                commit_interval,
+            )
+            if settings.get_bool('backfill_deferred', True):
+                backfill_deferred_parts(settings, store, dedup)
+    finally:
+        if dedup:
+            dedup.save()
+
+
+def run_backfill(creds_file: str = 'credentials.ini') -> int:
+    """
+    Fetch the attachments deferred by earlier syncs, without syncing.
+    """
+    from mailboxdb.attachments import open_store
+    from mailboxdb.dedup import open_dedup
+    from mailboxdb.model import db
+    from mailboxdb.sync import backfill_deferred_parts
+
+    settings = ConfigReader(creds_file)
+    db.connect(reuse_if_open=True)
+    dedup = open_dedup(settings)
+    try:
+        return backfill_deferred_parts(settings, open_store(settings), dedup)
+    finally:
+        if dedup:
+            dedup.save()
 
-    log.info(
-        'File ingest complete: folder=%s last_uid=%s synced_at=%s',
-        folder,
-        mailbox_row.last_uid,
-        mailbox_row.last_sync_at,
+
+def codec_arg(value: str) -> str:
+    try:
+        return check_codec(value)
+    except RuntimeError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+
+
+def add_database_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--db',
+        type=str,
+        help='SQLite database file (default: sqlite_database or database/messages.db)',
+    )
+    parser.add_argument(
+        '--pragma',
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='SQLite pragma overriding the tuned profile, may be repeated',
     )
 
 
+def add_instrument_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Print stage timings, counters and queue depths when done',
+    )
+    parser.add_argument(
+        '--stats-file',
+        type=str,
+        metavar='FILE',
+        help='Write stats in the Prometheus text format (after every sync with --daemon)',
+    )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        metavar='FILE',
+        help='Profile the writer thread with cProfile into FILE',
+    )
+    parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        help='Log peak memory and the top allocation sites with tracemalloc',
+    )
+
+
+@contextmanager
+def instrumented(args: argparse.Namespace):
+    """
+    Profile one run if asked to, then report its stats.
+    """
+    from mailboxdb.instrument import profiled, stats
+
+    try:
+        with profiled(args.profile, args.trace_memory):
+            yield
+    finally:
+        if args.stats:
+            print(stats.summary(), file=sys.stderr)
+        if args.stats_file:
+            stats.write_prometheus(args.stats_file)
+
+
+def setup_database(args: argparse.Namespace):
+    """
+    Configure the database from the credentials file, then CLI flags.
+    """
+    from mailboxdb.model import configure_db
+
+    path = None
+    pragmas = {}
+    if args.creds and Path(args.creds).is_file():
+        settings = ConfigReader(args.creds)
+        # Not database_path: old sample files set it while it was still ignored.
+        path = getattr(settings, 'sqlite_database', None)
+        pragmas.update(parse_pragmas(settings.get_list('sqlite_pragmas', [])))
+    pragmas.update(parse_pragmas(args.pragma))
+    configure_db(args.db or path, pragmas)
+
+
+def read_settings(args: argparse.Namespace) -> ConfigReader | None:
+    """
+    The credentials file settings, if the file exists.
+    """
+    return ConfigReader(args.creds) if args.creds and Path(args.creds).is_file() else None
+
+
+def setup_store(args: argparse.Namespace) -> AttachmentStore:
+    """
+    Open the attachment store configured in the credentials file, if present.
+    """
+    from mailboxdb.attachments import open_store
+
+    return open_store(read_settings(args))
+
+
 def main(argv: list[str] | None = None):
-    parser = argparse.ArgumentParser()
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'search':
+        return main_search(argv[1:])
+    if argv and argv[0] == 'attachments':
+        return main_attachments(argv[1:])
+    if argv and argv[0] == 'thread':
+        return main_thread(argv[1:])
+    if argv and argv[0] == 'export':
+        return main_export(argv[1:])
+
+    parser = argparse.ArgumentParser(
+        epilog='Run `mailboxdb search -h`, `mailboxdb thread -h`, `mailboxdb export -h` '
+        'or `mailboxdb attachments -h` for subcommands.'
+    )
     parser.add_argument(
         '-m',
         '--migrate',
@@ -113,6 +234,33 @@ def main(argv: list[str] | None = None):
         action='store_true',
         help='Fetch outstanding emails',
     )
+    parser.add_argument(
+        '-d',
+        '--daemon',
+        action='store_true',
+        help='Keep running, fetching new emails as they arrive (IMAP IDLE)',
+    )
+    parser.add_argument(
+        '--backfill',
+        action='store_true',
+        help='Fetch the attachments left on the server by large_part_policy = defer',
+    )
+    parser.add_argument(
+        '--optimize',
+        action='store_true',
+        help='Run PRAGMA optimize, checkpoint the WAL and vacuum free pages',
+    )
+    parser.add_argument(
+        '--reindex',
+        action='store_true',
+        help='Rebuild the full-text search and thread indexes from stored messages',
+    )
+    parser.add_argument(
+        '--recompress',
+        type=codec_arg,
+        metavar='CODEC',
+        help='Rewrite stored message bodies with CODEC (none, zlib, lzma, zstd)',
+    )
     parser.add_argument(
         '-c',
         '--creds',
@@ -120,6 +268,8 @@ def main(argv: list[str] | None = None):
         default='credentials.ini',
         help='Credentials INI file to use',
     )
+    add_database_args(parser)
+    add_instrument_args(parser)
     parser.add_argument(
         '-q',
         '--quiet',
@@ -131,9 +281,14 @@ def main(argv: list[str] | None = None):
     if args.quiet:
         quiet_root_logger()
 
+    setup_database(args)
+    from mailboxdb.model import pw
+
     did_action = False
 
     if args.rollback:
+        from mailboxdb.migrations import rollback_migrations
+
         try:
             rollback_migrations(args.rollback)
         except pw.OperationalError as err:
@@ -144,6 +299,8 @@ def main(argv: list[str] | None = None):
         did_action = True
 
     if args.migrate:
+        from mailboxdb.migrations import run_migrations
+
         try:
             run_migrations()
         except pw.OperationalError as err:
@@ -153,21 +310,310 @@ def main(argv: list[str] | None = None):
                 raise err
         did_action = True
 
-    if args.run:
-        run(args.creds)
+    if args.run or args.daemon:
+        with instrumented(args):
+            run(args.creds, args.daemon, args.stats_file)
+        did_action = True
+
+    if args.backfill:
+        with instrumented(args):
+            run_backfill(args.creds)
+        did_action = True
+
+    if args.reindex:
+        from mailboxdb.search import rebuild_search_index
+        from mailboxdb.threads import rebuild_thread_index
+
+        rebuild_search_index()
+        rebuild_thread_index()
+        did_action = True
+
+    if args.recompress:
+        from mailboxdb.model import recompress_bodies
+
+        recompress_bodies(args.recompress)
+        did_action = True
+
+    if args.optimize:
+        from mailboxdb.model import optimize_db
+
+        optimize_db()
         did_action = True
 
     if not did_action:
         parser.print_help()
 
 
+def search_date(value: str) -> datetime:
+    from mailboxdb.helpers import naive_utc
+
+    try:
+        return naive_utc(datetime.fromisoformat(value))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f'not an ISO date: {value!r}') from err
+
+
+def main_search(argv: list[str] | None = None):
+    from mailboxdb.search import DEFAULT_SEARCH_LIMIT, search_messages
+
+    parser = argparse.ArgumentParser(prog='mailboxdb search')
+    parser.add_argument(
+        'query',
+        type=str,
+        help='FTS5 query over subject, from, to and body, e.g. \'invoice AND from_:acme\'',
+    )
+    parser.add_argument(
+        '--after',
+        type=search_date,
+        help='Only messages dated on or after this ISO date (UTC unless given)',
+    )
+    parser.add_argument(
+        '--before',
+        type=search_date,
+        help='Only messages dated before this ISO date (UTC unless given)',
+    )
+    parser.add_argument(
+        '-n',
+        '--limit',
+        type=int,
+        default=DEFAULT_SEARCH_LIMIT,
+        help=f'Results per page (default: {DEFAULT_SEARCH_LIMIT})',
+    )
+    parser.add_argument(
+        '-p',
+        '--page',
+        type=int,
+        default=1,
+        help='Page of results to show, starting at 1',
+    )
+    parser.add_argument(
+        '-c',
+        '--creds',
+        type=str,
+        default='credentials.ini',
+        help='Credentials INI file to read database options from, if present',
+    )
+    add_database_args(parser)
+    args = parser.parse_args(argv)
+
+    setup_database(args)
+    hits = search_messages(
+        args.query,
+        after=args.after,
+        before=args.before,
+        limit=args.limit,
+        offset=max(0, args.page - 1) * args.limit,
+    )
+    for hit in hits:
+        print(
+            f'{hit.msgmeta_id}\t{hit.date or "-"}\t{hit.from_ or "-"}\t{hit.subject or ""}'
+        )
+
+
+def main_thread(argv: list[str] | None = None):
+    from mailboxdb.threads import thread_messages
+
+    parser = argparse.ArgumentParser(prog='mailboxdb thread')
+    parser.add_argument(
+        'message_id',
+        type=str,
+        help='Message-ID of any message in the conversation, with or without <>',
+    )
+    parser.add_argument(
+        '-c',
+        '--creds',
+        type=str,
+        default='credentials.ini',
+        help='Credentials INI file to read database options from, if present',
+    )
+    add_database_args(parser)
+    args = parser.parse_args(argv)
+
+    setup_database(args)
+    found = False
+    for message in thread_messages(args.message_id):
+        found = True
+        print(
+            f'{message.msgmeta_id}\t{message.date or "-"}\t{message.from_ or "-"}\t'
+            f'{message.subject or ""}'
+        )
+    if not found:
+        log.warning('No thread found for %s', args.message_id)
+        sys.exit(1)
+
+
+def main_export(argv: list[str] | None = None):
+    from mailboxdb.export import EXPORT_FORMATS, export_messages
+
+    parser = argparse.ArgumentParser(prog='mailboxdb export')
+    parser.add_argument(
+        'path',
+        type=str,
+        help='Folder to write one .eml file per message to, or mbox file',
+    )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=EXPORT_FORMATS,
+        help='Output format (default: mbox for a path ending in .mbox, else eml)',
+    )
+    parser.add_argument(
+        '--mailbox',
+        type=str,
+        help='Only messages in this mailbox, as named in the database (e.g. work:INBOX)',
+    )
+    parser.add_argument(
+        '--after',
+        type=search_date,
+        help='Only messages dated on or after this ISO date (UTC unless given)',
+    )
+    parser.add_argument(
+        '--before',
+        type=search_date,
+        help='Only messages dated before this ISO date (UTC unless given)',
+    )
+    parser.add_argument(
+        '--from',
+        dest='sender',
+        type=str,
+        help='Only messages whose From header contains this text',
+    )
+    parser.add_argument(
+        '-c',
+        '--creds',
+        type=str,
+        default='credentials.ini',
+        help='Credentials INI file to read database and attachment options from',
+    )
+    add_database_args(parser)
+    add_instrument_args(parser)
+    args = parser.parse_args(argv)
+
+    setup_database(args)
+    export_format = args.format or ('mbox' if args.path.endswith('.mbox') else 'eml')
+    with instrumented(args):
+        export_messages(
+            args.path,
+            export_format,
+            setup_store(args),
+            mailbox=args.mailbox,
+            after=args.after,
+            before=args.before,
+            sender=args.sender,
+        )
+
+
+def main_attachments(argv: list[str] | None = None):
+    from mailboxdb.attachments import DEFAULT_VERIFY_WORKERS, gc_store, verify_store
+
+    parser = argparse.ArgumentParser(prog='mailboxdb attachments')
+    parser.add_argument(
+        'action',
+        choices=('verify', 'gc', 'compact'),
+        help='verify: re-hash stored files and find missing ones; '
+        'gc: delete files no message references; '
+        'compact: rewrite pack segments holding unreferenced bytes',
+    )
+    parser.add_argument(
+        '-j',
+        '--workers',
+        type=int,
+        default=DEFAULT_VERIFY_WORKERS,
+        help=f'Threads re-hashing files (default: {DEFAULT_VERIFY_WORKERS})',
+    )
+    parser.add_argument(
+        '--repair',
+        action='store_true',
+        help='verify: delete corrupt files so they are stored again',
+    )
+    parser.add_argument(
+        '-n',
+        '--dry-run',
+        action='store_true',
+        help='gc: only list the files that would be deleted',
+    )
+    parser.add_argument(
+        '-c',
+        '--creds',
+        type=str,
+        default='credentials.ini',
+        help='Credentials INI file to read database and attachment options from',
+    )
+    add_database_args(parser)
+    args = parser.parse_args(argv)
+
+    setup_database(args)
+    store = setup_store(args)
+    if args.action == 'verify':
+        report = verify_store(store, args.workers, args.repair)
+        if report.corrupt or report.missing:
+            sys.exit(1)
+    elif args.action == 'gc':
+        gc_store(store, args.dry_run)
+    else:
+        store.compact()
+
+
 def main_file(argv: list[str] | None = None):
+    from mailboxdb.dedup import open_dedup
+    from mailboxdb.ingest import run_file
+    from mailboxdb.process import (
+        DEFAULT_COMMIT_INTERVAL,
+        DEFAULT_COMMIT_SIZE,
+        DEFAULT_PARSE_WORKERS,
+    )
+    from mailboxdb.stream import DEFAULT_STREAM_THRESHOLD
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        'email_folder',
+        'email_path',
+        type=str,
+        help='mbox file, Maildir tree or folder of .eml files',
+    )
+    parser.add_argument(
+        '--commit-size',
+        type=int,
+        default=DEFAULT_COMMIT_SIZE,
+        help=f'Messages stored per transaction (default: {DEFAULT_COMMIT_SIZE})',
+    )
+    parser.add_argument(
+        '--commit-interval',
+        type=int,
+        default=DEFAULT_COMMIT_INTERVAL,
+        metavar='SECONDS',
+        help='Commit a group and its checkpoint at least this often '
+        f'(default: {DEFAULT_COMMIT_INTERVAL})',
+    )
+    parser.add_argument(
+        '-j',
+        '--parse-workers',
+        type=int,
+        default=DEFAULT_PARSE_WORKERS,
+        help='Processes used to parse messages (default: parse in-process)',
+    )
+    parser.add_argument(
+        '--compression',
+        type=codec_arg,
+        default=DEFAULT_CODEC,
+        metavar='CODEC',
+        help=f'Compression of stored message bodies (default: {DEFAULT_CODEC})',
+    )
+    parser.add_argument(
+        '--stream-threshold',
+        type=int,
+        default=DEFAULT_STREAM_THRESHOLD,
+        metavar='BYTES',
+        help='Stream files larger than this, extracting attachments in chunks',
+    )
+    parser.add_argument(
+        '-c',
+        '--creds',
         type=str,
-        help='Folder containing .eml files',
+        default='credentials.ini',
+        help='Credentials INI file to read database options from, if present',
     )
+    add_database_args(parser)
+    add_instrument_args(parser)
     parser.add_argument(
         '-q',
         '--quiet',
@@ -179,7 +625,19 @@ def main_file(argv: list[str] | None = None):
     if args.quiet:
         quiet_root_logger()
 
-    run_file(args.email_folder)
+    setup_database(args)
+
+    with instrumented(args):
+        run_file(
+            args.email_path,
+            args.commit_size,
+            args.parse_workers,
+            args.compression,
+            args.stream_threshold,
+            setup_store(args),
+            open_dedup(read_settings(args)),
+            args.commit_interval,
+        )
 
 
 if __name__ == '__main__':
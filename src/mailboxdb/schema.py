@@ -1,4 +1,5 @@
 from collections.abc import Generator
+from datetime import datetime
 from email.message import Message
 from typing import Any, NamedTuple, TypeAlias, cast
 
@@ -12,12 +13,73 @@ class MboxResults(NamedTuple):
     message: Message
     checksum: str
     uid: UID
+    size: int | None = None
+
+
+class MboxHeaders(NamedTuple):
+    uid: UID
+    size: int
+    message_id: str | None
+
+
+class MailboxStatus(NamedTuple):
+    uid_validity: int | None
+    # None when the server does not keep mod-sequences for the mailbox.
+    highest_modseq: int | None
+
+
+class MailboxChanges(NamedTuple):
+    # Flags of each changed message, space separated.
+    flags: dict[UID, str]
+    # Ranges of expunged UIDs, reported with QRESYNC.
+    vanished: list[tuple[int, int]]
 
 
 MboxResultsGenerator: TypeAlias = Generator[MboxResults]
 
 
+class RawMessage(NamedTuple):
+    raw_email: bytes
+    uid: UID
+    # Set for streamed messages, where `raw_email` has its attachments removed,
+    # and for messages fetched by parts.
+    checksum: str | None = None
+    size: int | None = None
+
+
+RawMessageGenerator: TypeAlias = Generator[RawMessage]
+
+
 class AttachmentProperties(NamedTuple):
     file_checksum: str
     filename: str
     content_type: str
+    # Contents of a small attachment left for the writer to pack.
+    data: bytes | None = None
+
+
+class DeferredPart(NamedTuple):
+    # IMAP body section of an attachment left on the server by selective fetch.
+    section: str
+    filename: str
+    content_type: str
+    size: int
+
+
+class ParsedMessage(NamedTuple):
+    checksum: str
+    uid: UID
+    size: int | None
+    email_body: bytes
+    from_: str | None
+    to: str | None
+    subject: str | None
+    date: datetime | None
+    message_id: str | None
+    in_reply_to: str | None
+    attachments: list[AttachmentProperties]
+    codec: str | None = None
+    body_text: str | None = None
+    # Message-IDs from References and In-Reply-To.
+    references: tuple[str, ...] = ()
+    deferred: tuple[DeferredPart, ...] = ()
@@ -0,0 +1,125 @@
+from collections.abc import Iterator
+from datetime import datetime
+from typing import NamedTuple
+
+from mailboxdb.helpers import email_from_bytes
+from mailboxdb.logger import get_logger
+from mailboxdb.model import MsgMeta, MsgSearch, RawMsg, db, insert_rows, pw
+from mailboxdb.schema import Message
+
+log = get_logger('Search')
+
+# Characters of body text indexed per message.
+SEARCH_TEXT_LIMIT = 256 * 1024
+# bm25 weights of the subject, from, to and body columns.
+SEARCH_WEIGHTS = (4.0, 2.0, 2.0, 1.0)
+DEFAULT_SEARCH_LIMIT = 20
+REINDEX_BATCH = 500
+
+
+class SearchHit(NamedTuple):
+    msgmeta_id: int
+    score: float
+    date: datetime | None
+    from_: str | None
+    subject: str | None
+
+
+def message_text(email_msg: Message) -> str:
+    """
+    Decoded text/plain parts of a message, excluding attachments.
+    """
+    texts = []
+    for part in email_msg.walk():
+        if part.get_content_type() != 'text/plain' or part.get_filename():
+            continue
+        payload = part.get_payload(decode=True)
+        if not payload:
+            continue
+        try:
+            texts.append(payload.decode(part.get_content_charset() or 'utf-8', 'replace'))
+        except LookupError:
+            texts.append(payload.decode('utf-8', 'replace'))
+    return '\n'.join(texts)[:SEARCH_TEXT_LIMIT]
+
+
+def search_row(msgmeta_id: int, from_, to, subject, body_text) -> dict:
+    return dict(
+        rowid=msgmeta_id,
+        subject=subject or '',
+        from_=from_ or '',
+        to=to or '',
+        body=body_text or '',
+    )
+
+
+def rebuild_search_index(batch_size: int = REINDEX_BATCH) -> int:
+    """
+    Index all stored messages from scratch, one transaction per batch.
+    """
+    if db.is_closed():
+        db.connect()
+    MsgSearch._fts_cmd('delete-all')
+    last_id = 0
+    indexed = 0
+    while True:
+        rows = list(
+            MsgMeta.select(MsgMeta, RawMsg)
+            .join(RawMsg)
+            .where(MsgMeta.id > last_id)
+            .order_by(MsgMeta.id)
+            .limit(batch_size)
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        with db.atomic():
+            insert_rows(
+                MsgSearch,
+                [
+                    search_row(
+                        m.id,
+                        m.from_,
+                        m.to,
+                        m.subject,
+                        message_text(email_from_bytes(m.rawmsg.read_body())),
+                    )
+                    for m in rows
+                ],
+            )
+        indexed += len(rows)
+        log.info('Indexed messages: %s, up to id=%s', indexed, last_id)
+    MsgSearch.optimize()
+    return indexed
+
+
+def search_messages(
+    query: str,
+    after: datetime | None = None,
+    before: datetime | None = None,
+    limit: int = DEFAULT_SEARCH_LIMIT,
+    offset: int = 0,
+) -> Iterator[SearchHit]:
+    """
+    Best matches of an FTS5 `query`, ranked with bm25, optionally within a date range.
+    """
+    score = MsgSearch.bm25(*SEARCH_WEIGHTS)
+    where = [MsgSearch.match(query)]
+    if after:
+        where.append(MsgMeta.date >= after)
+    if before:
+        where.append(MsgMeta.date < before)
+    rows = (
+        MsgSearch.select(MsgMeta.id, score, MsgMeta.date, MsgMeta.from_, MsgMeta.subject)
+        .join(MsgMeta, on=(MsgMeta.id == MsgSearch.rowid))
+        .where(*where)
+        .order_by(score)
+        .limit(limit)
+        .offset(offset)
+        .tuples()
+    )
+    try:
+        for row in rows:
+            yield SearchHit(*row)
+    except pw.OperationalError as err:
+        raise RuntimeError(f'Invalid search query {query!r}: {err}') from err
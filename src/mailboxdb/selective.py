@@ -0,0 +1,332 @@
+import re
+from collections.abc import Iterator
+from email.message import Message
+from email.parser import BytesHeaderParser
+from fnmatch import fnmatch
+from typing import Any, NamedTuple
+
+from mailboxdb.config import ConfigReader
+from mailboxdb.helpers import sha256sum
+from mailboxdb.schema import DeferredPart
+
+# What to do with a large attachment, or one of a skipped content type.
+FETCH = 'fetch'
+SKIP = 'skip'
+DEFER = 'defer'
+PART_POLICIES = (FETCH, SKIP, DEFER)
+# Attachments larger than this many encoded bytes follow `large_part_policy`.
+DEFAULT_LARGE_PART_SIZE = 1024 * 1024
+# Bytes read from either end of a message body to find its preamble and epilogue.
+EDGE_PEEK = 16 * 1024
+
+# Left on an attachment part in place of its body, as `X-File-Checksum` is.
+SKIPPED_HEADER = 'X-File-Skipped'
+DEFERRED_HEADER = 'X-File-Deferred'
+# Marks the checksum of a message fetched by parts, see `parts_checksum`.
+PARTS_CHECKSUM_SUFFIX = '-parts'
+
+QUOTED_RE = re.compile(rb'"((?:[^"\\]|\\.)*)"', re.DOTALL)
+LITERAL_RE = re.compile(rb'\{(\d+)\+?\}\r\n')
+# Atoms, including section specs such as `BODY[HEADER.FIELDS (DATE)]<0>`.
+ATOM_RE = re.compile(rb'[^\s()"{\[]+(?:\[[^\]]*\](?:<\d+>)?)?')
+ESCAPE_RE = re.compile(rb'\\(.)')
+
+
+class MimePart(NamedTuple):
+    # IMAP section number, empty for the message itself.
+    section: str
+    content_type: str
+    # Encoded size of the body; 0 for multiparts, which have none of their own.
+    size: int
+    # Whether the part has a filename, so that parse_message extracts it.
+    attachment: bool
+    parts: tuple['MimePart', ...] = ()
+
+
+class PartPlan(NamedTuple):
+    # RFC822.SIZE of the message.
+    size: int
+    structure: MimePart
+    # Action of each part left on the server, by section.
+    actions: dict[str, str]
+
+
+class PartAssembly(NamedTuple):
+    pieces: list[bytes]
+    # Where in the body the close delimiter and epilogue start, and their length.
+    tail_offset: int
+    tail_length: int
+    close: bytes
+
+
+def _parse_values(data: bytes, pos: int = 0) -> tuple[list, int]:
+    values: list[Any] = []
+    while pos < len(data):
+        char = data[pos : pos + 1]
+        if char.isspace():
+            pos += 1
+        elif char == b'(':
+            value, pos = _parse_values(data, pos + 1)
+            values.append(value)
+        elif char == b')':
+            return values, pos + 1
+        elif match := QUOTED_RE.match(data, pos):
+            values.append(ESCAPE_RE.sub(rb'\1', match.group(1)))
+            pos = match.end()
+        elif match := LITERAL_RE.match(data, pos):
+            end = match.end() + int(match.group(1))
+            values.append(data[match.end() : end])
+            pos = end
+        elif match := ATOM_RE.match(data, pos):
+            atom = match.group(0)
+            values.append(None if atom.upper() == b'NIL' else atom)
+            pos = match.end()
+        else:
+            raise RuntimeError(f'Cannot parse IMAP response: {data[pos : pos + 40]!r}')
+    return values, pos
+
+
+def fetch_responses(fetch_data: list) -> Iterator[dict[str, Any]]:
+    """
+    Parse each message of a FETCH response into its items by name,
+    e.g. `{'UID': b'12', 'BODY[1.MIME]': b'...'}`.
+    """
+    pieces: list[bytes] = []
+    for item in fetch_data:
+        if isinstance(item, tuple):
+            pieces.extend((b' ', item[0], b'\r\n', item[1]))
+        elif item:
+            pieces.extend((b' ', item))
+    values, _ = _parse_values(b''.join(pieces))
+    for value in values:
+        if isinstance(value, list):
+            yield {
+                bytes(name).decode().upper(): item
+                for name, item in zip(value[::2], value[1::2])
+            }
+
+
+def _text(value: Any) -> str:
+    return value.decode(errors='replace').lower() if isinstance(value, bytes) else ''
+
+
+def _param_names(params: Any) -> set[str]:
+    if not isinstance(params, list):
+        return set()
+    return {_text(name) for name in params[::2]}
+
+
+def parse_bodystructure(value: list, section: str = '') -> MimePart:
+    """
+    The MIME tree of a BODYSTRUCTURE item, as parsed by `fetch_responses`.
+    """
+    if value and isinstance(value[0], list):
+        count = next(
+            (n for n, item in enumerate(value) if not isinstance(item, list)), len(value)
+        )
+        parts = tuple(
+            parse_bodystructure(child, f'{section}.{n}' if section else str(n))
+            for n, child in enumerate(value[:count], 1)
+        )
+        subtype = _text(value[count]) if count < len(value) else 'mixed'
+        return MimePart(section, f'multipart/{subtype}', 0, False, parts)
+
+    content_type = f'{_text(value[0])}/{_text(value[1])}'
+    size = int(value[6]) if len(value) > 6 and value[6] else 0
+    # Text parts add a line count, messages an envelope, a body and a line count.
+    extension = 8 if content_type.startswith('text/') else 7
+    if content_type == 'message/rfc822':
+        extension = 10
+    disposition = value[extension + 1] if len(value) > extension + 1 else None
+    names = {name for name in _param_names(value[2]) if name.startswith('name')}
+    if isinstance(disposition, list) and len(disposition) > 1:
+        names |= {
+            name for name in _param_names(disposition[1]) if name.startswith('filename')
+        }
+    return MimePart(section, content_type, size, bool(names))
+
+
+class PartPolicy:
+    """
+    Decide which attachments of a message are left on the server.
+
+    Only attachments directly below a multipart message qualify: their
+    siblings, the preamble and the epilogue are enough to put the rest of
+    the message back together byte for byte.
+    """
+
+    def __init__(
+        self,
+        large_part_size: int = DEFAULT_LARGE_PART_SIZE,
+        large_part_policy: str = FETCH,
+        skip_content_types: list[str] | None = None,
+    ):
+        if large_part_policy not in PART_POLICIES:
+            raise RuntimeError(
+                f'large_part_policy must be one of {PART_POLICIES}, '
+                f'got {large_part_policy!r}'
+            )
+        self.large_part_size = large_part_size
+        self.large_part_policy = large_part_policy
+        self.skip_content_types = [t.lower() for t in skip_content_types or []]
+
+    @classmethod
+    def from_settings(cls, settings: ConfigReader) -> 'PartPolicy | None':
+        """
+        The configured policy, or None when every part is fetched.
+        """
+        policy = cls(
+            settings.get_int('large_part_size', DEFAULT_LARGE_PART_SIZE),
+            str(getattr(settings, 'large_part_policy', FETCH)).strip().lower(),
+            settings.get_list('skip_content_types', []),
+        )
+        if policy.large_part_policy == FETCH and not policy.skip_content_types:
+            return None
+        return policy
+
+    def action(self, part: MimePart) -> str:
+        if any(
+            fnmatch(part.content_type, pattern) for pattern in self.skip_content_types
+        ):
+            return SKIP
+        if part.size > self.large_part_size:
+            return self.large_part_policy
+        return FETCH
+
+    def plan(self, structure: MimePart) -> dict[str, str]:
+        """
+        Action of each part to leave on the server, by section.
+        """
+        if not structure.content_type.startswith('multipart/'):
+            return {}
+        return {
+            part.section: action
+            for part in structure.parts
+            if part.attachment
+            and not part.content_type.startswith(('multipart/', 'message/'))
+            and (action := self.action(part)) != FETCH
+        }
+
+
+def part_placeholder(header: str, section: str, size: int) -> bytes:
+    """
+    Header line left on a part whose body stayed on the server.
+    """
+    return f'{header}: {section}; size={size}'.encode()
+
+
+def part_fetch_items(plan: PartPlan) -> str:
+    """
+    FETCH items for the header, the edges of the body and every part kept.
+    """
+    items = ['BODY.PEEK[HEADER]', f'BODY.PEEK[TEXT]<0.{EDGE_PEEK}>']
+    for part in plan.structure.parts:
+        items.append(f'BODY.PEEK[{part.section}.MIME]')
+        if part.section not in plan.actions:
+            items.append(f'BODY.PEEK[{part.section}]')
+    return '(' + ' '.join(items) + ')'
+
+
+def _with_placeholder(mime: bytes, placeholder: bytes) -> bytes | None:
+    eol = b'\r\n' if mime.endswith(b'\r\n') else b'\n'
+    headers = mime[: -len(eol)]
+    if not headers.endswith(b'\n'):
+        return None
+    return headers + placeholder + eol + eol
+
+
+def assemble_parts(plan: PartPlan, fields: dict[str, Any]) -> PartAssembly | None:
+    """
+    Put the fetched pieces of a message back in order, with a placeholder
+    header and no body for each part left on the server.
+
+    Returns None when the pieces do not line up with the message size,
+    in which case the message has to be fetched whole.
+    """
+    header = fields.get('BODY[HEADER]')
+    preview = fields.get('BODY[TEXT]<0>')
+    if header is None or preview is None:
+        return None
+    boundary = BytesHeaderParser().parsebytes(header).get_boundary()
+    if not boundary:
+        return None
+    delimiter = b'--' + boundary.encode('ascii', 'surrogateescape')
+    first = re.search(rb'(?:\A|\n)(' + re.escape(delimiter) + rb'[ \t]*(\r?\n))', preview)
+    if not first:
+        return None
+    eol = first.group(2)
+    separator = eol + first.group(1)
+    head = preview[: first.end()]
+    pieces = [header, head]
+    offset = len(head)
+    parser = BytesHeaderParser()
+    for index, part in enumerate(plan.structure.parts):
+        if index:
+            pieces.append(separator)
+            offset += len(separator)
+        mime = fields.get(f'BODY[{part.section}.MIME]')
+        if mime is None:
+            return None
+        action = plan.actions.get(part.section)
+        if action is None:
+            body = fields.get(f'BODY[{part.section}]')
+            if body is None:
+                return None
+            pieces.extend((mime, body))
+            offset += len(mime) + len(body)
+            continue
+        # BODYSTRUCTURE parameters can disagree with how the header is parsed.
+        if not parser.parsebytes(mime).get_filename():
+            return None
+        header_name = DEFERRED_HEADER if action == DEFER else SKIPPED_HEADER
+        marked = _with_placeholder(
+            mime, part_placeholder(header_name, part.section, part.size)
+        )
+        if marked is None:
+            return None
+        pieces.append(marked)
+        offset += len(mime) + part.size
+
+    close = eol + delimiter + b'--'
+    tail_length = plan.size - len(header) - offset
+    if not len(close) <= tail_length <= EDGE_PEEK:
+        return None
+    return PartAssembly(pieces, offset, tail_length, close)
+
+
+def parts_checksum(raw_email: bytes) -> str:
+    """
+    Checksum of a message fetched by parts. It hashes the rebuilt message,
+    not the bytes on the server, so it is marked to never match the checksum
+    of a whole fetch. Such messages are only recognised in other mailboxes by
+    Message-ID and size, with `find_known_messages`.
+    """
+    return sha256sum(raw_email) + PARTS_CHECKSUM_SUFFIX
+
+
+def finish_parts(assembly: PartAssembly, tail: bytes | None) -> bytes | None:
+    """
+    The reassembled message, if `tail` starts with the close delimiter
+    where the part sizes put it.
+    """
+    if tail is None or len(tail) != assembly.tail_length:
+        return None
+    if not tail.startswith(assembly.close):
+        return None
+    return b''.join([*assembly.pieces, tail])
+
+
+def deferred_part(part: Message) -> DeferredPart | None:
+    """
+    The attachment a placeholder header stands for, to be fetched later.
+    """
+    value = part.get(DEFERRED_HEADER)
+    if value is None:
+        return None
+    size = part.get_param('size', header=DEFERRED_HEADER)
+    return DeferredPart(
+        str(value).split(';', 1)[0].strip(),
+        part.get_filename() or '',
+        part.get_content_type(),
+        int(size) if isinstance(size, str) and size.isdigit() else 0,
+    )
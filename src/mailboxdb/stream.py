@@ -0,0 +1,338 @@
+import base64
+import binascii
+import hashlib
+import io
+import re
+from collections.abc import Iterable, Iterator
+from email.message import Message
+from email.parser import BytesHeaderParser
+from pathlib import Path
+from typing import BinaryIO, Protocol
+
+from mailboxdb.attachments import AttachmentStore
+from mailboxdb.instrument import stats
+from mailboxdb.logger import get_logger
+from mailboxdb.schema import UID, RawMessage
+
+log = get_logger('Stream')
+
+# Messages larger than this many bytes are streamed instead of parsed in memory.
+DEFAULT_STREAM_THRESHOLD = 32 * 1024 * 1024
+# Bytes read per partial FETCH or file read while streaming.
+DEFAULT_STREAM_CHUNK_SIZE = 1024 * 1024
+# Longest line held in memory; longer lines are handled in pieces.
+LINE_LIMIT = 64 * 1024
+
+BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+BASE64_IGNORED = bytes(c for c in range(256) if c not in BASE64_ALPHABET)
+# Bytes per 76 character base64 line.
+BASE64_LINE_BYTES = 57
+QP_FROM_RE = re.compile(rb'^From ', re.MULTILINE)
+
+
+def file_chunks(
+    path: Path, chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE
+) -> Iterator[bytes]:
+    with path.open('rb') as fp:
+        while chunk := fp.read(chunk_size):
+            yield chunk
+
+
+def _strip_eol(line: bytes) -> bytes:
+    if line.endswith(b'\r\n'):
+        return line[:-2]
+    if line.endswith(b'\n'):
+        return line[:-1]
+    return line
+
+
+class _Base64Decoder:
+    """
+    Decode base64 in pieces, carrying incomplete quanta to the next call.
+    """
+
+    def __init__(self):
+        self.rest = b''
+
+    def __call__(self, data: bytes, final: bool = False) -> bytes:
+        data = self.rest + data.translate(None, BASE64_IGNORED)
+        cut = len(data) if final else len(data) - len(data) % 4
+        data, self.rest = data[:cut], data[cut:]
+        if final and len(data) % 4:
+            data += b'=' * (-len(data) % 4)
+        try:
+            return binascii.a2b_base64(data)
+        except binascii.Error:
+            log.warning('Invalid base64 data in streamed attachment')
+            return b''
+
+
+def _transfer_encoding(headers: Message) -> str:
+    return str(headers.get('Content-Transfer-Encoding', '')).strip().lower()
+
+
+def _decoder(headers: Message):
+    cte = _transfer_encoding(headers)
+    if cte == 'base64':
+        return _Base64Decoder()
+    if cte == 'quoted-printable':
+        return lambda data, final=False: binascii.a2b_qp(data)
+    return lambda data, final=False: data
+
+
+def encoded_chunks(
+    fp: BinaryIO,
+    cte: str,
+    eol: bytes = b'\n',
+    chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    Encode an attachment file for its Content-Transfer-Encoding, reading
+    `chunk_size` bytes at a time. Other encodings are copied unchanged,
+    as `get_payload(decode=True)` leaves them.
+    """
+    if cte == 'base64':
+        size = max(1, chunk_size // BASE64_LINE_BYTES) * BASE64_LINE_BYTES
+        while chunk := fp.read(size):
+            encoded = base64.encodebytes(chunk)
+            yield encoded if eol == b'\n' else encoded.replace(b'\n', eol)
+    elif cte == 'quoted-printable':
+        while line := fp.readline(LINE_LIMIT):
+            # `=46rom` keeps mbox writers from quoting the line, which would change it.
+            encoded = QP_FROM_RE.sub(b'=46rom ', binascii.b2a_qp(line, istext=True))
+            # A line cut at LINE_LIMIT goes on after a soft line break.
+            yield encoded if line.endswith(b'\n') else encoded + b'=' + eol
+    else:
+        while chunk := fp.read(chunk_size):
+            yield chunk
+
+
+class MimeSplitter:
+    """
+    Split attachments out of a message read in chunks, without parsing it into
+    a `Message` tree.
+
+    Attachment bodies are decoded and hashed piece by piece while written
+    to `store`, which spools them to a temp file renamed to their checksum.
+    Everything else is copied to the stripped message, with `X-File-Checksum`
+    on each attachment part as `process_attachment` leaves it.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], store: AttachmentStore | None = None):
+        self.store = store or AttachmentStore()
+        self.checksum = hashlib.sha256()
+        self.size = 0
+        self.out = io.BytesIO()
+        self.lines = self._lines(chunks)
+
+    def _lines(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        buf = b''
+        for chunk in chunks:
+            self.checksum.update(chunk)
+            self.size += len(chunk)
+            buf += chunk
+            start = 0
+            while (end := buf.find(b'\n', start)) >= 0:
+                yield buf[start : end + 1]
+                start = end + 1
+            buf = buf[start:]
+            while len(buf) > LINE_LIMIT:
+                yield buf[:LINE_LIMIT]
+                buf = buf[LINE_LIMIT:]
+        if buf:
+            yield buf
+
+    @staticmethod
+    def _delimiter(
+        line: bytes, boundaries: tuple[bytes, ...]
+    ) -> tuple[bytes, bool] | None:
+        """
+        The boundary `line` delimits and whether it closes the multipart.
+        """
+        text = line.rstrip()
+        if not text.startswith(b'--'):
+            return None
+        for boundary in boundaries:
+            if text == b'--' + boundary:
+                return boundary, False
+            if text == b'--' + boundary + b'--':
+                return boundary, True
+        return None
+
+    def split(self, uid: UID) -> RawMessage:
+        self._entity(())
+        for _ in self.lines:  # trailing data after the closing boundary
+            pass
+        return RawMessage(self.out.getvalue(), uid, self.checksum.hexdigest(), self.size)
+
+    def _entity(self, boundaries: tuple[bytes, ...]) -> bytes | None:
+        """
+        Copy or extract one MIME entity. Returns the boundary line that ended it.
+        """
+        header_lines: list[bytes] = []
+        for line in self.lines:
+            if self._delimiter(line, boundaries):
+                self.out.write(b''.join(header_lines))
+                return line
+            header_lines.append(line)
+            if not line.strip():
+                break
+        headers = BytesHeaderParser().parsebytes(b''.join(header_lines))
+
+        boundary = headers.get_boundary()
+        if headers.get_content_maintype() == 'multipart' and boundary:
+            self.out.write(b''.join(header_lines))
+            return self._multipart(
+                boundary.encode('ascii', 'surrogateescape'), boundaries
+            )
+        if headers.get_filename():
+            return self._attachment(header_lines, headers, boundaries)
+        self.out.write(b''.join(header_lines))
+        if headers.get_content_type() == 'message/rfc822':
+            return self._entity(boundaries)
+        return self._copy(boundaries)
+
+    def _multipart(self, boundary: bytes, outer: tuple[bytes, ...]) -> bytes | None:
+        inner = (*outer, boundary)
+        line = self._copy(inner)  # preamble
+        while line is not None and self._delimiter(line, inner) == (boundary, False):
+            self.out.write(line)
+            line = self._entity(inner)
+        if line is not None and self._delimiter(line, inner) == (boundary, True):
+            self.out.write(line)
+            line = self._copy(outer)  # epilogue
+        return line
+
+    def _copy(self, boundaries: tuple[bytes, ...]) -> bytes | None:
+        for line in self.lines:
+            if self._delimiter(line, boundaries):
+                return line
+            self.out.write(line)
+        return None
+
+    def _attachment(
+        self, header_lines: list[bytes], headers: Message, boundaries: tuple[bytes, ...]
+    ) -> bytes | None:
+        decode = _decoder(headers)
+        end = None
+        with self.store.writer() as writer:
+            # The line break before a boundary belongs to the boundary.
+            pending = b''
+            for line in self.lines:
+                if self._delimiter(line, boundaries):
+                    end = line
+                    pending = _strip_eol(pending)
+                    break
+                writer.write(decode(pending))
+                pending = line
+            writer.write(decode(pending, final=True))
+        file_checksum = writer.checksum
+
+        eol = b'\n'
+        if header_lines and not header_lines[-1].strip():
+            eol = b'\r\n' if header_lines.pop().endswith(b'\r\n') else b'\n'
+        self.out.write(b''.join(header_lines))
+        self.out.write(b'X-File-Checksum: ' + file_checksum.encode() + eol + eol)
+        return end
+
+
+def split_message(
+    chunks: Iterable[bytes], uid: UID, store: AttachmentStore | None = None
+) -> RawMessage:
+    """
+    Stream a message, extracting its attachments to `store`.
+    Returns the stripped message with the checksum and size of the original.
+    """
+    return MimeSplitter(chunks, store).split(uid)
+
+
+class Writable(Protocol):
+    def write(self, data: bytes, /) -> object: ...
+
+
+class MimeJoiner(MimeSplitter):
+    """
+    Put the attachments of a stored message back, the inverse of `MimeSplitter`.
+
+    Each attachment part with an `X-File-Checksum` header and no body loses the
+    header and gets its file from `store`, encoded again and copied to `out` in
+    chunks, so only the stripped message is held in memory.
+    """
+
+    def __init__(
+        self,
+        email_body: bytes,
+        out: Writable,
+        store: AttachmentStore | None = None,
+        chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+    ):
+        super().__init__([email_body], store)
+        self.out = out
+        self.chunk_size = chunk_size
+        self.attachments = 0
+        self.missing = 0
+
+    def join(self) -> int:
+        """
+        Write the whole message to `out`. Returns the number of attachments put back.
+        """
+        self._entity(())
+        for line in self.lines:  # trailing data after the closing boundary
+            self.out.write(line)
+        return self.attachments
+
+    def _attachment(
+        self, header_lines: list[bytes], headers: Message, boundaries: tuple[bytes, ...]
+    ) -> bytes | None:
+        checksum = str(headers.get('X-File-Checksum') or '').strip()
+        if not checksum:
+            # Placeholders of selective fetch and parts that were never extracted.
+            self.out.write(b''.join(header_lines))
+            return self._copy(boundaries)
+
+        body: list[bytes] = []
+        end = None
+        for line in self.lines:
+            if self._delimiter(line, boundaries):
+                end = line
+                break
+            body.append(line)
+        try:
+            fp = self.store.open(checksum) if not any(map(bytes.strip, body)) else None
+        except FileNotFoundError:
+            fp = None
+            self.missing += 1
+            stats.count('export_missing_attachments')
+            log.warning('Attachment file not found: %s', checksum)
+        if fp is None:
+            self.out.write(b''.join([*header_lines, *body]))
+            return end
+
+        eol = b'\n'
+        if header_lines and not header_lines[-1].strip():
+            eol = b'\r\n' if header_lines[-1].endswith(b'\r\n') else b'\n'
+        self.out.write(b''.join(_without_header(header_lines, b'x-file-checksum:')))
+        with fp:
+            for chunk in encoded_chunks(
+                fp, _transfer_encoding(headers), eol, self.chunk_size
+            ):
+                self.out.write(chunk)
+                stats.count('export_attachment_bytes', len(chunk))
+        if end is not None:
+            # The line break before a boundary belongs to the boundary.
+            self.out.write(eol)
+        self.attachments += 1
+        return end
+
+
+def _without_header(header_lines: list[bytes], name: bytes) -> Iterator[bytes]:
+    """
+    `header_lines` without the field `name`, including its folded lines.
+    """
+    skipping = False
+    for line in header_lines:
+        if skipping and line[:1] in (b' ', b'\t'):
+            continue
+        skipping = line.lower().startswith(name)
+        if not skipping:
+            yield line
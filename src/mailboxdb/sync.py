@@ -0,0 +1,429 @@
+import queue
+import threading
+import time
+from collections import deque
+from collections.abc import Iterable
+from typing import NamedTuple
+
+from mailboxdb.attachments import AttachmentStore
+from mailboxdb.codec import DEFAULT_CODEC
+from mailboxdb.config import ConfigReader
+from mailboxdb.dedup import DedupCache
+from mailboxdb.helpers import utcnow
+from mailboxdb.imap import Mbox
+from mailboxdb.instrument import stats
+from mailboxdb.logger import get_logger
+from mailboxdb.model import DeferredAttachment, Mailbox, MsgLabel, MsgMeta, db
+from mailboxdb.pool import DEFAULT_FETCH_CONNECTIONS, FetchPool
+from mailboxdb.process import (
+    DEFAULT_COMMIT_INTERVAL,
+    DEFAULT_COMMIT_SIZE,
+    DEFAULT_PARSE_WORKERS,
+    MessageWriter,
+    ParsePipeline,
+    find_known_messages,
+    store_backfilled_part,
+)
+from mailboxdb.schema import (
+    UID,
+    ListUIDs,
+    MailboxChanges,
+    MailboxStatus,
+    ParsedMessage,
+    RawMessage,
+)
+
+log = get_logger('Sync')
+
+# Messages buffered between the fetch threads and the writer.
+WRITER_QUEUE_SIZE = 256
+# Seconds to wait for fetched messages while parse results are outstanding.
+PIPELINE_POLL = 0.05
+
+
+def writer_timeout(writer: MessageWriter, pipeline: ParsePipeline) -> float | None:
+    """
+    How long the writer may wait for fetched messages: until its pending group
+    is due, and no longer than `PIPELINE_POLL` while parse results are outstanding.
+    Commits the group first if it is due already.
+    """
+    timeouts = (writer.flush_due(), PIPELINE_POLL if pipeline.busy else None)
+    return min((t for t in timeouts if t is not None), default=None)
+
+
+class LinkKnown(NamedTuple):
+    msgmeta_ids: dict[UID, int]
+
+
+class ResetMailbox(NamedTuple):
+    uid_validity: int | None
+
+
+class SyncDone(NamedTuple):
+    pass
+
+
+SyncItem = (
+    RawMessage | ParsedMessage | LinkKnown | ResetMailbox | MailboxChanges | SyncDone
+)
+
+
+class UidProgress:
+    """
+    Track the highest UID up to which every UID of a sync is committed.
+    """
+
+    def __init__(self, message_uids: ListUIDs):
+        self.outstanding = deque(sorted(map(int, message_uids)))
+        self.committed: set[int] = set()
+
+    def commit(self, message_uids: Iterable[UID]) -> int | None:
+        """
+        Mark UIDs as committed; returns the new contiguous UID if it moved.
+        """
+        self.committed.update(map(int, message_uids))
+        last = None
+        while self.outstanding and self.outstanding[0] in self.committed:
+            last = self.outstanding.popleft()
+            self.committed.discard(last)
+        return last
+
+
+class MailboxSync:
+    """
+    Fetch one mailbox of one account on a background thread.
+
+    Everything that writes to the database is handed to the shared writer
+    through a queue, so several mailboxes never compete for the write lock.
+    """
+
+    def __init__(self, settings: ConfigReader, label: str, mailbox_row: Mailbox):
+        self.settings = settings
+        self.label = label
+        self.mailbox_row = mailbox_row
+        self.last_uid = mailbox_row.last_uid
+        self.message_uids: ListUIDs = []
+        self.progress: UidProgress | None = None
+        self.status: MailboxStatus | None = None
+        # Mod-sequence to store once synced, when the server has CONDSTORE.
+        self.highest_modseq: int | None = None
+        self.error: BaseException | None = None
+        self.messages = 0
+        self.linked = 0
+        self.expunged = 0
+        self.bytes = 0
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def name(self) -> str:
+        return self.mailbox_row.name
+
+    def start(self, out: 'queue.Queue[tuple[MailboxSync, SyncItem]]'):
+        self.started = time.monotonic()
+        log.info('Mailbox sync start: mailbox=%s last_uid=%s', self.name, self.last_uid)
+        thread = threading.Thread(
+            target=self._run, args=(out,), name=f'sync-{self.name}', daemon=True
+        )
+        thread.start()
+
+    def _run(self, out: 'queue.Queue[tuple[MailboxSync, SyncItem]]'):
+        try:
+            for item in self._fetch():
+                out.put((self, item))
+        except Exception as err:
+            self.error = err
+        finally:
+            if not db.is_closed():
+                db.close()
+            out.put((self, SyncDone()))
+
+    def _fetch(self):
+        mbox = Mbox(self.settings)
+        try:
+            mbox.enable_changes()
+            yield from self._sync(mbox)
+        finally:
+            mbox.logout()
+
+    def _sync(self, mbox: Mbox):
+        """
+        Fetch what changed since the stored checkpoint over an open connection.
+        """
+        self.status = mbox.select_mailbox(self.label)
+        last_uid = self.mailbox_row.last_uid
+        modseq = self.mailbox_row.highest_modseq
+        stored_validity = self.mailbox_row.uid_validity
+        server_validity = self.status.uid_validity
+        if stored_validity and server_validity and stored_validity != server_validity:
+            log.warning(
+                'UIDVALIDITY changed: mailbox=%s stored=%s server=%s; '
+                'reconciling all messages by checksum',
+                self.name,
+                stored_validity,
+                self.status.uid_validity,
+            )
+            yield ResetMailbox(self.status.uid_validity)
+            last_uid = modseq = None
+
+        changes = None
+        if mbox.condstore and self.status.highest_modseq:
+            self.highest_modseq = self.status.highest_modseq
+            if modseq == self.status.highest_modseq:
+                log.info('Mailbox unchanged since last sync: %s', self.name)
+                return
+            changes = mbox.fetch_changes(modseq)
+            message_uids = sorted(
+                (
+                    m_uid
+                    for m_uid in changes.flags
+                    if not last_uid or int(m_uid) > int(last_uid)
+                ),
+                key=int,
+            )
+        else:
+            message_uids = mbox.get_message_uids(latest_uid=last_uid, label=self.label)
+
+        if message_uids:
+            self.message_uids = message_uids
+            self.progress = UidProgress(message_uids)
+            yield from self._fetch_messages(mbox, message_uids)
+        else:
+            log.warning('No new message UIDs found for mailbox %s', self.name)
+        if changes:
+            yield changes
+
+    def _fetch_messages(self, mbox: Mbox, message_uids: ListUIDs):
+        sizes = None
+        fetch_uids = message_uids
+        if self.settings.get_bool('prefetch_headers', True):
+            headers = mbox.prefetch_headers(message_uids)
+            sizes = {h.uid: h.size for h in headers}
+            known = find_known_messages(headers)
+            if known:
+                stats.count('skipped_uids', len(known))
+                yield LinkKnown(known)
+            fetch_uids = [m_uid for m_uid in message_uids if m_uid not in known]
+
+        connections = self.settings.get_int(
+            'fetch_connections', DEFAULT_FETCH_CONNECTIONS
+        )
+        if connections > 1:
+            pool = FetchPool(self.settings, self.label, connections)
+            fetched = pool.fetch_raw_messages(fetch_uids, sizes)
+        else:
+            fetched = mbox.fetch_raw_messages(fetch_uids, sizes)
+        for raw in fetched:
+            stats.count('fetched_messages')
+            stats.count('fetched_bytes', raw.size or len(raw.raw_email))
+            yield raw
+
+    def write(self, item: SyncItem, writer: MessageWriter):
+        """
+        Apply one queued item. Runs on the writer thread.
+        """
+        if isinstance(item, LinkKnown):
+            with db.atomic():
+                MsgMeta.link_labels(item.msgmeta_ids, self.mailbox_row)
+                self.checkpoint(list(item.msgmeta_ids))
+            self.linked += len(item.msgmeta_ids)
+            log.info('Linked already stored messages: %s', len(item.msgmeta_ids))
+        elif isinstance(item, ResetMailbox):
+            # Stored UIDs belong to the old UIDVALIDITY: drop them and start over.
+            with db.atomic():
+                MsgLabel.delete().where(MsgLabel.mailbox == self.mailbox_row).execute()
+                DeferredAttachment.delete().where(
+                    DeferredAttachment.mailbox == self.mailbox_row
+                ).execute()
+                self.mailbox_row.last_uid = None
+                self.mailbox_row.highest_modseq = None
+                self.mailbox_row.uid_validity = item.uid_validity
+                self.mailbox_row.save()
+        elif isinstance(item, MailboxChanges):
+            # Flags of new messages are among the changes: store them first.
+            writer.flush()
+            with db.atomic():
+                MsgLabel.update_flags(self.mailbox_row, item.flags)
+                self.expunged += MsgLabel.unlink_uids(self.mailbox_row, item.vanished)
+        elif isinstance(item, ParsedMessage):
+            # The first message can be a duplicate.
+            # This is because IMAP fetch will always get the latest message from the
+            # mailbox, even if the UID we specify is higher than the latest one.
+            writer.add(item, self.mailbox_row, self.checkpoint)
+            self.messages += 1
+            self.bytes += item.size or 0
+
+    def checkpoint(self, message_uids: ListUIDs):
+        """
+        Store the highest UID below which all messages are committed,
+        inside the transaction that committed `message_uids`.
+        """
+        last_uid = self.progress.commit(message_uids) if self.progress else None
+        if last_uid is None:
+            return
+        self.mailbox_row.last_uid = str(last_uid)
+        if self.status:
+            self.mailbox_row.uid_validity = self.status.uid_validity
+        with stats.timed('checkpoint'):
+            self.mailbox_row.save(only=[Mailbox.last_uid, Mailbox.uid_validity])
+
+    def finish(self):
+        """
+        Store the mailbox checkpoint. Runs on the writer thread.
+        """
+        self.elapsed = time.monotonic() - self.started
+        if self.error:
+            log.error('Mailbox sync failed: mailbox=%s error=%s', self.name, self.error)
+            return
+        if self.status:
+            self.mailbox_row.uid_validity = self.status.uid_validity
+            self.mailbox_row.highest_modseq = self.highest_modseq
+        if self.message_uids:
+            last_uid = max(map(int, self.message_uids))
+            self.mailbox_row.last_uid = str(last_uid)
+        elif not self.status:
+            return
+
+        self.mailbox_row.last_sync_at = utcnow()
+        with stats.timed('checkpoint'):
+            self.mailbox_row.save()
+        log.info(
+            'Mailbox sync complete: mailbox=%s last_uid=%s synced_at=%s',
+            self.name,
+            self.mailbox_row.last_uid,
+            self.mailbox_row.last_sync_at,
+        )
+
+
+def sync_mailboxes(
+    jobs: list[MailboxSync],
+    commit_size: int = DEFAULT_COMMIT_SIZE,
+    parse_workers: int = DEFAULT_PARSE_WORKERS,
+    codec: str = DEFAULT_CODEC,
+    store: AttachmentStore | None = None,
+    dedup: DedupCache | None = None,
+    commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+):
+    """
+    Fetch all mailboxes concurrently, writing from the calling thread only.
+    Messages are parsed in `parse_workers` processes and written in fetch order.
+    """
+    writer = MessageWriter(commit_size, store, dedup, commit_interval)
+    pipeline = ParsePipeline(parse_workers, codec, store)
+    out: queue.Queue[tuple[MailboxSync, SyncItem]] = queue.Queue(WRITER_QUEUE_SIZE)
+    for job in jobs:
+        job.start(out)
+
+    try:
+        pending = len(jobs)
+        while pending:
+            try:
+                job, item = out.get(timeout=writer_timeout(writer, pipeline))
+                stats.gauge('writer', out.qsize())
+                pipeline.put(job, item)
+            except queue.Empty:
+                pass
+            for job, item in pipeline.ready():
+                if isinstance(item, SyncDone):
+                    writer.flush()
+                    job.finish()
+                    pending -= 1
+                else:
+                    job.write(item, writer)
+    finally:
+        pipeline.close()
+
+    for job in jobs:
+        log.info(
+            'Mailbox sync summary: mailbox=%s messages=%s linked=%s expunged=%s '
+            'bytes=%s seconds=%.1f',
+            job.name,
+            job.messages,
+            job.linked,
+            job.expunged,
+            job.bytes,
+            job.elapsed,
+        )
+
+    failed = [job for job in jobs if job.error]
+    if failed:
+        raise RuntimeError(
+            'Mailbox sync failed for: ' + ', '.join(job.name for job in failed)
+        ) from failed[0].error
+
+
+def mailbox_jobs(settings: ConfigReader) -> list[MailboxSync]:
+    """
+    One sync job per configured mailbox of every configured account.
+    """
+    jobs: list[MailboxSync] = []
+    for account in settings.accounts():
+        for label in account.mailbox_names():
+            mailbox_row, _ = Mailbox.get_or_create(name=account.mailbox_row_name(label))
+            jobs.append(MailboxSync(account, label, mailbox_row))
+    return jobs
+
+
+def backfill_deferred_parts(
+    settings: ConfigReader,
+    store: AttachmentStore | None = None,
+    dedup: DedupCache | None = None,
+) -> int:
+    """
+    Fetch the attachments that `large_part_policy = defer` left on the server,
+    one mailbox at a time, storing each in its own transaction.
+    """
+    writer = MessageWriter(store=store, dedup=dedup)
+    backfilled = 0
+    for account in settings.accounts():
+        for label in account.mailbox_names():
+            mailbox_row = Mailbox.get_or_none(
+                Mailbox.name == account.mailbox_row_name(label)
+            )
+            if not mailbox_row:
+                continue
+            queued = list(
+                DeferredAttachment.select()
+                .where(DeferredAttachment.mailbox == mailbox_row)
+                .order_by(DeferredAttachment.id)
+            )
+            if queued:
+                backfilled += _backfill_mailbox(
+                    account, label, mailbox_row, queued, writer
+                )
+    return backfilled
+
+
+def _backfill_mailbox(
+    settings: ConfigReader,
+    label: str,
+    mailbox_row: Mailbox,
+    queued: list[DeferredAttachment],
+    writer: MessageWriter,
+) -> int:
+    log.info('Backfill start: mailbox=%s attachments=%s', mailbox_row.name, len(queued))
+    backfilled = 0
+    mbox = Mbox(settings)
+    try:
+        status = mbox.select_mailbox(label)
+        if mailbox_row.uid_validity and status.uid_validity != mailbox_row.uid_validity:
+            # The next sync resets the mailbox and drops its queue.
+            log.warning('UIDVALIDITY changed, backfill skipped: %s', mailbox_row.name)
+            return 0
+        for deferred in queued:
+            part = mbox.fetch_part(str(deferred.uid).encode(), deferred.section)
+            with db.atomic():
+                if part is None:
+                    log.warning(
+                        'Deferred attachment gone from the server: mailbox=%s uid=%s',
+                        mailbox_row.name,
+                        deferred.uid,
+                    )
+                    deferred.delete_instance()
+                elif store_backfilled_part(deferred, part, writer):
+                    stats.count('backfilled_parts')
+                    backfilled += 1
+    finally:
+        mbox.logout()
+    log.info('Backfill complete: mailbox=%s attachments=%s', mailbox_row.name, backfilled)
+    return backfilled
@@ -0,0 +1,195 @@
+import re
+from collections.abc import Iterator, Sequence
+from datetime import datetime
+from typing import NamedTuple
+
+from mailboxdb.logger import get_logger
+from mailboxdb.model import SQLITE_BATCH, MsgMeta, MsgThread, RawMsg, db, insert_rows, pw
+from mailboxdb.schema import Message
+
+log = get_logger('Threads')
+
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+# Referenced Message-IDs kept per message, the most recent ones.
+REFERENCES_LIMIT = 100
+REINDEX_BATCH = 500
+
+
+class ThreadMessage(NamedTuple):
+    msgmeta_id: int
+    date: datetime | None
+    from_: str | None
+    subject: str | None
+    message_id: str | None
+    in_reply_to: str | None
+
+
+def normalize_message_id(value: str | None) -> str | None:
+    """
+    The `<id@host>` part of a Message-ID header, or the stripped value without one.
+    """
+    if not value:
+        return None
+    match = MESSAGE_ID_RE.search(value)
+    return match.group(0) if match else value.strip() or None
+
+
+def message_references(email_msg: Message) -> tuple[str, ...]:
+    """
+    Message-IDs of the References and In-Reply-To headers, without duplicates.
+    """
+    found = [
+        *MESSAGE_ID_RE.findall(str(email_msg.get('References') or '')),
+        *MESSAGE_ID_RE.findall(str(email_msg.get('In-Reply-To') or '')),
+    ]
+    return tuple(dict.fromkeys(found))[-REFERENCES_LIMIT:]
+
+
+def _known_threads(keys: set[str]) -> dict[str, int]:
+    known: dict[str, int] = {}
+    keys_list = list(keys)
+    for start in range(0, len(keys_list), SQLITE_BATCH):
+        query = MsgThread.select(MsgThread.message_id, MsgThread.thread).where(
+            MsgThread.message_id.in_(keys_list[start : start + SQLITE_BATCH])
+        )
+        known.update(query.tuples())
+    return known
+
+
+def _next_thread() -> int:
+    # Messages without any Message-ID have a thread but no MsgThread row.
+    last = max(
+        MsgThread.select(pw.fn.MAX(MsgThread.thread)).scalar() or 0,
+        MsgMeta.select(pw.fn.MAX(MsgMeta.thread)).scalar() or 0,
+    )
+    return last + 1
+
+
+def assign_threads(messages: Sequence[tuple[str | None, Sequence[str]]]) -> list[int]:
+    """
+    Thread ids for `(Message-ID, references)` of new messages, in order.
+    Runs inside the writer transaction.
+
+    A message joins the thread of any Message-ID it shares with stored messages
+    or earlier references. When it links several threads they are merged into
+    the oldest, union-find style, relabelling the stored rows once per batch.
+    """
+    keys_of = [
+        [key for key in (normalize_message_id(message_id), *references) if key]
+        for message_id, references in messages
+    ]
+    known = _known_threads({key for keys in keys_of for key in keys})
+    stored = set(known)
+    parent = {thread: thread for thread in known.values()}
+
+    def find(thread: int) -> int:
+        root = thread
+        while parent[root] != root:
+            root = parent[root]
+        while parent[thread] != root:
+            parent[thread], thread = root, parent[thread]
+        return root
+
+    next_thread = None
+    assigned = []
+    for keys in keys_of:
+        threads = {find(known[key]) for key in keys if key in known}
+        if threads:
+            target = min(threads)
+            for thread in threads:
+                parent[thread] = target
+        else:
+            if next_thread is None:
+                next_thread = _next_thread()
+            target, next_thread = next_thread, next_thread + 1
+            parent[target] = target
+        for key in keys:
+            known.setdefault(key, target)
+        assigned.append(target)
+
+    merged: dict[int, list[int]] = {}
+    for thread in parent:
+        if (root := find(thread)) != thread:
+            merged.setdefault(root, []).append(thread)
+    for root, threads in merged.items():
+        for chunk in pw.chunked(threads, SQLITE_BATCH):
+            MsgThread.update(thread=root).where(MsgThread.thread.in_(chunk)).execute()
+            MsgMeta.update(thread=root).where(MsgMeta.thread.in_(chunk)).execute()
+    insert_rows(
+        MsgThread,
+        [
+            dict(message_id=key, thread=find(thread))
+            for key, thread in known.items()
+            if key not in stored
+        ],
+    )
+    return [find(thread) for thread in assigned]
+
+
+def rebuild_thread_index(batch_size: int = REINDEX_BATCH) -> int:
+    """
+    Thread all stored messages from scratch, reading only their headers,
+    one transaction per batch.
+    """
+    from email.parser import BytesHeaderParser
+
+    if db.is_closed():
+        db.connect()
+    with db.atomic():
+        MsgThread.delete().execute()
+        MsgMeta.update(thread=None).execute()
+    parser = BytesHeaderParser()
+    last_id = 0
+    threaded = 0
+    while True:
+        rows = list(
+            MsgMeta.select(MsgMeta.id, MsgMeta.message_id, RawMsg)
+            .join(RawMsg)
+            .where(MsgMeta.id > last_id)
+            .order_by(MsgMeta.id)
+            .limit(batch_size)
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        with db.atomic():
+            threads = assign_threads(
+                [
+                    (
+                        m.message_id,
+                        message_references(parser.parsebytes(m.rawmsg.read_body())),
+                    )
+                    for m in rows
+                ]
+            )
+            for m, thread in zip(rows, threads):
+                m.thread = thread
+            MsgMeta.bulk_update(rows, [MsgMeta.thread])
+        threaded += len(rows)
+        log.info('Threaded messages: %s, up to id=%s', threaded, last_id)
+    return threaded
+
+
+def thread_messages(message_id: str) -> Iterator[ThreadMessage]:
+    """
+    All messages in the thread of `message_id`, oldest first, in one query.
+    """
+    key = normalize_message_id(message_id)
+    if key and not key.startswith('<'):
+        key = f'<{key}>'
+    thread = MsgThread.select(MsgThread.thread).where(MsgThread.message_id == key)
+    rows = (
+        MsgMeta.select(
+            MsgMeta.id,
+            MsgMeta.date,
+            MsgMeta.from_,
+            MsgMeta.subject,
+            MsgMeta.message_id,
+            MsgMeta.in_reply_to,
+        )
+        .where(MsgMeta.thread == thread)
+        .order_by(MsgMeta.date, MsgMeta.id)
+        .tuples()
+    )
+    for row in rows:
+        yield ThreadMessage(*row)
@@ -0,0 +1,17 @@
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+from playhouse.migrate import migrate as apply_operations
+
+from mailboxdb.migrations import column_names
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    if 'size' not in column_names(db, 'msgmeta'):
+        apply_operations(
+            migrator.add_column('msgmeta', 'size', pw.IntegerField(null=True))
+        )
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    if 'size' in column_names(db, 'msgmeta'):
+        apply_operations(migrator.drop_column('msgmeta', 'size'))
@@ -0,0 +1,80 @@
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+
+from mailboxdb.helpers import naive_utc
+from mailboxdb.logger import get_logger
+
+log = get_logger('Migrations')
+
+BACKFILL_BATCH = 1000
+
+INDEXES = {
+    'msgmeta_message_id': 'msgmeta ("message_id")',
+    'msgmeta_in_reply_to': 'msgmeta ("in_reply_to")',
+    'msgmeta_date': 'msgmeta ("date")',
+    'msgmeta_from_': 'msgmeta ("from_")',
+    'msgmeta_rawmsg_id': 'msgmeta ("rawmsg_id")',
+    'msgmetamailboxthrough_mailbox_id_msgmeta_id': (
+        'msgmeta_mailbox_through ("mailbox_id", "msgmeta_id")'
+    ),
+}
+
+
+def _parse_date(value: str) -> datetime | None:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def backfill_dates(db: pw.Database):
+    """
+    Rewrite stored dates as naive UTC, which sorts correctly as text.
+    """
+    last_id = 0
+    skipped = 0
+    while True:
+        rows = db.execute_sql(
+            'SELECT id, date FROM msgmeta WHERE id > ? AND date IS NOT NULL '
+            'ORDER BY id LIMIT ?',
+            (last_id, BACKFILL_BATCH),
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        for row_id, value in rows:
+            parsed = _parse_date(str(value))
+            if parsed is None:
+                skipped += 1
+                continue
+            normalized = str(naive_utc(parsed))
+            if normalized != value:
+                updates.append((normalized, row_id))
+        if updates:
+            db.connection().executemany(
+                'UPDATE msgmeta SET date = ? WHERE id = ?', updates
+            )
+
+    if skipped:
+        log.warning('Dates left unchanged, not parseable: %s', skipped)
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    for name, target in INDEXES.items():
+        db.execute_sql(f'CREATE INDEX IF NOT EXISTS "{name}" ON {target}')
+    backfill_dates(db)
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    for name in INDEXES:
+        if name != 'msgmeta_rawmsg_id':
+            db.execute_sql(f'DROP INDEX IF EXISTS "{name}"')
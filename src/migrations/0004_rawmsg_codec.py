@@ -0,0 +1,15 @@
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+from playhouse.migrate import migrate as apply_operations
+
+from mailboxdb.migrations import column_names
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    if 'codec' not in column_names(db, 'rawmsg'):
+        apply_operations(migrator.add_column('rawmsg', 'codec', pw.CharField(null=True)))
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    if 'codec' in column_names(db, 'rawmsg'):
+        apply_operations(migrator.drop_column('rawmsg', 'codec'))
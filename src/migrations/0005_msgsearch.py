@@ -0,0 +1,16 @@
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+
+from mailboxdb.logger import get_logger
+from mailboxdb.model import MsgSearch
+
+log = get_logger('Migrations')
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    db.create_tables([MsgSearch], safe=True)
+    log.info('Search index created; run mailboxdb --reindex to index stored messages.')
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    db.drop_tables([MsgSearch], safe=True)
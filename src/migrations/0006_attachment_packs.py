@@ -0,0 +1,29 @@
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+from playhouse.migrate import migrate as apply_operations
+
+from mailboxdb.migrations import column_names
+
+COLUMNS = ('pack_segment', 'pack_offset', 'pack_length')
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    existing = column_names(db, 'attachmentmeta')
+    apply_operations(
+        *(
+            migrator.add_column('attachmentmeta', column, pw.IntegerField(null=True))
+            for column in COLUMNS
+            if column not in existing
+        )
+    )
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    existing = column_names(db, 'attachmentmeta')
+    apply_operations(
+        *(
+            migrator.drop_column('attachmentmeta', column)
+            for column in COLUMNS
+            if column in existing
+        )
+    )
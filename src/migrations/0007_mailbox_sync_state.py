@@ -0,0 +1,55 @@
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+from playhouse.migrate import migrate as apply_operations
+
+from mailboxdb.migrations import column_names
+
+MAILBOX_COLUMNS = ('uid_validity', 'highest_modseq')
+LABEL_COLUMNS = {
+    'uid': pw.IntegerField(null=True),
+    'flags': pw.CharField(null=True),
+}
+UID_INDEX = 'msgmetamailboxthrough_mailbox_id_uid'
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    existing = column_names(db, 'mailbox')
+    apply_operations(
+        *(
+            migrator.add_column('mailbox', column, pw.IntegerField(null=True))
+            for column in MAILBOX_COLUMNS
+            if column not in existing
+        )
+    )
+    existing = column_names(db, 'msgmeta_mailbox_through')
+    apply_operations(
+        *(
+            migrator.add_column('msgmeta_mailbox_through', column, field)
+            for column, field in LABEL_COLUMNS.items()
+            if column not in existing
+        )
+    )
+    db.execute_sql(
+        f'CREATE INDEX IF NOT EXISTS "{UID_INDEX}" '
+        'ON msgmeta_mailbox_through ("mailbox_id", "uid")'
+    )
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    db.execute_sql(f'DROP INDEX IF EXISTS "{UID_INDEX}"')
+    existing = column_names(db, 'msgmeta_mailbox_through')
+    apply_operations(
+        *(
+            migrator.drop_column('msgmeta_mailbox_through', column)
+            for column in LABEL_COLUMNS
+            if column in existing
+        )
+    )
+    existing = column_names(db, 'mailbox')
+    apply_operations(
+        *(
+            migrator.drop_column('mailbox', column)
+            for column in MAILBOX_COLUMNS
+            if column in existing
+        )
+    )
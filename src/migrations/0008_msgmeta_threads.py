@@ -0,0 +1,30 @@
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+from playhouse.migrate import migrate as apply_operations
+
+from mailboxdb.logger import get_logger
+from mailboxdb.migrations import column_names
+from mailboxdb.model import MsgThread
+
+log = get_logger('Migrations')
+
+THREAD_INDEX = 'msgmeta_thread'
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    db.create_tables([MsgThread], safe=True)
+    if 'thread' not in column_names(db, 'msgmeta'):
+        apply_operations(
+            migrator.add_column('msgmeta', 'thread', pw.IntegerField(null=True))
+        )
+        log.info(
+            'Thread index created; run mailboxdb --reindex to thread stored messages.'
+        )
+    db.execute_sql(f'CREATE INDEX IF NOT EXISTS "{THREAD_INDEX}" ON msgmeta ("thread")')
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    db.execute_sql(f'DROP INDEX IF EXISTS "{THREAD_INDEX}"')
+    if 'thread' in column_names(db, 'msgmeta'):
+        apply_operations(migrator.drop_column('msgmeta', 'thread'))
+    db.drop_tables([MsgThread], safe=True)
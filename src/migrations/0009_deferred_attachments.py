@@ -0,0 +1,12 @@
+import peewee as pw
+from playhouse.migrate import SqliteMigrator
+
+from mailboxdb.model import DeferredAttachment
+
+
+def migrate(db: pw.Database, migrator: SqliteMigrator):
+    db.create_tables([DeferredAttachment], safe=True)
+
+
+def rollback(db: pw.Database, migrator: SqliteMigrator):
+    db.drop_tables([DeferredAttachment], safe=True)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#
+# Measure ingestion throughput on generated emails, without a Dovecot instance.
+# Run from the repository root, and compare the JSON output across versions:
+#
+# python tests/benchmark.py --scales 200,1000 --mixes text,mixed,heavy -o before.json
+# python tests/benchmark.py --scales 200,1000 --mixes text,mixed,heavy --baseline before.json
+#
+# Every measurement runs in a fresh process with its own database, so peak RSS
+# and commit counts belong to one phase only:
+#   imap     run() syncing INBOX from the fake IMAP server
+#   file     run_file() on a folder of .eml files
+#   process  process_message() on each message, one transaction each
+#
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+from pathlib import Path
+
+sys.path[:0] = [
+    str(Path(__file__).resolve().parents[1] / 'src'),
+    str(Path(__file__).parent),
+]
+
+PHASES = ('imap', 'file', 'process')
+# Attachments added to the messages of each mix:
+#   text   none
+#   mixed  a fixture file on every third message
+#   heavy  a fixture file and HEAVY_ATTACHMENT_SIZE random bytes on every message
+MIXES = ('text', 'mixed', 'heavy')
+HEAVY_ATTACHMENT_SIZE = 256 * 1024
+
+
+def build_corpus(
+    count: int, mix: str, duplicates: float, seed: int
+) -> list[tuple[int, bytes]]:
+    """
+    Generate `count` emails, a `duplicates` share of them copies of earlier ones.
+    """
+    from composeemail import compose_email
+
+    rnd = random.Random(seed)
+    random.seed(seed)
+    messages: list[tuple[int, bytes]] = []
+    for uid in range(1, count + 1):
+        if messages and rnd.random() < duplicates:
+            messages.append((uid, rnd.choice(messages)[1]))
+            continue
+        has_attachment = mix == 'heavy' or (mix == 'mixed' and uid % 3 == 0)
+        eml = compose_email(has_attachment=has_attachment)
+        eml['Message-Id'] = f'<bench-{seed}-{uid}@example.org>'
+        if mix == 'heavy':
+            eml.add_attachment(
+                rnd.randbytes(HEAVY_ATTACHMENT_SIZE),
+                maintype='application',
+                subtype='octet-stream',
+                filename=f'random-{uid}.bin',
+            )
+        messages.append((uid, eml.as_bytes()))
+    return messages
+
+
+def write_corpus(folder: Path, messages: list[tuple[int, bytes]]):
+    folder.mkdir(parents=True)
+    for uid, raw in messages:
+        (folder / f'{uid:08d}.eml').write_bytes(raw)
+
+
+def count_statements(database) -> dict[str, int]:
+    """
+    Count the statements and commits of every connection `database` opens.
+    """
+    counts = {'statements': 0, 'commits': 0}
+    add_hooks = database._add_conn_hooks
+
+    def trace(sql: str):
+        counts['statements'] += 1
+        if sql.startswith('COMMIT'):
+            counts['commits'] += 1
+
+    def hooks(conn):
+        add_hooks(conn)
+        conn.set_trace_callback(trace)
+
+    database._add_conn_hooks = hooks
+    return counts
+
+
+def measure(
+    phase: str, corpus: str, workdir: str, port: int, commit_size: int, parse_workers: int
+) -> dict:
+    """
+    Ingest `corpus` once in `workdir`; runs in a child process.
+    """
+    os.chdir(workdir)
+    from imaplib import IMAP4
+
+    from mailboxdb import imap
+    from mailboxdb.helpers import results_from_raw
+    from mailboxdb.ingest import run_file
+    from mailboxdb.instrument import stats
+    from mailboxdb.logger import quiet_root_logger
+    from mailboxdb.migrations import run_migrations
+    from mailboxdb.model import RawMsg, configure_db, db
+    from mailboxdb.process import process_message
+    from mailboxdb.run import run
+    from mailboxdb.schema import RawMessage
+
+    quiet_root_logger()
+    configure_db(str(Path(workdir) / 'messages.db'))
+    run_migrations()
+    db.close()
+    counts = count_statements(db)
+    paths = sorted(Path(corpus).glob('*.eml'))
+
+    started = time.perf_counter()
+    if phase == 'imap':
+        imap.IMAP4_SSL = functools.partial(IMAP4, port=port)
+        creds = Path(workdir) / 'credentials.ini'
+        creds.write_text(
+            '[DEFAULT]\n'
+            'server = 127.0.0.1\n'
+            'username = bench\n'
+            'password = bench\n'
+            f'commit_size = {commit_size}\n'
+            f'parse_workers = {parse_workers}\n'
+        )
+        run(str(creds))
+    elif phase == 'file':
+        run_file(corpus, commit_size, parse_workers)
+    else:
+        db.connect()
+        for path in paths:
+            raw = RawMessage(path.read_bytes(), path.name.encode())
+            process_message(results_from_raw(raw))
+    elapsed = time.perf_counter() - started
+
+    if db.is_closed():
+        db.connect()
+    return {
+        'seconds': round(elapsed, 4),
+        'stored': RawMsg.select().count(),
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        **counts,
+        'stages': {
+            stage: round(histogram.total, 4)
+            for stage, histogram in stats.histograms.items()
+        },
+    }
+
+
+def run_phase(phase: str, corpus: Path, port: int, args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory(prefix=f'bench-{phase}-') as workdir:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            future = executor.submit(
+                measure,
+                phase,
+                str(corpus),
+                workdir,
+                port,
+                args.commit_size,
+                args.parse_workers,
+            )
+            return future.result()
+
+
+def source_version() -> dict[str, str]:
+    try:
+        version = metadata.version('mailboxdb')
+    except metadata.PackageNotFoundError:
+        version = 'unknown'
+    try:
+        commit = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    return {'version': version, 'commit': commit}
+
+
+def compare(results: list[dict], baseline_file: str):
+    """
+    Print the msgs/s change of each measurement also found in the baseline.
+    """
+    baseline = json.loads(Path(baseline_file).read_text())
+
+    def key(row: dict) -> tuple:
+        return row['phase'], row['messages'], row['mix'], row['duplicates']
+
+    before = {key(row): row for row in baseline['results']}
+    for row in results:
+        if old := before.get(key(row)):
+            change = row['msgs_per_s'] / old['msgs_per_s'] - 1 if old['msgs_per_s'] else 0
+            print(
+                f'{row["phase"]:8} {row["messages"]:>7} {row["mix"]:6} '
+                f'{old["msgs_per_s"]:>9.1f} -> {row["msgs_per_s"]:>9.1f} msgs/s '
+                f'({change:+.1%})',
+                file=sys.stderr,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--scales', default='200,1000', help='Message counts, comma separated'
+    )
+    parser.add_argument(
+        '--mixes', default='text,mixed', help=f'Any of {", ".join(MIXES)}'
+    )
+    parser.add_argument('--phases', default=','.join(PHASES), help='Phases to measure')
+    parser.add_argument('--duplicates', type=float, default=0.1, help='Share of copies')
+    parser.add_argument('--commit-size', type=int, default=500)
+    parser.add_argument('-j', '--parse-workers', type=int, default=1)
+    parser.add_argument(
+        '--latency', type=float, default=0, help='Seconds per IMAP command'
+    )
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='Write the JSON report here, not stdout')
+    parser.add_argument('--baseline', help='JSON report to compare msgs/s against')
+    args = parser.parse_args()
+
+    from fakeimapserver import FakeImapServer
+
+    phases = args.phases.split(',')
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-corpus-') as corpora:
+        for count in map(int, args.scales.split(',')):
+            for mix in args.mixes.split(','):
+                messages = build_corpus(count, mix, args.duplicates, args.seed)
+                corpus = Path(corpora) / f'{count}-{mix}'
+                write_corpus(corpus, messages)
+                size = sum(len(raw) for _, raw in messages)
+                port = FakeImapServer({'INBOX': messages}, args.latency).start_in_thread()
+                for phase in phases:
+                    row = run_phase(phase, corpus, port, args)
+                    row = {
+                        'phase': phase,
+                        'messages': count,
+                        'mix': mix,
+                        'duplicates': args.duplicates,
+                        'megabytes': round(size / 1e6, 2),
+                        'msgs_per_s': round(count / row['seconds'], 1),
+                        'mb_per_s': round(size / 1e6 / row['seconds'], 2),
+                        **row,
+                    }
+                    print(
+                        f'{phase:8} {count:>7} {mix:6} {row["msgs_per_s"]:>9.1f} msgs/s '
+                        f'{row["mb_per_s"]:>7.2f} MB/s {row["peak_rss_mb"]:>7.1f} MB RSS '
+                        f'{row["commits"]:>5} commits',
+                        file=sys.stderr,
+                    )
+                    results.append(row)
+
+    report = {
+        **source_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'commit_size': args.commit_size,
+        'parse_workers': args.parse_workers,
+        'latency': args.latency,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.baseline:
+        compare(results, args.baseline)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
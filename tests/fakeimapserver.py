@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+# A stand-in IMAP server that keeps generated emails in memory,
+# to try the IMAP clients without a Dovecot instance.
+#
+# python tests/fakeimapserver.py --count 200 --connections 20
+#
+
+import argparse
+import asyncio
+import functools
+import hashlib
+import re
+import sys
+import tempfile
+import threading
+import time
+from email.parser import BytesHeaderParser
+from pathlib import Path
+
+UIDVALIDITY = 1
+INTERNALDATE = b'"01-Jan-2024 00:00:00 +0000"'
+SEQUENCE_RE = re.compile(r'^[\d:*,]+$')
+SECTION_RE = re.compile(r'BODY\.PEEK\[([^\]]*)\](?:<(\d+)\.(\d+)>)?')
+MESSAGE_ID_RE = re.compile(rb'(?im)^message-id:.*\r?\n')
+HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+
+
+def _uid_set(spec: str, uids: list[int]) -> list[int]:
+    top = max(uids, default=0)
+    wanted: set[int] = set()
+    for part in spec.split(','):
+        first, _, last = part.partition(':')
+        start = top if first == '*' else int(first)
+        end = start if not last else top if last == '*' else int(last)
+        low, high = min(start, end), max(start, end)
+        wanted.update(uid for uid in uids if low <= uid <= high)
+    return sorted(wanted)
+
+
+def _quote(value: str | None) -> str:
+    if value is None:
+        return 'NIL'
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _params(params: list[tuple[str, str]]) -> str:
+    if not params:
+        return 'NIL'
+    return (
+        '(' + ' '.join(f'{_quote(k.upper())} {_quote(str(v))}' for k, v in params) + ')'
+    )
+
+
+def _split_entity(raw: bytes) -> tuple[bytes, bytes]:
+    match = HEADER_END_RE.search(raw)
+    if not match:
+        return raw, b''
+    return raw[: match.end()], raw[match.end() :]
+
+
+def _children(body: bytes, boundary: bytes) -> list[bytes]:
+    delimiter = re.compile(
+        rb'(?:\A|\r?\n)--' + re.escape(boundary) + rb'(--)?[ \t]*(?:\r?\n|\Z)'
+    )
+    parts: list[bytes] = []
+    start = None
+    for match in delimiter.finditer(body):
+        if start is not None:
+            parts.append(body[start : match.start()])
+        if match.group(1):
+            break
+        start = match.end()
+    return parts
+
+
+def _structure(header: bytes, body: bytes, section: str, sections: dict) -> str:
+    """
+    BODYSTRUCTURE of one entity, recording the bytes of its sections.
+    """
+    entity = BytesHeaderParser().parsebytes(header)
+    boundary = entity.get_boundary()
+    if entity.get_content_maintype() == 'multipart' and boundary:
+        children = []
+        for n, child in enumerate(_children(body, boundary.encode()), 1):
+            child_section = f'{section}.{n}' if section else str(n)
+            child_header, child_body = _split_entity(child)
+            sections[f'{child_section}.MIME'] = child_header
+            sections[child_section] = child_body
+            children.append(_structure(child_header, child_body, child_section, sections))
+        return (
+            '(' + ''.join(children) + f' {_quote(entity.get_content_subtype().upper())} '
+            f'{_params([("boundary", boundary)])} NIL NIL NIL)'
+        )
+
+    maintype = entity.get_content_maintype()
+    subtype = entity.get_content_subtype()
+    params = _params((entity.get_params() or [])[1:])
+    encoding = _quote(str(entity.get('Content-Transfer-Encoding', '7BIT')).upper())
+    fields = (
+        f'{_quote(maintype.upper())} {_quote(subtype.upper())} {params} NIL NIL '
+        f'{encoding} {len(body)}'
+    )
+    if maintype == 'text':
+        fields += ' %d' % body.count(b'\n')
+    elif (maintype, subtype) == ('message', 'rfc822'):
+        fields += ' NIL ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 0 0) 0'
+    disposition = 'NIL'
+    if value := entity.get('Content-Disposition'):
+        disposition_params = entity.get_params(header='Content-Disposition') or []
+        disposition = (
+            f'({_quote(str(value).split(";")[0].strip().upper())} '
+            f'{_params(disposition_params[1:])})'
+        )
+    return f'({fields} NIL {disposition} NIL NIL)'
+
+
+@functools.lru_cache(maxsize=64)
+def message_sections(raw: bytes) -> tuple[str, dict[str, bytes]]:
+    """
+    BODYSTRUCTURE of a message and the bytes of each section, by section spec.
+    """
+    header, body = _split_entity(raw)
+    sections = {'': raw, 'HEADER': header, 'TEXT': body}
+    structure = _structure(header, body, '', sections)
+    sections.setdefault('1', body)
+    return structure, sections
+
+
+class FakeImapServer:
+    """
+    Serve `mailboxes`, a mapping of mailbox name to `(uid, raw email)` pairs.
+    Every command waits `latency` seconds, to make round trips visible.
+    """
+
+    def __init__(self, mailboxes: dict[str, list[tuple[int, bytes]]], latency: float = 0):
+        self.mailboxes = mailboxes
+        self.latency = latency
+        self.connections = 0
+        self.commands = 0
+        self.server: asyncio.AbstractServer | None = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def start_in_thread(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        """
+        Serve from a background event loop, for blocking clients.
+        """
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        ports: list[int] = []
+
+        def serve():
+            asyncio.set_event_loop(loop)
+            ports.append(loop.run_until_complete(self.start(host, port)))
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait()
+        return ports[0]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        selected: list[tuple[int, bytes]] = []
+        writer.write(b'* OK [CAPABILITY IMAP4rev1 IDLE SASL-IR AUTH=XOAUTH2] ready\r\n')
+        try:
+            while line := await reader.readline():
+                self.commands += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+                command, _, args = rest.partition(' ')
+                command = command.upper()
+                status = 'OK'
+                if command == 'CAPABILITY':
+                    writer.write(b'* CAPABILITY IMAP4rev1 IDLE SASL-IR AUTH=XOAUTH2\r\n')
+                elif command == 'AUTHENTICATE' and len(args.split()) == 1:
+                    writer.write(b'+ \r\n')
+                    await reader.readline()
+                elif command in ('SELECT', 'EXAMINE'):
+                    selected = self.mailboxes.get(args.strip('"'), [])
+                    next_uid = max((uid for uid, _ in selected), default=0) + 1
+                    writer.write(b'* %d EXISTS\r\n' % len(selected))
+                    writer.write(b'* OK [UIDVALIDITY %d] ok\r\n' % UIDVALIDITY)
+                    writer.write(b'* OK [UIDNEXT %d] ok\r\n' % next_uid)
+                elif command == 'IDLE':
+                    writer.write(b'+ idling\r\n')
+                    await writer.drain()
+                    await reader.readline()
+                elif command == 'LOGOUT':
+                    writer.write(b'* BYE bye\r\n')
+                    writer.write(f'{tag} OK done\r\n'.encode())
+                    break
+                elif command == 'UID':
+                    status = self._uid(writer, selected, args)
+                elif command not in ('LOGIN', 'AUTHENTICATE', 'NOOP'):
+                    status = 'BAD'
+                writer.write(f'{tag} {status} done\r\n'.encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _uid(self, writer: asyncio.StreamWriter, selected: list, args: str) -> str:
+        command, _, args = args.partition(' ')
+        uids = [uid for uid, _ in selected]
+        if command.upper() == 'SEARCH':
+            spec = args.split()[-1]
+            found = uids if args.upper() == 'ALL' else _uid_set(spec, uids)
+            if not found and uids and args.upper() != 'ALL':
+                found = [max(uids)]  # `n:*` always matches the last message
+            writer.write(('* SEARCH ' + ' '.join(map(str, found)) + '\r\n').encode())
+            return 'OK'
+        if command.upper() != 'FETCH':
+            return 'BAD'
+        spec, _, items = args.partition(' ')
+        if not SEQUENCE_RE.match(spec):
+            return 'BAD'
+        items = items.upper()
+        wanted = set(_uid_set(spec, uids))
+        for seq, (uid, raw) in enumerate(selected, 1):
+            if uid not in wanted:
+                continue
+            parts = [b'UID %d' % uid]
+            if 'FLAGS' in items:
+                parts.append(b'FLAGS ()')
+            if 'RFC822.SIZE' in items:
+                parts.append(b'RFC822.SIZE %d' % len(raw))
+            if 'INTERNALDATE' in items:
+                parts.append(b'INTERNALDATE ' + INTERNALDATE)
+            if 'HEADER.FIELDS (MESSAGE-ID)' in items:
+                match = MESSAGE_ID_RE.search(raw)
+                header = (match.group(0) if match else b'') + b'\r\n'
+                parts.append(
+                    b'BODY[HEADER.FIELDS (MESSAGE-ID)] {%d}\r\n' % len(header) + header
+                )
+            if 'BODYSTRUCTURE' in items:
+                parts.append(b'BODYSTRUCTURE ' + message_sections(raw)[0].encode())
+            for match in SECTION_RE.finditer(items):
+                spec, offset, length = match.groups()
+                if spec.startswith('HEADER.FIELDS'):
+                    continue
+                piece = message_sections(raw)[1].get(spec, b'')
+                name = f'BODY[{spec}]'.encode()
+                if offset is not None:
+                    piece = piece[int(offset) : int(offset) + int(length)]
+                    name += b'<%d>' % int(offset)
+                parts.append(name + b' {%d}\r\n' % len(piece) + piece)
+            if re.search(r'\bRFC822\b(?!\.)', items):
+                parts.append(b'RFC822 {%d}\r\n' % len(raw) + raw)
+            writer.write(b'* %d FETCH (' % seq + b' '.join(parts) + b')\r\n')
+        return 'OK'
+
+
+def generate_mailbox(count: int) -> list[tuple[int, bytes]]:
+    from composeemail import compose_email
+
+    messages = []
+    for uid in range(1, count + 1):
+        eml = compose_email(has_attachment=uid % 3 == 0)
+        eml['Message-Id'] = f'<fake-{uid}@example.org>'
+        messages.append((uid, eml.as_bytes()))
+    return messages
+
+
+async def fetch_concurrently(port: int, connections: int, expected: dict[bytes, str]):
+    from mailboxdb.aioimap import AsyncMbox
+    from mailboxdb.config import ConfigReader
+
+    with tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False) as creds:
+        creds.write('[DEFAULT]\nserver = 127.0.0.1\nusername = user\npassword = pass\n')
+    settings = ConfigReader(creds.name)
+    Path(creds.name).unlink()
+
+    async def one() -> int:
+        mbox = await AsyncMbox.connect(settings, port, use_ssl=False)
+        uids = await mbox.get_message_uids(None)
+        fetched = 0
+        async for result in mbox.fetch_all_messages(uids or []):
+            assert expected[result.uid] == result.checksum, result.uid
+            fetched += 1
+        await mbox.logout()
+        return fetched
+
+    return await asyncio.gather(*(one() for _ in range(connections)))
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--connections', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.005)
+    args = parser.parse_args()
+
+    mailbox = generate_mailbox(args.count)
+    expected = {
+        str(uid).encode(): hashlib.sha256(raw).hexdigest() for uid, raw in mailbox
+    }
+    server = FakeImapServer({'INBOX': mailbox}, args.latency)
+
+    async def main():
+        port = await server.start()
+        started = time.monotonic()
+        counts = await fetch_concurrently(port, args.connections, expected)
+        elapsed = time.monotonic() - started
+        print(
+            f'{sum(counts)} messages over {args.connections} connections '
+            f'in {elapsed:.2f}s, {server.commands} commands'
+        )
+
+    asyncio.run(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Guard the startup cost of the mailboxdb CLI with `python -X importtime`.
+# Run from the repository root; exits with 1 on a regression:
+#
+# python tests/importtime.py -o before.json
+# python tests/importtime.py --baseline before.json
+# python tests/importtime.py --budget-ms 150
+#
+# Every command runs in a fresh interpreter against a migrated database in a
+# temporary folder. A command fails when it imports a module it has no use for
+# (the IMAP client for `--migrate`, say), when its import time exceeds
+# --budget-ms, or when it is more than --tolerance slower than the baseline.
+# Times are medians over --repeat runs, net of a bare `python -c pass`.
+#
+
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1] / 'src'
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+# Loaded only by the commands that fetch, parse or store mail.
+HEAVY_MODULES = (
+    'imaplib',
+    'ssl',
+    'email.parser',
+    'playhouse.migrate',
+    'tracemalloc',
+    'mailboxdb.process',
+    'mailboxdb.sync',
+)
+# Arguments of `mailboxdb`, and the modules each one must not import.
+COMMANDS = {
+    'help': ([], HEAVY_MODULES),
+    'migrate': (['--migrate'], HEAVY_MODULES),
+    'optimize': (['--optimize'], HEAVY_MODULES),
+    'search': (['search', 'invoice'], HEAVY_MODULES),
+    'thread': (['thread', '<none@example.org>'], HEAVY_MODULES),
+    'attachments': (['attachments', 'verify'], HEAVY_MODULES),
+    # Exports run instrumented, which must not load the profilers unasked.
+    'export': (
+        ['export', 'export.mbox'],
+        ('imaplib', 'ssl', 'tracemalloc', 'cProfile', 'mailboxdb.process'),
+    ),
+}
+
+
+def import_times(code: str, cwd: str) -> dict[str, tuple[int, int, int]]:
+    """
+    Self and cumulative µs and nesting depth of every module `code` imports.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=cwd,
+        env={'PYTHONPATH': str(SRC)},
+        capture_output=True,
+        text=True,
+    )
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if match := IMPORTTIME_RE.match(line):
+            own, cumulative, indent, name = match.groups()
+            modules[name] = (int(own), int(cumulative), (len(indent) - 1) // 2)
+    if not modules:
+        raise RuntimeError(f'No import times from {code!r}: {proc.stderr[-500:]}')
+    return modules
+
+
+def total_ms(modules: dict[str, tuple[int, int, int]]) -> float:
+    return (
+        sum(cumulative for _, cumulative, depth in modules.values() if not depth) / 1000
+    )
+
+
+def cli_code(argv: list[str], database: str) -> str:
+    if argv and argv[0] in ('search', 'thread', 'attachments', 'export'):
+        argv = [*argv, '--db', database]
+    elif argv:
+        argv = [*argv, '-q', '--db', database]
+    else:
+        return 'import mailboxdb.run'
+    return (
+        'from mailboxdb.run import main\n'
+        'try:\n'
+        f'    main({argv!r})\n'
+        'except SystemExit:\n'
+        '    pass\n'
+    )
+
+
+def measure(args: argparse.Namespace) -> dict:
+    report: dict = {'python': sys.version.split()[0], 'commands': {}}
+    with tempfile.TemporaryDirectory(prefix='importtime-') as workdir:
+        database = str(Path(workdir) / 'messages.db')
+        # Migrate once so that every measured --migrate finds nothing pending.
+        import_times(cli_code(['--migrate'], database), workdir)
+        bare = statistics.median(
+            total_ms(import_times('pass', workdir)) for _ in range(args.repeat)
+        )
+        for name, (argv, forbidden) in COMMANDS.items():
+            runs = [
+                import_times(cli_code(argv, database), workdir)
+                for _ in range(args.repeat)
+            ]
+            modules = runs[-1]
+            top = sorted(
+                (m for m in modules.items() if m[0].startswith('mailboxdb')),
+                key=lambda m: m[1][1],
+                reverse=True,
+            )
+            report['commands'][name] = {
+                'ms': round(statistics.median(map(total_ms, runs)) - bare, 1),
+                'modules': len(modules),
+                'unexpected': [m for m in forbidden if m in modules],
+                'slowest': {m: round(times[1] / 1000, 1) for m, times in top[:5]},
+            }
+    return report
+
+
+def check(report: dict, args: argparse.Namespace) -> list[str]:
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    failures = []
+    for name, result in report['commands'].items():
+        if result['unexpected']:
+            failures.append(f'{name}: imports {", ".join(result["unexpected"])}')
+        if args.budget_ms and result['ms'] > args.budget_ms:
+            failures.append(f'{name}: {result["ms"]} ms over {args.budget_ms} ms')
+        before = baseline and baseline['commands'].get(name)
+        if before and result['ms'] > before['ms'] * (1 + args.tolerance):
+            failures.append(f'{name}: {result["ms"]} ms, baseline {before["ms"]} ms')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--repeat', type=int, default=5, help='Runs per command, the median is kept'
+    )
+    parser.add_argument(
+        '--budget-ms', type=float, help='Fail a command importing for longer than this'
+    )
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare to')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.25,
+        help='Slowdown against the baseline that still passes (default: 0.25)',
+    )
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    report = measure(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    print(text)
+
+    failures = check(report, args)
+    for failure in failures:
+        print(f'FAIL {failure}', file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
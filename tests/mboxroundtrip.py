@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Check that messages written to an mbox file read back byte for byte.
+# Run from the repository root; exits with 1 on a mismatch:
+#
+# python tests/mboxroundtrip.py
+#
+# Messages are written with MboxWriter, which quotes `From ` lines mboxrd
+# style, then read back with mbox_messages both in memory and streamed,
+# which must undo the quoting. A message without a final line end comes
+# back with one, as mbox cannot keep it.
+#
+
+import hashlib
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from mailboxdb.attachments import AttachmentStore  # noqa: E402
+from mailboxdb.mailfiles import MboxWriter, mbox_messages  # noqa: E402
+from mailboxdb.stream import DEFAULT_STREAM_CHUNK_SIZE  # noqa: E402
+
+HEADERS = b'From: Ann <ann@example.org>\nSubject: %d\n\n'
+BODIES = [
+    b'Plain text.\n',
+    b'From the start.\n>From quoted.\n>>From twice.\nNot From here.\n',
+    b'>From\n>From \nFrom\nFrom \n',
+    b'Crlf\r\nFrom here\r\n>From there\r\n',
+    # `From ` lines around the edge of a streamed piece.
+    b'x' * (DEFAULT_STREAM_CHUNK_SIZE - 40) + b'\n>From edge\nFrom edge\n' * 4,
+    # A line longer than a streamed piece, then `From ` lines.
+    b'y' * (DEFAULT_STREAM_CHUNK_SIZE + 10) + b'>From inside\n>From after\n',
+    # Line ends the blank line between messages must not be confused with.
+    b'Mixed\r\nline ends\n',
+    b'Ends with a blank line\n\n',
+    b'No final line end',
+    b'No final\r\nline end',
+]
+
+
+def messages() -> list[bytes]:
+    return [HEADERS % n + body for n, body in enumerate(BODIES)]
+
+
+def check(path: Path, expected: list[bytes], stream_threshold: int) -> list[str]:
+    with tempfile.TemporaryDirectory(prefix='attachments-') as root:
+        store = AttachmentStore(root)
+        found = [m.raw for m in mbox_messages(path, None, stream_threshold, store)]
+    if len(found) != len(expected):
+        return [f'threshold {stream_threshold}: {len(found)} of {len(expected)} read']
+    failures = []
+    for n, (message, raw) in enumerate(zip(expected, found)):
+        if raw.raw_email != message:
+            failures.append(f'threshold {stream_threshold}: message {n} differs')
+        # Streamed messages carry the checksum dedup compares against IMAP.
+        if raw.checksum and raw.checksum != hashlib.sha256(message).hexdigest():
+            failures.append(f'threshold {stream_threshold}: checksum {n} differs')
+    return failures
+
+
+def main():
+    expected = messages()
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='mbox-') as workdir:
+        path = Path(workdir) / 'roundtrip.mbox'
+        with path.open('wb') as fp:
+            writer = MboxWriter(fp)
+            for n, message in enumerate(expected):
+                eol = b'\r\n' if b'\r\n' in message else b'\n'
+                writer.start('ann@example.org', datetime(2024, 5, 1))
+                writer.write(message)
+                writer.finish(eol)
+                if not message.endswith(b'\n'):
+                    expected[n] = message + eol
+        for stream_threshold in (1 << 30, 0):
+            failures += check(path, expected, stream_threshold)
+    for failure in failures:
+        print(f'FAIL {failure}', file=sys.stderr)
+    print(f'{len(expected)} messages, {len(failures)} failures')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()